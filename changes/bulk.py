@@ -0,0 +1,32 @@
+from django.db import transaction
+
+from .models import Change
+from .serializers import BulkChangeSerializer
+from .tasks import dispatch_changes
+
+
+def create_changes(rows, source, start=0):
+    """ Validates the change rows, creates the valid ones in a single query,
+    and queues them to be implemented in batches.
+
+    Returns a list with the outcome of each row: the row number, starting
+    from start, and either the id of the created change, or the validation
+    errors.
+    """
+    outcomes = []
+    changes = []
+    for i, row in enumerate(rows, start):
+        serializer = BulkChangeSerializer(data=row)
+        if serializer.is_valid():
+            change = Change(source=source, **serializer.validated_data)
+            changes.append(change)
+            outcomes.append(
+                {"row": i, "status": "created", "id": str(change.id)})
+        else:
+            outcomes.append(
+                {"row": i, "status": "error", "errors": serializer.errors})
+
+    with transaction.atomic():
+        Change.objects.bulk_create(changes)
+    dispatch_changes(changes)
+    return outcomes
@@ -0,0 +1,69 @@
+import csv
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from changes.bulk import create_changes
+from registrations.models import Source
+
+
+class Command(BaseCommand):
+    help = ("Creates changes from a CSV file with mother_id and action "
+            "columns. Any other columns, such as new_language or reason, "
+            "are stored as the change data. The outcome of each row is "
+            "written as CSV to stdout.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'csv_file', help='The CSV file of changes')
+        parser.add_argument(
+            '--source', type=int, required=True,
+            help='The id of the source to create the changes for')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='The amount of rows to create at a time')
+
+    def get_change(self, row):
+        change = {
+            "mother_id": row.pop("mother_id", None),
+            "action": row.pop("action", None),
+        }
+        data = dict((k, v) for k, v in row.items() if k and v)
+        if data:
+            change["data"] = data
+        return change
+
+    def handle(self, *args, **options):
+        try:
+            source = Source.objects.get(id=options['source'])
+        except Source.DoesNotExist:
+            raise CommandError('Source %s does not exist' % options['source'])
+
+        writer = csv.writer(self.stdout)
+        writer.writerow(['row', 'status', 'id', 'errors'])
+        created = rows = 0
+
+        def create(batch, start):
+            results = create_changes(batch, source, start=start)
+            for result in results:
+                writer.writerow([
+                    result['row'], result['status'], result.get('id', ''),
+                    json.dumps(result['errors']) if 'errors' in result
+                    else ''])
+            return len([r for r in results if r['status'] == 'created'])
+
+        with open(options['csv_file']) as f:
+            batch = []
+            for row in csv.DictReader(f):
+                batch.append(self.get_change(row))
+                if len(batch) >= options['batch_size']:
+                    created += create(batch, rows + 1)
+                    rows += len(batch)
+                    batch = []
+            if batch:
+                created += create(batch, rows + 1)
+                rows += len(batch)
+
+        self.stderr.write(
+            "Created %s changes, %s rows had errors" % (
+                created, rows - created))
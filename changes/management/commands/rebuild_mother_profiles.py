@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from changes.models import Change
+from registrations.models import MotherProfile, Registration
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds the mother profiles from each mother's latest "
+            "registration, and the changes implemented since then.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='The amount of mothers to rebuild at a time')
+
+    def create_profiles(self, registrations):
+        profiles = {}
+        for registration in registrations:
+            profile = MotherProfile(
+                mother_id=registration.mother_id,
+                **MotherProfile.get_registration_fields(registration))
+            if registration.validated:
+                profile.subscribed = True
+                profile.subscription_stage = registration.stage
+            profiles[registration.mother_id] = profile
+
+        changes = Change.objects\
+            .filter(mother_id__in=profiles.keys(), implemented=True)\
+            .order_by('created_at')
+        for change in changes:
+            profile = profiles[change.mother_id]
+            if change.created_at < profile.registration.created_at:
+                continue
+            for field, value in MotherProfile.get_change_fields(
+                    change.action, change.data).items():
+                setattr(profile, field, value)
+
+        MotherProfile.objects.bulk_create(profiles.values())
+        return len(profiles)
+
+    def handle(self, *args, **options):
+        registrations = Registration.objects\
+            .select_related('source')\
+            .order_by('mother_id', '-created_at')\
+            .distinct('mother_id')
+
+        count = 0
+        with transaction.atomic():
+            MotherProfile.objects.all().delete()
+            batch = []
+            for registration in registrations.iterator():
+                batch.append(registration)
+                if len(batch) >= options['batch_size']:
+                    count += self.create_profiles(batch)
+                    batch = []
+            if batch:
+                count += self.create_profiles(batch)
+
+        self.stdout.write("Rebuilt %s mother profiles" % count)
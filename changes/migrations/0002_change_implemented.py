@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 07:51
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('changes', '0001_initial'),
+    ]
+
+    operations = [
+        # Changes that already exist have been implemented
+        migrations.AddField(
+            model_name='change',
+            name='implemented',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AlterField(
+            model_name='change',
+            name='implemented',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 07:56
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('changes', '0002_change_implemented'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='change',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='change',
+            name='mother_id',
+            field=models.CharField(db_index=True, max_length=36),
+        ),
+    ]
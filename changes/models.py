@@ -1,15 +1,70 @@
 import uuid
+from datetime import timedelta
 
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Q
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.contrib.postgres.fields import JSONField
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 
 from registrations.models import Source
 
 
+class ChangeQuerySet(models.QuerySet):
+    def claim(self):
+        """
+        Claims the changes that haven't been implemented yet, and aren't
+        already claimed, and returns them in the order that they were
+        submitted. The changes are locked while they are claimed, so each
+        change is only claimed by one task at a time. Claims expire after
+        CHANGE_CLAIM_SECONDS, so that the changes of a task that died are
+        implemented again.
+        """
+        now = timezone.now()
+        expired = now - timedelta(seconds=settings.CHANGE_CLAIM_SECONDS)
+        with transaction.atomic():
+            changes = list(self.select_for_update()
+                           .filter(implemented=False)
+                           .filter(Q(claimed_at__isnull=True) |
+                                   Q(claimed_at__lt=expired))
+                           .order_by('created_at'))
+            self.model.objects.filter(
+                id__in=[change.id for change in changes]
+            ).update(claimed_at=now)
+        for change in changes:
+            change.claimed_at = now
+        return changes
+
+    def stale(self, older_than):
+        """
+        Returns the changes submitted before older_than that still haven't
+        been implemented, and aren't claimed by a task, because they failed,
+        or the task implementing them died.
+        """
+        expired = timezone.now() - timedelta(
+            seconds=settings.CHANGE_CLAIM_SECONDS)
+        return self.filter(implemented=False, created_at__lt=older_than)\
+            .filter(Q(claimed_at__isnull=True) | Q(claimed_at__lt=expired))
+
+    def complete(self, changes):
+        """
+        Marks the claimed changes as implemented.
+        """
+        self.filter(id__in=[change.id for change in changes]).update(
+            implemented=True, claimed_at=None)
+
+    def release(self, changes):
+        """
+        Releases the claim on the changes, so that they can be retried.
+        """
+        self.filter(id__in=[change.id for change in changes]).update(
+            claimed_at=None)
+
+
 @python_2_unicode_compatible
 class Change(models.Model):
     """ A request to change a subscription
@@ -19,6 +74,9 @@ class Change(models.Model):
         action (str): What type of change to implement
         data (json): Change info in json format
         source (object): Auto-completed field based on the Api key
+        implemented (bool): True once the change has been implemented
+        claimed_at (datetime): When a task claimed the change to implement
+            it, if it is being implemented
     """
 
     ACTION_CHOICES = (
@@ -29,14 +87,17 @@ class Change(models.Model):
     )
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    mother_id = models.CharField(max_length=36, null=False, blank=False)
+    mother_id = models.CharField(max_length=36, null=False, blank=False,
+                                 db_index=True)
     action = models.CharField(max_length=255, null=False, blank=False,
                               choices=ACTION_CHOICES)
     data = JSONField(null=True, blank=True)
     validated = models.BooleanField(default=False)
+    implemented = models.BooleanField(default=False)
+    claimed_at = models.DateTimeField(null=True, blank=True)
     source = models.ForeignKey(Source, related_name='changes',
                                null=False)
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     updated_at = models.DateTimeField(auto_now=True)
     created_by = models.ForeignKey(User, related_name='changes_created',
                                    null=True)
@@ -44,16 +105,26 @@ class Change(models.Model):
                                    null=True)
     user = property(lambda self: self.created_by)
 
+    objects = ChangeQuerySet.as_manager()
+
     def __str__(self):
         return str(self.id)
 
 
 @receiver(post_save, sender=Change)
 def change_post_save(sender, instance, created, **kwargs):
-    """ Post save hook to fire Change validation task
+    """ Post save hook to fire Change validation task. If changes are
+    coalesced, the changes for the mother are implemented together once the
+    coalescing window has passed.
     """
     if created:
-        from .tasks import implement_action
-        implement_action.apply_async(
-            kwargs={"change_id": str(instance.id)})
-        pass
+        from .tasks import implement_action, implement_mother_changes
+        if settings.CHANGE_COALESCE_SECONDS:
+            implement_mother_changes.apply_async(
+                kwargs={"mother_id": instance.mother_id},
+                countdown=settings.CHANGE_COALESCE_SECONDS)
+        else:
+            implement_action.apply_async(kwargs={
+                "change_id": str(instance.id),
+                "mother_id": instance.mother_id,
+            })
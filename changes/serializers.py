@@ -6,7 +6,18 @@ class ChangeSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Change
-        read_only_fields = ('validated', 'created_by', 'updated_by',
-                            'created_at', 'updated_at')
-        fields = ('id', 'action', 'mother_id', 'data', 'validated', 'source',
-                  'created_at', 'updated_at', 'created_by', 'updated_by')
+        read_only_fields = ('validated', 'implemented', 'created_by',
+                            'updated_by', 'created_at', 'updated_at')
+        fields = ('id', 'action', 'mother_id', 'data', 'validated',
+                  'implemented', 'source', 'created_at', 'updated_at',
+                  'created_by', 'updated_by')
+
+
+class BulkChangeSerializer(serializers.ModelSerializer):
+    """ Validates a single change of a bulk submission. The source is set
+    for the whole submission, instead of for each change.
+    """
+
+    class Meta:
+        model = Change
+        fields = ('action', 'mother_id', 'data')
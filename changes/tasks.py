@@ -1,7 +1,13 @@
+import datetime
+
 from celery.task import Task
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
 
 from familyconnect_registration import utils
-from registrations.models import Registration, SubscriptionRequest
+from familyconnect_registration.routers import get_mother_shard_queue
+from registrations.models import MotherProfile, SubscriptionRequest
 from .models import Change
 
 
@@ -10,28 +16,36 @@ class ImplementAction(Task):
     """
     name = "familyconnect_registration.changes.tasks.implement_action"
 
+    def deactivate_subscriptions(self, mother_id):
+        """ Gets the current subscriptions, and deactivates them
+        concurrently.
+        """
+        subscriptions = utils.get_subscriptions(mother_id)
+        utils.run_concurrently(
+            (utils.deactivate_subscription, (subscription,))
+            for subscription in subscriptions)
+
     def change_baby(self, change):
-        # Get current subscriptions
-        subscriptions = utils.get_subscriptions(change.mother_id)
-        # Deactivate subscriptions
-        for subscription in subscriptions:
-            utils.deactivate_subscription(subscription)
-        # Get mother's identity
-        mother = utils.get_identity(change.mother_id)
-        # Get mother's registration
-        registration = Registration.objects.get(mother_id=change.mother_id)
+        # Get mother's profile
+        profile = MotherProfile.objects.get_for_mother(change.mother_id)
 
         short_name = utils.get_messageset_short_name(
-            registration.data["msg_receiver"],
+            profile.msg_receiver,
             'postbirth',
-            registration.source.authority)
+            profile.authority)
 
-        msgset_id, msgset_schedule, next_sequence_number =\
-            utils.get_messageset_schedule_sequence(short_name, 0)
+        # Deactivate current subscriptions, get mother's identity and the new
+        # messageset concurrently
+        _, mother, (msgset_id, msgset_schedule, next_sequence_number) = \
+            utils.run_concurrently([
+                (self.deactivate_subscriptions, (change.mother_id,)),
+                (utils.get_identity, (change.mother_id,)),
+                (utils.get_messageset_schedule_sequence, (short_name, 0)),
+            ])
 
         # Make new subscription request object
         mother_sub = {
-            "identity": registration.mother_id,
+            "identity": change.mother_id,
             "messageset": msgset_id,
             "next_sequence_number": next_sequence_number,
             "lang": mother["details"]["preferred_language"],
@@ -42,23 +56,22 @@ class ImplementAction(Task):
         return "Change baby completed"
 
     def change_loss(self, change):
-        # Get current subscriptions
-        subscriptions = utils.get_subscriptions(change.mother_id)
-        # Deactivate subscriptions
-        for subscription in subscriptions:
-            utils.deactivate_subscription(subscription)
-        # Get mother's identity
-        mother = utils.get_identity(change.mother_id)
-        # Get mother's registration
-        registration = Registration.objects.get(mother_id=change.mother_id)
+        # Get mother's profile
+        profile = MotherProfile.objects.get_for_mother(change.mother_id)
 
         short_name = utils.get_messageset_short_name(
-            registration.data["msg_receiver"],
+            profile.msg_receiver,
             'loss',
-            registration.source.authority)
+            profile.authority)
 
-        msgset_id, msgset_schedule, next_sequence_number =\
-            utils.get_messageset_schedule_sequence(short_name, 0)
+        # Deactivate current subscriptions, get mother's identity and the new
+        # messageset concurrently
+        _, mother, (msgset_id, msgset_schedule, next_sequence_number) = \
+            utils.run_concurrently([
+                (self.deactivate_subscriptions, (change.mother_id,)),
+                (utils.get_identity, (change.mother_id,)),
+                (utils.get_messageset_schedule_sequence, (short_name, 0)),
+            ])
 
         # Make new subscription request object
         mother_sub = {
@@ -76,19 +89,16 @@ class ImplementAction(Task):
         # Get current subscriptions
         subscriptions = utils.get_subscriptions(change.mother_id)
         # Patch subscriptions languages
-        for subscription in subscriptions:
-            utils.patch_subscription(
-                subscription, {"lang": change.data["new_language"]})
+        utils.run_concurrently(
+            (utils.patch_subscription,
+             (subscription, {"lang": change.data["new_language"]}))
+            for subscription in subscriptions)
 
         return "Change language completed"
 
     def unsubscribe(self, change):
-        # Get current subscriptions
-        subscriptions = utils.get_subscriptions(
-            change.mother_id)
-        # Deactivate subscriptions
-        for subscription in subscriptions:
-            utils.deactivate_subscription(subscription)
+        # Deactivate current subscriptions
+        self.deactivate_subscriptions(change.mother_id)
 
         return "Unsubscribe completed"
 
@@ -96,13 +106,273 @@ class ImplementAction(Task):
         """ Implements the appropriate action
         """
         change = Change.objects.get(id=change_id)
+        if not Change.objects.filter(id=change.id).claim():
+            return "Change already implemented"
 
-        result = {
-            'change_baby': self.change_baby,
-            'change_loss': self.change_loss,
-            'change_language': self.change_language,
-            'unsubscribe': self.unsubscribe,
-        }.get(change.action, None)(change)
+        try:
+            result = {
+                'change_baby': self.change_baby,
+                'change_loss': self.change_loss,
+                'change_language': self.change_language,
+                'unsubscribe': self.unsubscribe,
+            }.get(change.action, None)(change)
+        except Exception:
+            Change.objects.release([change])
+            raise
+        Change.objects.complete([change])
+        MotherProfile.objects.apply_change(
+            change.mother_id, change.action, change.data)
         return result
 
 implement_action = ImplementAction()
+
+
+class ImplementActions(Task):
+    """ Task to apply a batch of Change actions of the same type. The
+    subscription lookups and patches for unsubscribes and language changes
+    are made concurrently across the whole batch.
+    """
+    name = "familyconnect_registration.changes.tasks.implement_actions"
+
+    def patch_subscriptions(self, changes, get_data):
+        """ Gets the subscriptions of all of the changes, and patches them
+        with the data for their change. Returns a dictionary of change id to
+        the error for the changes that failed.
+        """
+        errors = {}
+        patch_data = {}
+        for change in changes:
+            try:
+                patch_data[change.id] = get_data(change)
+            except Exception as e:
+                errors[change.id] = e
+        changes = [c for c in changes if c.id not in errors]
+
+        subscriptions = utils.run_concurrently(
+            ((utils.get_subscriptions, (change.mother_id,))
+             for change in changes), raise_errors=False)
+        patches = []
+        for change, result in zip(changes, subscriptions):
+            if isinstance(result, Exception):
+                errors[change.id] = result
+            else:
+                patches.extend((change, s) for s in result)
+
+        results = utils.run_concurrently(
+            ((utils.patch_subscription, (subscription, patch_data[change.id]))
+             for change, subscription in patches), raise_errors=False)
+        for (change, _), result in zip(patches, results):
+            if isinstance(result, Exception):
+                errors.setdefault(change.id, result)
+        return errors
+
+    def run(self, action, change_ids, **kwargs):
+        """ Implements the changes, and returns a dictionary of change id to
+        the outcome of each change.
+        """
+        l = self.get_logger(**kwargs)
+        changes = Change.objects\
+            .filter(id__in=change_ids, action=action)\
+            .claim()
+
+        if action in ('unsubscribe', 'change_language'):
+            if action == 'unsubscribe':
+                success = "Unsubscribe completed"
+                errors = self.patch_subscriptions(
+                    changes, lambda change: {"active": False})
+            else:
+                success = "Change language completed"
+                errors = self.patch_subscriptions(
+                    changes,
+                    lambda change: {"lang": change.data["new_language"]})
+            outcomes = dict(
+                (change.id, errors.get(change.id, success))
+                for change in changes)
+        else:
+            outcomes = {}
+            for change in changes:
+                try:
+                    outcomes[change.id] = getattr(
+                        implement_action, action)(change)
+                except Exception as e:
+                    outcomes[change.id] = e
+
+        failed = [c for c in changes if isinstance(outcomes[c.id], Exception)]
+        Change.objects.release(failed)
+        Change.objects.complete(c for c in changes if c not in failed)
+
+        result = {}
+        for change in changes:
+            outcome = outcomes[change.id]
+            if isinstance(outcome, Exception):
+                l.warning("Change %s failed: %r" % (change.id, outcome))
+                outcome = "Failed: %r" % outcome
+            else:
+                MotherProfile.objects.apply_change(
+                    change.mother_id, change.action, change.data)
+            result[str(change.id)] = outcome
+        return result
+
+implement_actions = ImplementActions()
+
+
+class ImplementMotherChanges(Task):
+    """ Task to implement all of the pending changes for a mother at once.
+    The changes are merged into a plan with at most one patch per
+    subscription and one new subscription request, which has the same
+    outcome as implementing the changes one by one in submission order.
+    """
+    name = "familyconnect_registration.changes.tasks.implement_mother_changes"
+
+    def get_plan(self, changes, subscriptions):
+        """ Returns a list of (subscription, data) patches to make, and the
+        stage and language of the new subscription request to make, or None.
+        The language is None if it should be the mother's preferred language.
+        """
+        active = list(subscriptions)
+        patches = dict((s["id"], (s, {})) for s in subscriptions)
+        new_subscription = None
+        for change in changes:
+            if change.action == 'change_language':
+                language = change.data["new_language"]
+                for subscription in active:
+                    patches[subscription["id"]][1]["lang"] = language
+                if new_subscription is not None:
+                    new_subscription["lang"] = language
+            elif change.action in ('unsubscribe', 'change_baby',
+                                   'change_loss'):
+                for subscription in active:
+                    # The language of an inactive subscription doesn't matter
+                    patches[subscription["id"]] = (
+                        subscription, {"active": False})
+                active = []
+                new_subscription = None
+                if change.action == 'change_baby':
+                    new_subscription = {"stage": 'postbirth', "lang": None}
+                elif change.action == 'change_loss':
+                    new_subscription = {"stage": 'loss', "lang": None}
+            else:
+                raise ValueError("Unknown action %s" % change.action)
+
+        patches = [(s, data) for s, data in patches.values() if data]
+        return patches, new_subscription
+
+    def create_subscription_request(self, mother_id, stage, lang):
+        profile = MotherProfile.objects.get_for_mother(mother_id)
+        short_name = utils.get_messageset_short_name(
+            profile.msg_receiver, stage, profile.authority)
+
+        calls = [(utils.get_messageset_schedule_sequence, (short_name, 0))]
+        if lang is None:
+            calls.append((utils.get_identity, (mother_id,)))
+        results = utils.run_concurrently(calls)
+        msgset_id, msgset_schedule, next_sequence_number = results[0]
+        if lang is None:
+            lang = results[1]["details"]["preferred_language"]
+
+        SubscriptionRequest.objects.create(
+            identity=mother_id,
+            messageset=msgset_id,
+            next_sequence_number=next_sequence_number,
+            lang=lang,
+            schedule=msgset_schedule)
+
+    def run(self, mother_id, **kwargs):
+        """ Implements the pending changes for the mother
+        """
+        pending = Change.objects.filter(mother_id=mother_id)
+        if not pending.filter(implemented=False).exists():
+            return "No pending changes"
+
+        subscriptions = utils.get_subscriptions(mother_id)
+        with transaction.atomic():
+            changes = pending.claim()
+            patches, new_subscription = self.get_plan(changes, subscriptions)
+        if not changes:
+            return "Changes already claimed"
+
+        # The patches are idempotent, so if any of the requests fail, all of
+        # the changes can be retried
+        try:
+            utils.run_concurrently(
+                (utils.patch_subscription, (subscription, data))
+                for subscription, data in patches)
+            if new_subscription is not None:
+                self.create_subscription_request(
+                    mother_id, **new_subscription)
+        except Exception:
+            Change.objects.release(changes)
+            raise
+        Change.objects.complete(changes)
+        for change in changes:
+            MotherProfile.objects.apply_change(
+                mother_id, change.action, change.data)
+
+        return "Implemented %s changes" % len(changes)
+
+implement_mother_changes = ImplementMotherChanges()
+
+
+class RetryChanges(Task):
+    """ Task to queue the changes that failed, or whose task died, to be
+    implemented again.
+    """
+    name = "familyconnect_registration.changes.tasks.retry_changes"
+
+    def run(self, **kwargs):
+        """ Queues the changes that have been pending for longer than
+        CHANGE_RETRY_SECONDS. If changes are coalesced, the changes for each
+        mother are retried together.
+        """
+        older_than = timezone.now() - datetime.timedelta(
+            seconds=settings.CHANGE_RETRY_SECONDS)
+        changes = Change.objects.stale(older_than)
+        if settings.CHANGE_COALESCE_SECONDS:
+            mother_ids = changes.order_by('mother_id')\
+                .values_list('mother_id', flat=True).distinct()
+            retried = 0
+            for mother_id in mother_ids.iterator():
+                implement_mother_changes.apply_async(
+                    kwargs={"mother_id": mother_id})
+                retried += 1
+            return "Retrying the changes of %s mothers" % retried
+
+        changes = changes.order_by('created_at')\
+            .values_list('id', 'mother_id')
+        retried = 0
+        for change_id, mother_id in changes.iterator():
+            implement_action.apply_async(kwargs={
+                "change_id": str(change_id),
+                "mother_id": mother_id,
+            })
+            retried += 1
+        return "Retrying %s changes" % retried
+
+retry_changes = RetryChanges()
+
+
+def dispatch_changes(changes, chunk_size=None):
+    """ Queues implement_actions tasks for the changes, with the changes
+    grouped by action into chunks. If there are mother shard queues, the
+    changes are also grouped by shard, and each chunk is queued on its
+    shard's queue, so that it isn't run at the same time as other tasks for
+    its mothers. Returns the amount of tasks queued.
+    """
+    if chunk_size is None:
+        chunk_size = settings.BULK_CHANGE_CHUNK_SIZE
+    change_ids = {}
+    for change in changes:
+        queue = get_mother_shard_queue(change.mother_id) or ''
+        change_ids.setdefault((change.action, queue), []).append(
+            str(change.id))
+
+    tasks = 0
+    for (action, queue), ids in sorted(change_ids.items()):
+        options = {"queue": queue} if queue else {}
+        for i in range(0, len(ids), chunk_size):
+            implement_actions.apply_async(kwargs={
+                "action": action,
+                "change_ids": ids[i:i + chunk_size],
+            }, **options)
+            tasks += 1
+    return tasks
@@ -1,8 +1,21 @@
 import datetime
 import json
+import os
+import tempfile
 import responses
+from requests.exceptions import HTTPError
 
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from django.conf import settings
 from django.test import TestCase
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils import timezone
+from django.utils.six import StringIO
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 
@@ -12,11 +25,16 @@ from rest_framework.authtoken.models import Token
 from rest_hooks.models import model_saved
 
 from familyconnect_registration import utils
+from familyconnect_registration.routers import get_mother_shard_queue
 from registrations.models import (Source, Registration, SubscriptionRequest,
                                   registration_post_save, fire_created_metric,
-                                  fire_language_metric, fire_source_metric)
+                                  fire_language_metric, fire_source_metric,
+                                  update_registration_rollup,
+                                  update_mother_profile, MotherProfile)
 from .models import Change, change_post_save
-from .tasks import implement_action
+from .tasks import (
+    dispatch_changes, implement_action, implement_actions,
+    implement_mother_changes, retry_changes)
 
 
 def override_get_today():
@@ -62,6 +80,10 @@ class AuthenticatedAPITestCase(APITestCase):
         assert has_listeners(), (
             "Registration model has no post_save listeners. Make sure"
             " helpers cleaned up properly in earlier tests.")
+        post_save.disconnect(receiver=update_registration_rollup,
+                             sender=Registration)
+        post_save.disconnect(receiver=update_mother_profile,
+                             sender=Registration)
         post_save.disconnect(receiver=registration_post_save,
                              sender=Registration)
         post_save.disconnect(receiver=model_saved,
@@ -81,6 +103,10 @@ class AuthenticatedAPITestCase(APITestCase):
         assert not has_listeners(), (
             "Registration model still has post_save listeners. Make sure"
             " helpers removed them properly in earlier tests.")
+        post_save.connect(receiver=update_registration_rollup,
+                          sender=Registration)
+        post_save.connect(receiver=update_mother_profile,
+                          sender=Registration)
         post_save.connect(registration_post_save, sender=Registration)
         post_save.connect(receiver=fire_created_metric, sender=Registration)
         post_save.connect(receiver=fire_language_metric, sender=Registration)
@@ -166,6 +192,35 @@ class AuthenticatedAPITestCase(APITestCase):
         }
         return Registration.objects.create(**registration_data)
 
+    def mock_get_subscriptions(self, mother_id, subscription_ids):
+        query_string = '?active=True&id=%s' % mother_id
+        responses.add(
+            responses.GET,
+            'http://localhost:8005/api/v1/subscriptions/%s' % query_string,
+            json={
+                "count": len(subscription_ids),
+                "next": None,
+                "previous": None,
+                "results": [{
+                    "id": subscription_id,
+                    "identity": mother_id,
+                    "active": True,
+                    "lang": "eng_UG"
+                } for subscription_id in subscription_ids],
+            },
+            status=200, content_type='application/json',
+            match_querystring=True
+        )
+
+    def mock_patch_subscription(self, subscription_id, status=200):
+        responses.add(
+            responses.PATCH,
+            'http://localhost:8005/api/v1/subscriptions/%s/' % (
+                subscription_id,),
+            json={"id": subscription_id}, status=status,
+            content_type='application/json',
+        )
+
     def setUp(self):
         super(AuthenticatedAPITestCase, self).setUp()
         self._replace_post_save_hooks_change()
@@ -613,6 +668,64 @@ class TestChangeUnsubscribe(AuthenticatedAPITestCase):
         self.assertEqual(result.get(), "Unsubscribe completed")
         assert len(responses.calls) == 2
 
+    @responses.activate
+    def test_mother_unsubscribe_multiple(self):
+        """
+        All of the mother's subscriptions should be deactivated.
+        """
+        self.make_registration_mother()
+        change = Change.objects.create(
+            mother_id="mother01-63e2-4acc-9b94-26663b9bc267",
+            action="unsubscribe", data={"reason": "miscarriage"},
+            source=self.make_source_adminuser())
+        subscription_ids = ["subscription%s-4bf1-8779-c47b428e89d0" % i
+                            for i in range(5)]
+        self.mock_get_subscriptions(change.mother_id, subscription_ids)
+        for subscription_id in subscription_ids:
+            responses.add(
+                responses.PATCH,
+                'http://localhost:8005/api/v1/subscriptions/%s/' % (
+                    subscription_id,),
+                json={"active": False},
+                status=200, content_type='application/json',
+            )
+
+        result = implement_action.apply_async(args=[change.id])
+
+        self.assertEqual(result.get(), "Unsubscribe completed")
+        self.assertEqual(len(responses.calls), 6)
+        self.assertEqual(
+            [json.loads(call.request.body) for call in responses.calls[1:]],
+            [{"active": False}] * 5)
+
+    @responses.activate
+    def test_mother_unsubscribe_deactivation_error(self):
+        """
+        If one of the deactivations fails, the rest should still be made,
+        and the error should be raised.
+        """
+        self.make_registration_mother()
+        change = Change.objects.create(
+            mother_id="mother01-63e2-4acc-9b94-26663b9bc267",
+            action="unsubscribe", data={"reason": "miscarriage"},
+            source=self.make_source_adminuser())
+        subscription_ids = ["subscription%s-4bf1-8779-c47b428e89d0" % i
+                            for i in range(3)]
+        self.mock_get_subscriptions(change.mother_id, subscription_ids)
+        for i, subscription_id in enumerate(subscription_ids):
+            responses.add(
+                responses.PATCH,
+                'http://localhost:8005/api/v1/subscriptions/%s/' % (
+                    subscription_id,),
+                json={"active": False},
+                status=500 if i == 1 else 200,
+                content_type='application/json',
+            )
+
+        with self.assertRaises(HTTPError):
+            implement_action.apply_async(args=[change.id])
+        self.assertEqual(len(responses.calls), 4)
+
 
 class TestChangeLoss(AuthenticatedAPITestCase):
 
@@ -716,3 +829,511 @@ class TestChangeLoss(AuthenticatedAPITestCase):
         self.assertEqual(d.next_sequence_number, 1)
         self.assertEqual(d.lang, "eng_UG")
         self.assertEqual(d.schedule, 5)
+
+
+class TestBulkChanges(AuthenticatedAPITestCase):
+
+    @responses.activate
+    def test_bulk_create_changes(self):
+        """
+        The valid changes should be created and implemented, and the outcome
+        for each change returned.
+        """
+        self.make_source_adminuser()
+        mother_ids = ["mother0%s-63e2-4acc-9b94-26663b9bc267" % i
+                      for i in range(3)]
+        for i, mother_id in enumerate(mother_ids):
+            self.mock_get_subscriptions(mother_id, ["subscription%s" % i])
+            self.mock_patch_subscription("subscription%s" % i)
+        post_data = [
+            {"mother_id": mother_ids[0], "action": "unsubscribe"},
+            {"mother_id": mother_ids[1], "action": "not_an_action"},
+            {"mother_id": mother_ids[1], "action": "change_language",
+             "data": {"new_language": "cgg_UG"}},
+            {"mother_id": mother_ids[2], "action": "unsubscribe"},
+        ]
+
+        response = self.adminclient.post('/api/v1/change/bulk/',
+                                         json.dumps(post_data),
+                                         content_type='application/json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["created"], 3)
+        self.assertEqual(response.data["errors"], 1)
+        results = response.data["results"]
+        self.assertEqual(
+            [(r["row"], r["status"]) for r in results],
+            [(0, "created"), (1, "error"), (2, "created"), (3, "created")])
+        self.assertIn("action", results[1]["errors"])
+        change = Change.objects.get(id=results[2]["id"])
+        self.assertEqual(change.source.name, 'test_source_adminuser')
+        self.assertEqual(change.data, {"new_language": "cgg_UG"})
+        self.assertEqual(Change.objects.count(), 3)
+        # One subscription lookup and one patch for each change
+        self.assertEqual(len(responses.calls), 6)
+
+    def test_dispatch_changes_sharded(self):
+        """
+        If there are mother shard queues, each chunk of changes should only
+        have changes for mothers on the same shard, and be queued on that
+        shard's queue.
+        """
+        source = self.make_source_adminuser()
+        changes = [Change.objects.create(
+            mother_id="mother%02d" % i, action="unsubscribe", data={},
+            source=source) for i in range(20)]
+
+        with self.settings(MOTHER_SHARD_QUEUES=2), patch(
+                'changes.tasks.implement_actions.apply_async') as mock_apply:
+            tasks = dispatch_changes(changes, chunk_size=100)
+            queues = dict(
+                (str(c.id), get_mother_shard_queue(c.mother_id))
+                for c in changes)
+
+        self.assertEqual(tasks, 2)
+        self.assertEqual(mock_apply.call_count, 2)
+        dispatched = []
+        for args, kwargs in mock_apply.call_args_list:
+            change_ids = kwargs['kwargs']['change_ids']
+            self.assertEqual(
+                set(queues[i] for i in change_ids), set([kwargs['queue']]))
+            dispatched.extend(change_ids)
+        self.assertEqual(sorted(dispatched), sorted(queues))
+
+    def test_bulk_create_changes_not_list(self):
+        """
+        A request that isn't a list of changes should be rejected.
+        """
+        self.make_source_adminuser()
+        response = self.adminclient.post(
+            '/api/v1/change/bulk/',
+            json.dumps({"mother_id": "mother01", "action": "unsubscribe"}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Change.objects.count(), 0)
+
+    @responses.activate
+    def test_implement_actions(self):
+        """
+        The changes should be implemented together, with the outcome of each
+        change returned.
+        """
+        source = self.make_source_adminuser()
+        changes = [Change.objects.create(
+            mother_id="mother0%s-63e2-4acc-9b94-26663b9bc267" % i,
+            action="change_language", data={"new_language": "cgg_UG"},
+            source=source) for i in range(3)]
+        changes.append(Change.objects.create(
+            mother_id="mother03-63e2-4acc-9b94-26663b9bc267",
+            action="change_language", data={}, source=source))
+        self.mock_get_subscriptions(changes[0].mother_id, ["sub0", "sub1"])
+        self.mock_get_subscriptions(changes[1].mother_id, ["sub2"])
+        self.mock_get_subscriptions(changes[2].mother_id, ["sub3"])
+        self.mock_patch_subscription("sub0")
+        self.mock_patch_subscription("sub1")
+        self.mock_patch_subscription("sub2", status=500)
+        self.mock_patch_subscription("sub3")
+
+        result = implement_actions.apply_async(kwargs={
+            "action": "change_language",
+            "change_ids": [str(c.id) for c in changes],
+        }).get()
+
+        self.assertEqual(result[str(changes[0].id)],
+                         "Change language completed")
+        self.assertTrue(result[str(changes[1].id)].startswith(
+            "Failed: HTTPError"))
+        self.assertEqual(result[str(changes[2].id)],
+                         "Change language completed")
+        self.assertTrue(result[str(changes[3].id)].startswith(
+            "Failed: KeyError"))
+        patches = [c.request for c in responses.calls
+                   if c.request.method == 'PATCH']
+        self.assertEqual(len(patches), 4)
+        self.assertEqual(
+            [json.loads(p.body) for p in patches],
+            [{"lang": "cgg_UG"}] * 4)
+
+        # The failed changes should be released so that they can be retried
+        for change, implemented in zip(changes, [True, False, True, False]):
+            change.refresh_from_db()
+            self.assertEqual(change.implemented, implemented)
+            self.assertIsNone(change.claimed_at)
+
+    @responses.activate
+    def test_bulk_change_command(self):
+        """
+        The command should create the changes in the CSV file, and write the
+        outcome of each row.
+        """
+        source = self.make_source_adminuser()
+        mother_id = "mother01-63e2-4acc-9b94-26663b9bc267"
+        self.mock_get_subscriptions(mother_id, ["sub0"])
+        self.mock_patch_subscription("sub0")
+        csv_file = tempfile.NamedTemporaryFile(
+            mode='w', suffix='.csv', delete=False)
+        self.addCleanup(os.remove, csv_file.name)
+        csv_file.write(
+            "mother_id,action,new_language\n"
+            "%s,change_language,cgg_UG\n"
+            ",change_language,cgg_UG\n" % mother_id)
+        csv_file.close()
+
+        stdout, stderr = StringIO(), StringIO()
+        call_command(
+            'bulk_change', csv_file.name, '--source', str(source.id),
+            '--batch-size', '1', stdout=stdout, stderr=stderr)
+
+        change = Change.objects.get()
+        self.assertEqual(change.data, {"new_language": "cgg_UG"})
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(lines[0], "row,status,id,errors")
+        self.assertEqual(lines[1], "1,created,%s," % change.id)
+        self.assertTrue(lines[2].startswith("2,error,,"))
+        self.assertEqual(
+            stderr.getvalue().strip(), "Created 1 changes, 1 rows had errors")
+        self.assertEqual(len(responses.calls), 2)
+
+    def test_bulk_change_command_missing_source(self):
+        """
+        If the source doesn't exist, an error should be raised.
+        """
+        with self.assertRaises(CommandError):
+            call_command('bulk_change', 'changes.csv', '--source', '999')
+
+
+class TestCoalescedChanges(AuthenticatedAPITestCase):
+    mother_id = "mother01-63e2-4acc-9b94-26663b9bc267"
+
+    def make_change(self, action, **data):
+        return Change.objects.create(
+            mother_id=self.mother_id, action=action, data=data,
+            source=Source.objects.get(name='test_source_adminuser'))
+
+    def get_patches(self):
+        return dict(
+            (c.request.url.split('/')[-2], json.loads(c.request.body))
+            for c in responses.calls if c.request.method == 'PATCH')
+
+    def test_plan_language_then_unsubscribe(self):
+        """
+        Subscriptions that get deactivated shouldn't also have their language
+        changed.
+        """
+        self.make_source_adminuser()
+        changes = [
+            self.make_change('change_language', new_language='cgg_UG'),
+            self.make_change('unsubscribe'),
+        ]
+        subscriptions = [{"id": "sub1"}, {"id": "sub2"}]
+
+        patches, new_subscription = implement_mother_changes.get_plan(
+            changes, subscriptions)
+
+        self.assertEqual(sorted((s["id"], d) for s, d in patches), [
+            ("sub1", {"active": False}), ("sub2", {"active": False})])
+        self.assertEqual(new_subscription, None)
+
+    def test_plan_baby_then_language(self):
+        """
+        A language change after a change to baby messages should change the
+        language of the new subscription request.
+        """
+        self.make_source_adminuser()
+        changes = [
+            self.make_change('change_language', new_language='xog_UG'),
+            self.make_change('change_baby'),
+            self.make_change('change_language', new_language='cgg_UG'),
+        ]
+        patches, new_subscription = implement_mother_changes.get_plan(
+            changes, [{"id": "sub1"}])
+
+        self.assertEqual(
+            [(s["id"], d) for s, d in patches], [("sub1", {"active": False})])
+        self.assertEqual(
+            new_subscription, {"stage": "postbirth", "lang": "cgg_UG"})
+
+    def test_plan_unsubscribe_after_baby(self):
+        """
+        An unsubscribe after a change to baby messages should cancel the new
+        subscription request.
+        """
+        self.make_source_adminuser()
+        changes = [
+            self.make_change('change_baby'),
+            self.make_change('unsubscribe'),
+        ]
+        patches, new_subscription = implement_mother_changes.get_plan(
+            changes, [])
+        self.assertEqual(patches, [])
+        self.assertEqual(new_subscription, None)
+
+    @responses.activate
+    def test_implement_mother_changes(self):
+        """
+        The pending changes should be implemented with a single subscription
+        lookup and one patch per subscription, and only once.
+        """
+        self.make_source_adminuser()
+        changes = [
+            self.make_change('change_language', new_language='cgg_UG'),
+            self.make_change('change_language', new_language='xog_UG'),
+        ]
+        self.mock_get_subscriptions(self.mother_id, ["sub1", "sub2"])
+        self.mock_patch_subscription("sub1")
+        self.mock_patch_subscription("sub2")
+
+        result = implement_mother_changes.apply_async(
+            kwargs={"mother_id": self.mother_id})
+
+        self.assertEqual(result.get(), "Implemented 2 changes")
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual(self.get_patches(), {
+            "sub1": {"lang": "xog_UG"}, "sub2": {"lang": "xog_UG"}})
+        for change in changes:
+            change.refresh_from_db()
+            self.assertTrue(change.implemented)
+
+        result = implement_mother_changes.apply_async(
+            kwargs={"mother_id": self.mother_id})
+        self.assertEqual(result.get(), "No pending changes")
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    def test_implement_mother_changes_failed(self):
+        """
+        If implementing the changes fails, they should be released so that
+        they can be retried.
+        """
+        self.make_source_adminuser()
+        change = self.make_change('change_language', new_language='cgg_UG')
+        self.mock_get_subscriptions(self.mother_id, ["sub1"])
+        self.mock_patch_subscription("sub1", status=500)
+
+        with self.assertRaises(HTTPError):
+            implement_mother_changes.apply_async(
+                kwargs={"mother_id": self.mother_id})
+
+        change.refresh_from_db()
+        self.assertFalse(change.implemented)
+        self.assertIsNone(change.claimed_at)
+
+        responses.reset()
+        self.mock_get_subscriptions(self.mother_id, ["sub1"])
+        self.mock_patch_subscription("sub1")
+        result = implement_mother_changes.apply_async(
+            kwargs={"mother_id": self.mother_id})
+        self.assertEqual(result.get(), "Implemented 1 changes")
+
+    @responses.activate
+    def test_implement_mother_changes_new_subscription(self):
+        """
+        A change to loss messages followed by a language change should create
+        a subscription request in the new language, without looking up the
+        mother's identity.
+        """
+        self.make_registration_mother()
+        self.make_change('change_loss')
+        self.make_change('change_language', new_language='cgg_UG')
+        self.mock_get_subscriptions(self.mother_id, ["sub1"])
+        self.mock_patch_subscription("sub1")
+        responses.add(
+            responses.GET,
+            'http://localhost:8005/api/v1/messageset/'
+            '?short_name=loss.mother.hw_full',
+            json={"count": 1, "next": None, "previous": None, "results": [{
+                "id": 4, "short_name": "loss.mother.hw_full",
+                "default_schedule": 4}]},
+            status=200, content_type='application/json',
+            match_querystring=True)
+        responses.add(
+            responses.GET, 'http://localhost:8005/api/v1/schedule/4/',
+            json={"id": 4, "day_of_week": "1"},
+            status=200, content_type='application/json')
+
+        result = implement_mother_changes.apply_async(
+            kwargs={"mother_id": self.mother_id})
+
+        self.assertEqual(result.get(), "Implemented 2 changes")
+        self.assertEqual(self.get_patches(), {"sub1": {"active": False}})
+        d = SubscriptionRequest.objects.get()
+        self.assertEqual(d.identity, self.mother_id)
+        self.assertEqual(d.messageset, 4)
+        self.assertEqual(d.schedule, 4)
+        self.assertEqual(d.lang, "cgg_UG")
+        self.assertEqual(len(responses.calls), 4)
+
+    def test_post_save_coalesced(self):
+        """
+        If changes are coalesced, creating a change should queue the task
+        for the mother's changes once the coalescing window has passed.
+        """
+        self.make_source_adminuser()
+        post_save.connect(change_post_save, sender=Change)
+        try:
+            with self.settings(CHANGE_COALESCE_SECONDS=10), patch(
+                    'changes.tasks.implement_mother_changes.apply_async'
+                    ) as mock_apply:
+                self.make_change('unsubscribe')
+        finally:
+            post_save.disconnect(change_post_save, sender=Change)
+        mock_apply.assert_called_once_with(
+            kwargs={"mother_id": self.mother_id}, countdown=10)
+
+    def test_implement_action_claimed(self):
+        """
+        A change that has already been implemented shouldn't be implemented
+        again.
+        """
+        self.make_source_adminuser()
+        change = self.make_change('unsubscribe')
+        Change.objects.filter(id=change.id).update(implemented=True)
+
+        result = implement_action.apply_async(args=[change.id])
+
+        self.assertEqual(result.get(), "Change already implemented")
+
+    def test_implement_action_claim_expired(self):
+        """
+        A change that is claimed by another task shouldn't be implemented,
+        unless the claim has expired.
+        """
+        self.make_source_adminuser()
+        change = self.make_change('unsubscribe')
+        Change.objects.filter(id=change.id).update(claimed_at=timezone.now())
+
+        result = implement_action.apply_async(args=[change.id])
+        self.assertEqual(result.get(), "Change already implemented")
+
+        Change.objects.filter(id=change.id).update(
+            claimed_at=timezone.now() - datetime.timedelta(
+                seconds=settings.CHANGE_CLAIM_SECONDS + 1))
+        with patch('changes.tasks.ImplementAction.unsubscribe') as unsubscribe:
+            unsubscribe.return_value = "Unsubscribe completed"
+            result = implement_action.apply_async(args=[change.id])
+
+        self.assertEqual(result.get(), "Unsubscribe completed")
+        change.refresh_from_db()
+        self.assertTrue(change.implemented)
+        self.assertIsNone(change.claimed_at)
+
+    def test_retry_changes(self):
+        """
+        The retry task should queue the changes that have been pending for
+        too long and aren't claimed, or whose claim has expired.
+        """
+        self.make_source_adminuser()
+        old = timezone.now() - datetime.timedelta(
+            seconds=settings.CHANGE_RETRY_SECONDS + 1)
+        failed, claimed, expired, new, done = [
+            self.make_change('unsubscribe') for _ in range(5)]
+        Change.objects.exclude(id=new.id).update(created_at=old)
+        Change.objects.filter(id=claimed.id).update(
+            claimed_at=timezone.now())
+        Change.objects.filter(id=expired.id).update(
+            claimed_at=timezone.now() - datetime.timedelta(
+                seconds=settings.CHANGE_CLAIM_SECONDS + 1))
+        Change.objects.filter(id=done.id).update(implemented=True)
+
+        with patch('changes.tasks.implement_action.apply_async') as mock_apply:
+            result = retry_changes.apply_async()
+
+        self.assertEqual(result.get(), "Retrying 2 changes")
+        self.assertEqual(
+            sorted(c[1]['kwargs']['change_id']
+                   for c in mock_apply.call_args_list),
+            sorted([str(failed.id), str(expired.id)]))
+        mock_apply.assert_any_call(kwargs={
+            "change_id": str(failed.id), "mother_id": self.mother_id})
+
+    def test_retry_changes_coalesced(self):
+        """
+        If changes are coalesced, the retry task should queue the task for
+        the changes of each mother with pending changes.
+        """
+        self.make_source_adminuser()
+        self.make_change('unsubscribe')
+        self.make_change('change_language', new_language='cgg_UG')
+        Change.objects.update(created_at=timezone.now() - datetime.timedelta(
+            seconds=settings.CHANGE_RETRY_SECONDS + 1))
+
+        with self.settings(CHANGE_COALESCE_SECONDS=10), patch(
+                'changes.tasks.implement_mother_changes.apply_async'
+                ) as mock_apply:
+            result = retry_changes.apply_async()
+
+        self.assertEqual(result.get(), "Retrying the changes of 1 mothers")
+        mock_apply.assert_called_once_with(
+            kwargs={"mother_id": self.mother_id})
+
+    def test_implement_action_failed(self):
+        """
+        If implementing a change fails, it should be released so that it can
+        be retried.
+        """
+        self.make_source_adminuser()
+        change = self.make_change('unsubscribe')
+
+        with patch('changes.tasks.ImplementAction.unsubscribe') as unsubscribe:
+            unsubscribe.side_effect = HTTPError()
+            with self.assertRaises(HTTPError):
+                implement_action.apply_async(args=[change.id])
+
+        change.refresh_from_db()
+        self.assertFalse(change.implemented)
+        self.assertIsNone(change.claimed_at)
+
+
+class TestMotherProfileChanges(AuthenticatedAPITestCase):
+    mother_id = "mother01-63e2-4acc-9b94-26663b9bc267"
+
+    @responses.activate
+    def test_unsubscribe_updates_profile(self):
+        """
+        Implementing a change should update the mother's profile.
+        """
+        registration = self.make_registration_mother()
+        MotherProfile.objects.update_registration(registration)
+        MotherProfile.objects.registration_subscribed(registration)
+        change = Change.objects.create(
+            mother_id=self.mother_id, action="unsubscribe", data={},
+            source=registration.source)
+        self.mock_get_subscriptions(self.mother_id, [])
+
+        implement_action.apply_async(args=[change.id])
+
+        profile = MotherProfile.objects.get(mother_id=self.mother_id)
+        self.assertEqual(profile.subscribed, False)
+        self.assertEqual(profile.subscription_stage, 'prebirth')
+
+    def test_rebuild_mother_profiles(self):
+        """
+        The profiles should be rebuilt from the latest registrations and the
+        changes implemented after them.
+        """
+        self.make_registration_mother()
+        registration = self.make_registration_hoh()
+        registration.validated = True
+        registration.save()
+        MotherProfile.objects.create(
+            mother_id="other", registration=registration, stage="loss",
+            authority="patient")
+        for action, data, implemented in (
+                ("change_loss", {}, True),
+                ("change_language", {"new_language": "cgg_UG"}, True),
+                ("unsubscribe", {}, False)):
+            Change.objects.create(
+                mother_id=self.mother_id, action=action, data=data,
+                source=registration.source, implemented=implemented)
+
+        stdout = StringIO()
+        call_command('rebuild_mother_profiles', stdout=stdout)
+
+        self.assertEqual(
+            stdout.getvalue().strip(), "Rebuilt 1 mother profiles")
+        profile = MotherProfile.objects.get()
+        self.assertEqual(profile.registration, registration)
+        self.assertEqual(profile.msg_receiver, "head_of_household")
+        self.assertEqual(profile.language, "cgg_UG")
+        self.assertEqual(profile.subscribed, True)
+        self.assertEqual(profile.subscription_stage, "loss")
@@ -8,5 +8,6 @@ router.register(r'changes', views.ChangeGetViewSet)
 # Wire up our API using automatic URL routing.
 # Additionally, we include login URLs for the browseable API.
 urlpatterns = [
+    url(r'^api/v1/change/bulk/$', views.ChangeBulkPost.as_view()),
     url(r'^api/v1/change/', views.ChangePost.as_view()),
 ]
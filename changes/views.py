@@ -1,7 +1,9 @@
 import django_filters
 from .models import Source, Change
-from rest_framework import viewsets, mixins, generics, filters
+from rest_framework import viewsets, mixins, generics, filters, status
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from .bulk import create_changes
 from .serializers import ChangeSerializer
 
 
@@ -25,6 +27,31 @@ class ChangePost(mixins.CreateModelMixin, generics.GenericAPIView):
     #     serializer.save(updated_by=self.request.user)
 
 
+class ChangeBulkPost(generics.GenericAPIView):
+    """
+    Creates a list of changes in one request, and returns the outcome for
+    each of the changes. The changes are implemented in batches.
+    """
+    permission_classes = (IsAuthenticated,)
+    queryset = Change.objects.all()
+
+    def post(self, request, *args, **kwargs):
+        if not isinstance(request.data, list):
+            return Response(
+                {"detail": "Expected a list of changes"},
+                status=status.HTTP_400_BAD_REQUEST)
+        # load the users sources - posting users should only have one source
+        source = Source.objects.get(user=self.request.user)
+        results = create_changes(request.data, source)
+        created = len([r for r in results if r["status"] == "created"])
+        return Response({
+            "created": created,
+            "errors": len(results) - created,
+            "results": results,
+        }, status=status.HTTP_201_CREATED if created else
+            status.HTTP_400_BAD_REQUEST)
+
+
 class ChangeFilter(filters.FilterSet):
     """Filter for changes created, using ISO 8601 formatted dates"""
     created_before = django_filters.IsoDateTimeFilter(name="created_at",
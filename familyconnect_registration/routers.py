@@ -0,0 +1,32 @@
+import zlib
+
+from django.conf import settings
+
+
+def get_mother_shard_queue(mother_id):
+    """
+    Returns the name of the shard queue for the mother, or None if there are
+    no shard queues configured.
+    """
+    if not settings.MOTHER_SHARD_QUEUES:
+        return None
+    shard = (zlib.crc32(mother_id.encode('utf-8')) & 0xffffffff) % \
+        settings.MOTHER_SHARD_QUEUES
+    return '%s_%d' % (settings.MOTHER_SHARD_QUEUE_PREFIX, shard)
+
+
+class MotherShardRouter(object):
+    """
+    Routes tasks that are queued with a mother_id keyword argument onto one
+    of the mother shard queues, by hashing the mother id. If each shard queue
+    is consumed by a single worker process, the tasks for a mother are run
+    one at a time in the order that they were queued.
+    """
+    def route_for_task(self, task, args=None, kwargs=None):
+        mother_id = (kwargs or {}).get('mother_id')
+        if not mother_id:
+            return None
+        queue = get_mother_shard_queue(mother_id)
+        if queue is None:
+            return None
+        return {'queue': queue}
@@ -182,29 +182,68 @@ CELERY_IMPORTS = (
     'registrations.tasks',
     'changes.tasks',
     'locations.tasks',
+    'uniqueids.tasks',
 )
 
 CELERY_CREATE_MISSING_QUEUES = True
-CELERY_ROUTES = {
-    'celery.backend_cleanup': {
-        'queue': 'mediumpriority',
-    },
-    'registrations.tasks.validate_registration': {
-        'queue': 'priority',
-    },
-    'changes.tasks.implement_action': {
-        'queue': 'priority',
-    },
-    'registrations.tasks.DeliverHook': {
-        'queue': 'priority',
-    },
-    'locations.tasks.sync_locations': {
-        'queue': 'mediumpriority',
-    },
-    'registrations.tasks.send_location_reminders': {
-        'queue': 'mediumpriority',
+
+# Tasks for a mother are routed onto one of this many shard queues, so that
+# they are run in order when each queue has a single worker process. Disabled
+# if 0.
+MOTHER_SHARD_QUEUES = int(os.environ.get('MOTHER_SHARD_QUEUES', '0'))
+MOTHER_SHARD_QUEUE_PREFIX = os.environ.get(
+    'MOTHER_SHARD_QUEUE_PREFIX', 'mother_shard')
+
+CELERY_ROUTES = (
+    'familyconnect_registration.routers.MotherShardRouter',
+    {
+        'celery.backend_cleanup': {
+            'queue': 'mediumpriority',
+        },
+        'registrations.tasks.validate_registration': {
+            'queue': 'priority',
+        },
+        'changes.tasks.implement_action': {
+            'queue': 'priority',
+        },
+        'familyconnect_registration.changes.tasks.implement_actions': {
+            'queue': 'mediumpriority',
+        },
+        'familyconnect_registration.changes.tasks.implement_mother_changes': {
+            'queue': 'priority',
+        },
+        'familyconnect_registration.changes.tasks.retry_changes': {
+            'queue': 'mediumpriority',
+        },
+        'registrations.tasks.DeliverHook': {
+            'queue': 'priority',
+        },
+        'locations.tasks.sync_locations': {
+            'queue': 'mediumpriority',
+        },
+        'registrations.tasks.send_location_reminders': {
+            'queue': 'mediumpriority',
+        },
+        'registrations.tasks.send_location_reminder_chunk': {
+            'queue': 'mediumpriority',
+        },
+        'registrations.tasks.scheduled_metrics': {
+            'queue': 'mediumpriority',
+        },
+        'registrations.tasks.update_registration_snapshot': {
+            'queue': 'mediumpriority',
+        },
+        'uniqueids.tasks.refill_unique_id_pool': {
+            'queue': 'mediumpriority',
+        },
+        'uniqueids.tasks.backfill_unique_ids': {
+            'queue': 'mediumpriority',
+        },
+        'uniqueids.tasks.write_back_unique_ids': {
+            'queue': 'mediumpriority',
+        },
     },
-}
+)
 
 CELERYBEAT_SCHEDULE = {
     'sync-locations-every-day': {
@@ -215,6 +254,26 @@ CELERYBEAT_SCHEDULE = {
         'task': 'registrations.tasks.send_location_reminders',
         'schedule': crontab(minute=0, hour=12, day_of_week='sunday'),
     },
+    'fire-scheduled-metrics-every-hour': {
+        'task': 'registrations.tasks.scheduled_metrics',
+        'schedule': crontab(minute=0),
+    },
+    'update-registration-snapshot-every-hour': {
+        'task': 'registrations.tasks.update_registration_snapshot',
+        'schedule': crontab(minute=30),
+    },
+    'write-back-unique-ids-every-minute': {
+        'task': 'uniqueids.tasks.write_back_unique_ids',
+        'schedule': crontab(),
+    },
+    'refill-unique-id-pool-every-ten-minutes': {
+        'task': 'uniqueids.tasks.refill_unique_id_pool',
+        'schedule': crontab(minute='*/10'),
+    },
+    'retry-changes-every-ten-minutes': {
+        'task': 'familyconnect_registration.changes.tasks.retry_changes',
+        'schedule': crontab(minute='*/10'),
+    },
 }
 
 LANGUAGES = ["eng_UG", "cgg_UG", "xog_UG", "lug_UG"]
@@ -242,14 +301,89 @@ METRICS_REALTIME.extend(
 METRICS_AUTH_TOKEN = os.environ.get("METRICS_AUTH_TOKEN", "REPLACEME")
 METRICS_URL = os.environ.get("METRICS_URL", None)
 
+# Directory of the columnar registration snapshot. Disabled if not set.
+REGISTRATION_SNAPSHOT_PATH = os.environ.get(
+    'REGISTRATION_SNAPSHOT_PATH', None)
+
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_ACCEPT_CONTENT = ['json']
 
 djcelery.setup_loader()
 
+# The amount of unused unique IDs to keep in the pool for each of the ID
+# lengths, so that records can be created without generating an ID
+UNIQUE_ID_POOL_SIZE = int(os.environ.get('UNIQUE_ID_POOL_SIZE', '10000'))
+UNIQUE_ID_POOL_LENGTHS = [
+    int(length) for length in
+    os.environ.get('UNIQUE_ID_POOL_LENGTHS', '10').split(',')]
+
+# The maximum amount of identities per second that the unique ID backfill
+# updates, and the amount of pages of identities that each backfill task
+# processes before queueing the next task
+UNIQUE_ID_BACKFILL_RATE = float(
+    os.environ.get('UNIQUE_ID_BACKFILL_RATE', '10'))
+UNIQUE_ID_BACKFILL_PAGES = int(
+    os.environ.get('UNIQUE_ID_BACKFILL_PAGES', '10'))
+
+# If set, the unique IDs of new records are written back to their identities
+# in batches of this size by a periodic task, instead of a task per record
+UNIQUE_ID_WRITE_BACK_BATCH_SIZE = int(
+    os.environ.get('UNIQUE_ID_WRITE_BACK_BATCH_SIZE', '0'))
+
+# How long a write back task's claim on the records it is writing back lasts,
+# after which the records can be claimed again if the task died
+UNIQUE_ID_WRITE_BACK_CLAIM_SECONDS = int(
+    os.environ.get('UNIQUE_ID_WRITE_BACK_CLAIM_SECONDS', '600'))
+
+# How long the identity details from the webhook are used to write back the
+# unique ID, after which the details are fetched again, so that changes to
+# the identity in the meantime aren't overwritten
+UNIQUE_ID_WRITE_BACK_DETAILS_SECONDS = int(
+    os.environ.get('UNIQUE_ID_WRITE_BACK_DETAILS_SECONDS', '120'))
+
+# How often each process checks whether the parish list has changed, and
+# rebuilds its in-memory parish search index if it has
+PARISH_INDEX_CHECK_SECONDS = int(
+    os.environ.get('PARISH_INDEX_CHECK_SECONDS', '30'))
+
+# How long the results of unique ID lookups are cached for
+UNIQUE_ID_LOOKUP_CACHE_SECONDS = int(
+    os.environ.get('UNIQUE_ID_LOOKUP_CACHE_SECONDS', '60'))
+
+# How unique IDs are generated for new records. 'pool' claims IDs from the
+# unique ID pool, and 'permutation' maps a database sequence through a keyed
+# permutation. The permutation key is required for the permutation generator,
+# and must never change, otherwise new IDs can collide with issued ones.
+UNIQUE_ID_GENERATOR = os.environ.get('UNIQUE_ID_GENERATOR', 'pool')
+UNIQUE_ID_PERMUTATION_KEY = os.environ.get('UNIQUE_ID_PERMUTATION_KEY')
+
 PREBIRTH_MIN_WEEKS = int(os.environ.get('PREBIRTH_MIN_WEEKS', '4'))
 
+# The maximum amount of concurrent requests to the other services per task
+CONCURRENT_REQUESTS = int(os.environ.get('CONCURRENT_REQUESTS', '10'))
+
+# The amount of changes implemented by each task for bulk changes
+BULK_CHANGE_CHUNK_SIZE = int(os.environ.get('BULK_CHANGE_CHUNK_SIZE', '100'))
+
+# The amount of location reminders sent by each task
+LOCATION_REMINDER_CHUNK_SIZE = int(
+    os.environ.get('LOCATION_REMINDER_CHUNK_SIZE', '100'))
+
+# If set, changes for a mother that are submitted within this many seconds of
+# each other are merged and implemented together, in submission order.
+CHANGE_COALESCE_SECONDS = int(os.environ.get('CHANGE_COALESCE_SECONDS', '0'))
+
+# How long a task's claim on the changes it is implementing lasts. Changes
+# that are still claimed aren't implemented by other tasks, and changes whose
+# claim has expired, because the task died, can be implemented again.
+CHANGE_CLAIM_SECONDS = int(os.environ.get('CHANGE_CLAIM_SECONDS', '600'))
+
+# Changes that still haven't been implemented this long after they were
+# submitted, because they failed or their task died, are queued again by
+# the periodic retry task
+CHANGE_RETRY_SECONDS = int(os.environ.get('CHANGE_RETRY_SECONDS', '600'))
+
 STAGE_BASED_MESSAGING_URL = os.environ.get('STAGE_BASED_MESSAGING_URL',
                                            'http://localhost:8005/api/v1')
 STAGE_BASED_MESSAGING_TOKEN = os.environ.get('STAGE_BASED_MESSAGING_TOKEN',
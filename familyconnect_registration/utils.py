@@ -2,8 +2,12 @@ import datetime
 import requests
 import json
 import re
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
+from six.moves import queue
 
 
 def get_today():
@@ -22,15 +26,29 @@ def calc_pregnancy_week_lmp(today, lmp):
     return preg_weeks
 
 
-def get_identity(identity):
+def get_session(pool_size=None):
+    """ Returns a requests session, for reusing connections across many
+    requests. Its connection pool is big enough for CONCURRENT_REQUESTS
+    concurrent requests to each host.
+    """
+    if pool_size is None:
+        pool_size = settings.CONCURRENT_REQUESTS
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_identity(identity, session=None):
     url = "%s/%s/%s/" % (settings.IDENTITY_STORE_URL, "identities", identity)
     headers = {'Authorization': 'Token %s' % settings.IDENTITY_STORE_TOKEN,
                'Content-Type': 'application/json'}
-    r = requests.get(url, headers=headers)
+    r = (session or requests).get(url, headers=headers)
     return r.json()
 
 
-def get_identity_address(identity):
+def get_identity_address(identity, session=None):
     url = "%s/%s/%s/addresses/msisdn" % (settings.IDENTITY_STORE_URL,
                                          "identities", identity)
     params = {"default": True}
@@ -38,7 +56,7 @@ def get_identity_address(identity):
         'Authorization': 'Token %s' % settings.IDENTITY_STORE_TOKEN,
         'Content-Type': 'application/json'
     }
-    r = requests.get(url, params=params, headers=headers).json()
+    r = (session or requests).get(url, params=params, headers=headers).json()
     if len(r["results"]) > 0:
         return r["results"][0]["address"]
     else:
@@ -56,17 +74,81 @@ def get_vhts_for_parish(parish):
         'Authorization': 'Token %s' % settings.IDENTITY_STORE_TOKEN,
         'Content-Type': 'application/json'
     }
-    r = requests.get(url, params=params, headers=headers).json()
-    while True:
-        for r in r.get('results', []):
-            yield r
-        if r.get('next') is not None:
-            r = requests.get(r['next'], headers=headers)
+
+    def get_page(next_url):
+        if next_url is None:
+            return requests.get(url, params=params, headers=headers).json()
+        return requests.get(next_url, headers=headers).json()
+
+    for page in prefetch_pages(get_page):
+        for identity in page.get('results', []):
+            yield identity
+
+
+def prefetch_pages(get_page, url=None, buffer_size=2):
+    """ Returns an iterator over the pages of a paginated API, starting at
+    url. The following pages are fetched in a background thread while the
+    current page is being processed, with at most buffer_size pages waiting
+    to be processed. get_page is called with the next url of the previous
+    page, or url for the first page, and should return the page. The
+    background thread stops when the iterator is closed.
+    """
+    pages = queue.Queue(maxsize=buffer_size)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch():
+        next_url = url
+        try:
+            while True:
+                page = get_page(next_url)
+                next_url = page.get('next')
+                if not put(('page', page)) or next_url is None:
+                    break
+        except Exception as e:
+            put(('error', e))
         else:
-            break
+            put(('done', None))
+
+    thread = threading.Thread(target=fetch)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            kind, value = pages.get()
+            if kind == 'error':
+                raise value
+            if kind == 'done':
+                break
+            yield value
+    finally:
+        stopped.set()
+
+
+def get_identities_page(url=None, params=None):
+    """ Returns a page of identities. url is the next url of the previous
+    page, or None for the first page.
+    """
+    if url is None:
+        url = "%s/%s/" % (settings.IDENTITY_STORE_URL, "identities")
+    headers = {
+        'Authorization': 'Token %s' % settings.IDENTITY_STORE_TOKEN,
+        'Content-Type': 'application/json'
+    }
+    r = requests.get(url, params=params, headers=headers)
+    r.raise_for_status()
+    return r.json()
 
 
-def patch_identity(identity, data):
+def patch_identity(identity, data, session=None):
     """ Patches the given identity with the data provided
     """
     url = "%s/%s/%s/" % (settings.IDENTITY_STORE_URL, "identities", identity)
@@ -75,7 +157,8 @@ def patch_identity(identity, data):
         'Authorization': 'Token %s' % settings.IDENTITY_STORE_TOKEN,
         'Content-Type': 'application/json'
     }
-    r = requests.patch(url, data=json.dumps(data), headers=headers)
+    r = (session or requests).patch(
+        url, data=json.dumps(data), headers=headers)
     r.raise_for_status()
     return r.json()
 
@@ -139,6 +222,57 @@ def deactivate_subscription(subscription):
     return patch_subscription(subscription, {"active": False})
 
 
+def run_concurrently(calls, max_workers=None, raise_errors=True):
+    """ Runs the (function, args) calls concurrently in a bounded pool of
+    threads, and returns their results in order. Once all of the calls have
+    finished, the exception of the first call that failed is raised, or if
+    raise_errors is False, the exceptions are returned in place of the
+    results of the calls that failed.
+    """
+    calls = list(calls)
+    if not calls:
+        return []
+    if max_workers is None:
+        max_workers = settings.CONCURRENT_REQUESTS
+    pool = ThreadPool(min(max_workers, len(calls)))
+    try:
+        results = [pool.apply_async(func, args) for func, args in calls]
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+    values = []
+    for result in results:
+        try:
+            values.append(result.get())
+        except Exception as e:
+            if raise_errors:
+                raise
+            values.append(e)
+    return values
+
+
+class RateLimiter(object):
+    """ Spaces out the calls to wait, across all threads, so that there are
+    at most rate calls per second. Doesn't limit anything if rate is 0.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
 def get_messageset_short_name(recipient, stage, authority):
     # Examples:
     # prebirth.mother.hw_full
@@ -184,8 +318,8 @@ def get_messageset_schedule_sequence(short_name, weeks):
     return (messageset_id, schedule_id, next_sequence_number)
 
 
-def post_message(payload):
-    result = requests.post(
+def post_message(payload, session=None):
+    result = (session or requests).post(
         url="%s/outbound/" % settings.MESSAGE_SENDER_URL,
         data=json.dumps(payload),
         headers={
@@ -1,4 +1,5 @@
 from django.contrib import admin
-from .models import Parish
+from .models import LocationSync, Parish
 
 admin.site.register(Parish)
+admin.site.register(LocationSync)
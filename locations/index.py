@@ -0,0 +1,151 @@
+from __future__ import division
+
+import re
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Parish, get_parish_version
+
+# Words are runs of letters and digits, like in pg_trgm
+WORD_RE = re.compile(r'[^\W_]+', re.UNICODE)
+
+
+def get_words(string):
+    return WORD_RE.findall(string.lower())
+
+
+def get_trigrams(string):
+    """
+    Returns the set of trigrams of the string, in the same way as pg_trgm
+    does, so that similarities match the database's. Each lowercased word is
+    padded with two spaces in front and one behind.
+    """
+    trigrams = set()
+    for word in get_words(string):
+        word = '  %s ' % word
+        trigrams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return trigrams
+
+
+class ParishIndex(object):
+    """
+    An in-memory index of the parish names, to search them without querying
+    the database. Names are matched by prefix using a trie of their
+    normalised words, and by trigram similarity using a postings list of the
+    names that contain each trigram.
+    """
+    def __init__(self, names, version=None):
+        self.version = version
+        self.names = sorted(names)
+        self.trie = {}
+        self.postings = defaultdict(list)
+        self.trigram_counts = []
+        for i, name in enumerate(self.names):
+            node = self.trie
+            for char in ' '.join(get_words(name)):
+                node = node.setdefault(char, {})
+            # The None key holds the names that end at the node
+            node.setdefault(None, []).append(i)
+
+            trigrams = get_trigrams(name)
+            self.trigram_counts.append(len(trigrams))
+            for trigram in trigrams:
+                self.postings[trigram].append(i)
+
+    def get_prefix_matches(self, prefix):
+        """
+        Returns the indexes of the names that start with the prefix.
+        """
+        node = self.trie
+        for char in ' '.join(get_words(prefix)):
+            node = node.get(char)
+            if node is None:
+                return set()
+        matches = set()
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            for key, child in node.items():
+                if key is None:
+                    matches.update(child)
+                else:
+                    nodes.append(child)
+        return matches
+
+    def get_similarities(self, query):
+        """
+        Returns a dictionary of the trigram similarity between the query and
+        each of the names that share a trigram with it, by name index.
+        """
+        trigrams = get_trigrams(query)
+        shared = defaultdict(int)
+        for trigram in trigrams:
+            for i in self.postings.get(trigram, ()):
+                shared[i] += 1
+        return dict(
+            (i, count / (len(trigrams) + self.trigram_counts[i] - count))
+            for i, count in shared.items())
+
+    def search(self, query, threshold=0.3):
+        """
+        Returns the names that start with the query, followed by the names
+        that are at least threshold similar to it, each most similar first.
+        """
+        if not get_words(query):
+            return []
+        similarities = self.get_similarities(query)
+        prefix_matches = self.get_prefix_matches(query)
+        matches = prefix_matches.union(
+            i for i, similarity in similarities.items()
+            if similarity >= threshold)
+        matches = sorted(matches, key=lambda i: (
+            i not in prefix_matches, -similarities.get(i, 0), i))
+        return [self.names[i] for i in matches]
+
+
+_index = None
+_checked_at = 0
+_lock = threading.Lock()
+
+
+def get_parish_index():
+    """
+    Returns the index of the parishes for this process. It is rebuilt if the
+    version of the parish list has changed, which is checked at most every
+    PARISH_INDEX_CHECK_SECONDS.
+    """
+    global _index, _checked_at
+    with _lock:
+        now = time.time()
+        if (_index is None or
+                now - _checked_at >= settings.PARISH_INDEX_CHECK_SECONDS):
+            version = get_parish_version()
+            if _index is None or _index.version != version:
+                _index = ParishIndex(
+                    Parish.objects.values_list('name', flat=True), version)
+            _checked_at = now
+        return _index
+
+
+def clear_parish_index():
+    """
+    Removes the index of the parishes for this process, so that it is
+    rebuilt on the next search.
+    """
+    global _index
+    with _lock:
+        _index = None
+
+
+@receiver(post_save, sender=Parish)
+@receiver(post_delete, sender=Parish)
+def parish_changed(sender, **kwargs):
+    """ Post save and delete hook to rebuild this process's index straight
+        away, instead of after the next version check
+    """
+    clear_parish_index()
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locations', '0002_locationsync'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "CREATE SEQUENCE locations_parish_version",
+            "DROP SEQUENCE locations_parish_version"),
+    ]
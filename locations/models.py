@@ -1,9 +1,31 @@
 from __future__ import unicode_literals
 
-from django.db import models
+from django.db import connection, models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils.encoding import python_2_unicode_compatible
 
 
+class ParishQuerySet(models.QuerySet):
+    def insert_missing(self, names):
+        """
+        Creates parishes for the names that don't exist yet, in a single
+        query, and returns the amount that were created.
+        """
+        names = list(names)
+        if not names:
+            return 0
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO {table} (name) "
+                "SELECT unnest(%s::varchar[]) "
+                "ON CONFLICT DO NOTHING".format(
+                    table=connection.ops.quote_name(
+                        self.model._meta.db_table)),
+                [names])
+            return cursor.rowcount
+
+
 @python_2_unicode_compatible
 class Parish(models.Model):
     """
@@ -11,5 +33,55 @@ class Parish(models.Model):
     """
     name = models.CharField(max_length=100, primary_key=True)
 
+    objects = ParishQuerySet.as_manager()
+
     def __str__(self):
         return self.name
+
+
+@receiver(post_save, sender=Parish)
+@receiver(post_delete, sender=Parish)
+def parish_changed(sender, **kwargs):
+    """ Post save and delete hook to bump the version of the parish list
+    """
+    bump_parish_version()
+
+
+def get_parish_version():
+    """
+    Returns the version of the parish list, which is increased whenever the
+    parishes change.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT last_value, is_called FROM locations_parish_version")
+        value, is_called = cursor.fetchone()
+    return value if is_called else 0
+
+
+def bump_parish_version():
+    """
+    Increases the version of the parish list, so that the search indexes are
+    rebuilt, and returns the new version. The version is a sequence, so it
+    is shared between processes and isn't rolled back with transactions.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT nextval('locations_parish_version')")
+        return cursor.fetchone()[0]
+
+
+@python_2_unicode_compatible
+class LocationSync(models.Model):
+    """
+    A run of the location sync. Incremental syncs only look at the
+    identities that were updated since the start of the last completed sync.
+    """
+    started_at = models.DateTimeField()
+    completed_at = models.DateTimeField(null=True, blank=True)
+    incremental = models.BooleanField(default=True)
+    pages = models.IntegerField(default=0)
+    identities = models.IntegerField(default=0)
+    created = models.IntegerField(default=0)
+
+    def __str__(self):
+        return "Location sync at %s" % self.started_at
@@ -1,12 +1,15 @@
 from future.standard_library import install_aliases
 install_aliases()  # noqa
 from urllib.parse import urlparse
+import time
 
 from celery.task import Task
 from django.conf import settings
+from django.utils import timezone
 from seed_services_client import IdentityStoreApiClient
 
-from .models import Parish
+from familyconnect_registration import utils
+from .models import LocationSync, Parish, bump_parish_version
 
 
 class SyncLocations(Task):
@@ -16,35 +19,66 @@ class SyncLocations(Task):
     """
     name = 'locations.tasks.sync_locations'
 
-    def get_identities(self, client):
+    def get_identity_pages(self, client, params):
         """
-        Returns an iterator over all the identities in the identity store
-        specified by 'client'.
+        Returns an iterator over the pages of the identities in the identity
+        store specified by 'client' that match the search params. The next
+        pages are fetched while the current one is processed.
         """
-        identities = client.get_identities()
-        while True:
-            for identity in identities.get('results', []):
-                yield identity
+        def get_page(next_url):
             # If there is a next page, extract the querystring and get it
-            if identities.get('next') is not None:
-                qs = urlparse(identities['next']).query
-                identities = client.get_identities(params=qs)
-            else:
-                break
+            if next_url is not None:
+                return client.session.get(
+                    '/identities/search/', params=urlparse(next_url).query)
+            return client.session.get('/identities/search/', params=params)
 
-    def run(self, **kwargs):
+        for identities in utils.prefetch_pages(get_page):
+            yield identities.get('results', [])
+
+    def run(self, full=False, **kwargs):
+        """
+        Syncs the parishes of the identities that have been updated since the
+        start of the last completed sync, or of all of the identities if
+        full is True or there hasn't been a sync yet.
+        """
         l = self.get_logger(**kwargs)
         l.info('Starting location import')
-        imported_count = 0
         client = IdentityStoreApiClient(
             settings.IDENTITY_STORE_TOKEN, settings.IDENTITY_STORE_URL)
-        for identity in self.get_identities(client):
-            parish = identity.get('details', {}).get('parish')
-            if parish is not None:
-                _, created = Parish.objects.get_or_create(name=parish.title())
-                if created:
-                    imported_count += 1
-        l.info('Imported {} locations'.format(imported_count))
-        return imported_count
+
+        params = [('details__has_key', 'parish')]
+        watermark = LocationSync.objects\
+            .filter(completed_at__isnull=False)\
+            .order_by('-started_at')\
+            .values_list('started_at', flat=True)\
+            .first()
+        incremental = watermark is not None and not full
+        if incremental:
+            params.append(('updated_at__gte', watermark.isoformat()))
+        sync = LocationSync.objects.create(
+            started_at=timezone.now(), incremental=incremental)
+
+        start = time.time()
+        seen = set()
+        for identities in self.get_identity_pages(client, params):
+            parishes = (
+                identity.get('details', {}).get('parish')
+                for identity in identities)
+            names = set(p.title() for p in parishes if p is not None) - seen
+            seen.update(names)
+            sync.created += Parish.objects.insert_missing(names)
+            sync.identities += len(identities)
+            sync.pages += 1
+        sync.completed_at = timezone.now()
+        sync.save()
+        if sync.created:
+            bump_parish_version()
+
+        elapsed = time.time() - start
+        l.info('Imported {} locations from {} pages in {:.1f}s, {:.1f} '
+               'pages/s'.format(
+                   sync.created, sync.pages, elapsed,
+                   sync.pages / elapsed if elapsed else 0))
+        return sync.created
 
 sync_locations = SyncLocations()
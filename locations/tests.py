@@ -1,17 +1,27 @@
+import datetime
+
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.contrib.postgres.search import TrigramSimilarity
+from django.test import TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.six.moves.urllib.parse import quote
 import responses
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APITestCase
-from seed_services_client import IdentityStoreApiClient
 
-from .models import Parish
+from .index import ParishIndex, clear_parish_index
+from .models import (
+    LocationSync, Parish, bump_parish_version, get_parish_version)
 from .tasks import sync_locations
 
 
 class TestLocations(APITestCase):
+    def setUp(self):
+        super(TestLocations, self).setUp()
+        clear_parish_index()
+
     def login(self):
         """
         Creates a user, creates a token for that user, and attaches that token
@@ -67,6 +77,90 @@ class TestLocations(APITestCase):
         self.assertEqual(response.data['results'], [
             {'name': 'Kawaaga'}, {'name': 'Kawakawa'}])
 
+    def test_search_prefix_matches_first(self):
+        """
+        Parishes that start with the search should be returned before those
+        that are only similar to it.
+        """
+        self.login()
+        Parish.objects.create(name='Kawaaga')
+        Parish.objects.create(name='Ka')
+        Parish.objects.create(name='Kabale')
+
+        response = self.client.get(reverse('locations-list'), {'name': 'ka'})
+        self.assertEqual(response.data['results'], [
+            {'name': 'Ka'}, {'name': 'Kabale'}, {'name': 'Kawaaga'}])
+
+    def test_search_uses_index(self):
+        """
+        Searches should use the in-memory index, which is rebuilt when the
+        parish version changes.
+        """
+        self.login()
+        Parish.objects.create(name='Kawaaga')
+        self.client.get(reverse('locations-list'), {'name': 'kawaga'})
+
+        # Without signals, like the location sync
+        Parish.objects.insert_missing(['Naluwoli'])
+        with self.assertNumQueries(1):  # The authentication token
+            response = self.client.get(
+                reverse('locations-list'), {'name': 'naluwoli'})
+        self.assertEqual(response.data['results'], [])
+
+        bump_parish_version()
+        with override_settings(PARISH_INDEX_CHECK_SECONDS=0):
+            response = self.client.get(
+                reverse('locations-list'), {'name': 'naluwoli'})
+        self.assertEqual(response.data['results'], [{'name': 'Naluwoli'}])
+
+    def test_index_similarity_matches_database(self):
+        """
+        The index should calculate the same similarities as pg_trgm.
+        """
+        names = ['Kawaaga', 'Kawakawa', 'St. Mary-Kibuli', 'Naluwoli 2']
+        Parish.objects.bulk_create(Parish(name=name) for name in names)
+        index = ParishIndex(names)
+        for query in ['kawaga', 'mary kibuli', 'naluwoli']:
+            similarities = dict(
+                Parish.objects
+                .annotate(similarity=TrigramSimilarity('name', query))
+                .values_list('name', 'similarity'))
+            for i, similarity in index.get_similarities(query).items():
+                self.assertAlmostEqual(
+                    similarity, similarities[index.names[i]], places=5)
+
+    def test_full_list(self):
+        """
+        The full list should return all of the parish names, with the parish
+        version as the ETag, and not return them again if the client has
+        that version.
+        """
+        self.login()
+        Parish.objects.create(name='Naluwoli')
+        Parish.objects.create(name='Kawaaga')
+        version = get_parish_version()
+
+        response = self.client.get(reverse('locations-all'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['ETag'], '"%s"' % version)
+        self.assertEqual(response.data, {
+            'version': version, 'results': ['Kawaaga', 'Naluwoli']})
+
+        response = self.client.get(
+            reverse('locations-all'),
+            HTTP_IF_NONE_MATCH='"%s"' % version)
+        self.assertEqual(
+            response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], '"%s"' % version)
+
+        Parish.objects.create(name='Kabale')
+        response = self.client.get(
+            reverse('locations-all'),
+            HTTP_IF_NONE_MATCH='"%s"' % version)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data['results'], ['Kabale', 'Kawaaga', 'Naluwoli'])
+
     def test_search_no_query_parameter(self):
         """
         If no query parameter is present to search on, then no results should
@@ -109,45 +203,28 @@ class TestTasks(TestCase):
         ],
     }
 
-    @responses.activate
-    def test_sync_locations_get_identities(self):
-        """
-        get_identities should iterate through the identities, even if split
-        over multiple pages.
-        """
+    def mock_search_pages(self, updated_since=None):
+        query = 'details__has_key=parish'
+        if updated_since is not None:
+            query += '&updated_at__gte=' + quote(updated_since.isoformat())
         responses.add(
-            responses.GET, 'http://localhost:8001/api/v1/identities/',
+            responses.GET,
+            'http://localhost:8001/api/v1/identities/search/?' + query,
             json=self.identity_list_page_one, match_querystring=True
         )
         responses.add(
             responses.GET,
-            'http://localhost:8001/api/v1/identities/?limit=2&offset=2',
+            'http://localhost:8001/api/v1/identities/search/'
+            '?limit=2&offset=2',
             json=self.identity_list_page_two, match_querystring=True
         )
 
-        client = IdentityStoreApiClient('foo', 'http://localhost:8001/api/v1')
-        identities = list(sync_locations.get_identities(client))
-        self.assertEqual(identities, [
-            {'details': {'parish': 'Kawaaga'}},
-            {'details': {}},
-            {'details': {'parish': 'Naluwoli'}},
-            {'details': {'parish': 'Kawaaga'}},
-        ])
-
     @responses.activate
     def test_sync_locations_creates_objects(self):
         """
         Running the sync_locations task should create the applicable locations
         """
-        responses.add(
-            responses.GET, 'http://localhost:8001/api/v1/identities/',
-            json=self.identity_list_page_one, match_querystring=True
-        )
-        responses.add(
-            responses.GET,
-            'http://localhost:8001/api/v1/identities/?limit=2&offset=2',
-            json=self.identity_list_page_two, match_querystring=True
-        )
+        self.mock_search_pages()
 
         self.assertEqual(Parish.objects.count(), 0)
 
@@ -165,7 +242,9 @@ class TestTasks(TestCase):
         to title case.
         """
         responses.add(
-            responses.GET, 'http://localhost:8001/api/v1/identities/',
+            responses.GET,
+            'http://localhost:8001/api/v1/identities/search/'
+            '?details__has_key=parish',
             json=self.identity_list_caps, match_querystring=True
         )
 
@@ -177,3 +256,55 @@ class TestTasks(TestCase):
         self.assertEqual(Parish.objects.count(), 2)
         self.assertTrue(Parish.objects.filter(name='Kawaaga').exists())
         self.assertTrue(Parish.objects.filter(name='Naluwoli').exists())
+
+    @responses.activate
+    def test_sync_locations_records_sync(self):
+        """
+        Each sync should be recorded, with the amount of pages, identities
+        and new parishes, and parishes that appear on several pages should
+        only be inserted once. The parish version should be bumped if there
+        are new parishes.
+        """
+        self.mock_search_pages()
+        Parish.objects.create(name='Naluwoli')
+        version = get_parish_version()
+
+        with self.assertNumQueries(6):
+            result = sync_locations.apply_async()
+
+        self.assertEqual(int(result.get()), 1)
+        sync = LocationSync.objects.get()
+        self.assertFalse(sync.incremental)
+        self.assertIsNotNone(sync.completed_at)
+        self.assertEqual(
+            (sync.pages, sync.identities, sync.created), (2, 4, 1))
+        self.assertEqual(get_parish_version(), version + 1)
+
+    @responses.activate
+    def test_sync_locations_incremental(self):
+        """
+        Only the identities updated since the start of the last completed
+        sync should be synced, unless a full sync is requested.
+        """
+        started_at = timezone.make_aware(
+            datetime.datetime(2016, 10, 15, 1, 2, 3), timezone.utc)
+        LocationSync.objects.create(
+            started_at=started_at - datetime.timedelta(days=1),
+            completed_at=started_at)
+        LocationSync.objects.create(
+            started_at=started_at,
+            completed_at=started_at + datetime.timedelta(minutes=5))
+        LocationSync.objects.create(
+            started_at=started_at + datetime.timedelta(days=1))
+        self.mock_search_pages(updated_since=started_at)
+
+        result = sync_locations.apply_async()
+
+        self.assertEqual(int(result.get()), 2)
+        self.assertTrue(LocationSync.objects.latest('id').incremental)
+
+        responses.reset()
+        self.mock_search_pages()
+        result = sync_locations.apply_async(kwargs={'full': True})
+        self.assertEqual(int(result.get()), 0)
+        self.assertFalse(LocationSync.objects.latest('id').incremental)
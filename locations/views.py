@@ -1,8 +1,12 @@
-from django.contrib.postgres.search import TrigramSimilarity
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.decorators import list_route
 from rest_framework.mixins import ListModelMixin
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
 
+from .index import get_parish_index
 from .models import Parish
 from .serializers import ParishSerializer
 
@@ -16,16 +20,45 @@ class ParishSearch(ListModelMixin, GenericViewSet):
     """
     permission_classes = (IsAuthenticated,)
     serializer_class = ParishSerializer
+    similarity_threshold = 0.3
 
     def get_queryset(self):
+        return Parish.objects.all()
+
+    def list(self, request, *args, **kwargs):
+        """
+        Searches the in-memory parish index, so that searches don't query
+        the database.
+        """
         name = self.request.query_params.get('name', None)
 
         if name is None:
-            return Parish.objects.none()
+            names = []
+        else:
+            names = get_parish_index().search(name, self.similarity_threshold)
 
-        qs = Parish.objects.all()
-        qs = qs.annotate(similarity=TrigramSimilarity('name', name))
-        qs = qs.filter(similarity__gt=0.3)
-        qs = qs.order_by('-similarity')
+        page = self.paginate_queryset(names)
+        if page is not None:
+            names = page
+        serializer = self.get_serializer(
+            [Parish(name=n) for n in names], many=True)
+        if page is not None:
+            return self.get_paginated_response(serializer.data)
+        return Response(serializer.data)
 
-        return qs
+    @list_route(url_path='all')
+    def full_list(self, request):
+        """
+        Returns the names of all of the parishes, so that clients can search
+        them locally. The ETag is the version of the list, so clients can
+        send it in If-None-Match to only download the list when it changes.
+        """
+        index = get_parish_index()
+        etag = quote_etag(str(index.version))
+        etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+        if '*' in etags or str(index.version) in etags:
+            return Response(
+                status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        return Response(
+            {'version': index.version, 'results': index.names},
+            headers={'ETag': etag})
@@ -2,12 +2,16 @@ from django import forms
 from django.contrib import admin, messages
 from django.contrib.admin import helpers
 from django.conf.urls import url
-from django.shortcuts import redirect
+from django.db.models import Case, Count, IntegerField, Sum, When
+from django.shortcuts import get_object_or_404, redirect
 from django.template.response import TemplateResponse
 
 from familyconnect_registration.utils import get_available_metrics
-from .models import Source, Registration, SubscriptionRequest
-from .tasks import repopulate_metrics
+from .models import (
+    Source, Registration, SubscriptionRequest, MetricsRepopulation)
+from .tasks import (
+    repopulate_metrics, start_metrics_repopulation,
+    resume_metrics_repopulation)
 
 
 class RepopulateMetricsForm(forms.Form):
@@ -21,6 +25,17 @@ class RepopulateMetricsForm(forms.Form):
     graphite_retentions = forms.CharField(
         label='Graphite Retentions', initial='1m:1d,5m:1y,1h:5y',
         widget=forms.TextInput(attrs={'size': 80}))
+    histogram = forms.BooleanField(
+        label='Use histogram generator', initial=True, required=False,
+        help_text='Generate each retention with a few grouped queries, '
+                  'instead of a query per metric per time bucket.')
+    chunked = forms.BooleanField(
+        label='Run in parallel chunks', initial=False, required=False,
+        help_text='Split the repopulation up into chunks that are run in '
+                  'parallel across the workers, and can be resumed if the '
+                  'run fails. Always uses the histogram generator.')
+    buckets_per_chunk = forms.IntegerField(
+        label='Buckets per chunk', initial=1000, min_value=1)
 
     def __init__(self, *args, **kwargs):
         super(RepopulateMetricsForm, self).__init__(*args, **kwargs)
@@ -44,6 +59,10 @@ class RegistrationAdmin(admin.ModelAdmin):
             url(r'^repopulate_registration_metrics/$',
                 self.admin_site.admin_view(self.repopulate_metrics),
                 name='registrations_registration_repopulate_metrics'),
+            url(r'^repopulate_registration_metrics/(?P<repopulation_id>\d+)/'
+                r'resume/$',
+                self.admin_site.admin_view(self.resume_repopulate_metrics),
+                name='registrations_registration_resume_repopulate_metrics'),
         ] + urls
 
     def repopulate_metrics(self, request):
@@ -52,9 +71,18 @@ class RegistrationAdmin(admin.ModelAdmin):
             form = RepopulateMetricsForm(request.POST)
             if form.is_valid():
                 data = form.cleaned_data
+                if data['chunked']:
+                    start_metrics_repopulation(
+                        data['amqp_url'], data['prefix'],
+                        data['metric_names'], data['graphite_retentions'],
+                        buckets_per_chunk=data['buckets_per_chunk'])
+                    messages.success(request, 'Metrics repopulation started')
+                    return redirect(
+                        'admin:registrations_registration_repopulate_metrics')
                 repopulate_metrics.delay(
                     data['amqp_url'], data['prefix'], data['metric_names'],
-                    data['graphite_retentions'])
+                    data['graphite_retentions'],
+                    histogram=data['histogram'])
                 messages.success(request, 'Metrics repopulation started')
                 return redirect('admin:registrations_registration_changelist')
         else:
@@ -67,12 +95,27 @@ class RegistrationAdmin(admin.ModelAdmin):
             adminform=helpers.AdminForm(
                 form, [(None, {'fields': form.base_fields})],
                 self.get_prepopulated_fields(request)),
+            repopulations=MetricsRepopulation.objects.annotate(
+                total_chunks=Count('chunks'),
+                completed_chunks=Sum(Case(
+                    When(chunks__completed=True, then=1),
+                    default=0, output_field=IntegerField())),
+            ).order_by('-created_at')[:10],
         )
         return TemplateResponse(
             request,
             "admin/registrations/registration/repopulate_metrics.html",
             context)
 
+    def resume_repopulate_metrics(self, request, repopulation_id):
+        repopulation = get_object_or_404(
+            MetricsRepopulation, id=repopulation_id)
+        if request.method == 'POST':
+            resume_metrics_repopulation(repopulation)
+            messages.success(
+                request, 'Metrics repopulation %s resumed' % repopulation.id)
+        return redirect('admin:registrations_registration_repopulate_metrics')
+
 
 class SubscriptionRequestAdmin(admin.ModelAdmin):
     list_display = [
@@ -57,10 +57,11 @@ class RetentionScheme(object):
     def __init__(self, retentions):
         self.retentions = [GraphiteRetention(r) for r in retentions.split(',')]
 
-    def get_buckets(self, now=None):
+    def get_retention_buckets(self, now=None):
         """
-        Returns an iterator of tuples (start, end) that define the time
-        buckets that all the retention schemes cover.
+        Returns an iterator of lists of tuples (start, end), one list for each
+        retention. Each list contains the consecutive time buckets that the
+        retention covers, ordered from oldest to newest.
         kwargs:
             now: timestamp of current time. Defaults to current time.
         """
@@ -69,11 +70,19 @@ class RetentionScheme(object):
         finish = now
 
         for r in self.retentions:
-            beginning = now
-            for start, end in r.get_buckets(now=now, finish=finish):
-                # We always want to end the next retention at the earliest
-                # point that this retention covers, to avoid overlaps
-                beginning = min(beginning, start)
-                yield (start, end)
-            # The next retention should end where this one started
-            finish = beginning
+            buckets = list(r.get_buckets(now=now, finish=finish))
+            yield buckets
+            # The next retention should end where this one started, to avoid
+            # overlaps
+            finish = buckets[0][0] if buckets else now
+
+    def get_buckets(self, now=None):
+        """
+        Returns an iterator of tuples (start, end) that define the time
+        buckets that all the retention schemes cover.
+        kwargs:
+            now: timestamp of current time. Defaults to current time.
+        """
+        for buckets in self.get_retention_buckets(now=now):
+            for bucket in buckets:
+                yield bucket
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from registrations.models import Registration
+
+
+class Command(BaseCommand):
+    help = ("Populates the typed registration fields, such as language and "
+            "last_period_date, from the data of each registration. Only "
+            "registrations whose fields are out of date are updated.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='The amount of registrations to update in each transaction')
+
+    def update_registrations(self, registrations):
+        count = 0
+        with transaction.atomic():
+            for registration in registrations:
+                fields = Registration.get_data_fields(registration.data)
+                if any(getattr(registration, name) != value
+                       for name, value in fields.items()):
+                    Registration.objects\
+                        .filter(id=registration.id)\
+                        .update(**fields)
+                    count += 1
+        return count
+
+    def handle(self, *args, **options):
+        registrations = Registration.objects\
+            .only('id', 'data', *Registration.DATA_FIELDS)\
+            .order_by('created_at')
+
+        count = 0
+        batch = []
+        for registration in registrations.iterator():
+            batch.append(registration)
+            if len(batch) >= options['batch_size']:
+                count += self.update_registrations(batch)
+                batch = []
+        if batch:
+            count += self.update_registrations(batch)
+
+        self.stdout.write("Updated %s registrations" % count)
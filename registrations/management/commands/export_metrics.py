@@ -0,0 +1,73 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from familyconnect_registration.utils import get_available_metrics
+from registrations.graphite import RetentionScheme
+from registrations.metrics import (
+    GraphiteFileExporter, SnapshotMetricGenerator)
+from registrations.snapshot import RegistrationSnapshot, from_timestamp
+from registrations.tasks import repopulate_metrics
+
+
+class Command(BaseCommand):
+    help = ("Generates the historical metrics for the given graphite "
+            "retentions, and writes them to gzip compressed files in the "
+            "output directory, instead of publishing them to AMQP.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'output_dir',
+            help='The directory to write the metric files to')
+        parser.add_argument(
+            '--format', dest='export_format', default='plaintext',
+            choices=GraphiteFileExporter.FORMATS,
+            help='Graphite plaintext, or carbon pickle protocol')
+        parser.add_argument(
+            '--retentions', default='1m:1d,5m:1y,1h:5y',
+            help='The graphite retentions to generate the metrics for')
+        parser.add_argument(
+            '--metric', dest='metric_names', action='append',
+            help='The metrics to generate. Defaults to all metrics')
+        parser.add_argument(
+            '--prefix', default='', help='The metric name prefix')
+        parser.add_argument(
+            '--points-per-file', type=int, default=1000000,
+            help='The maximum amount of metrics in each file')
+        parser.add_argument(
+            '--snapshot',
+            help='Generate the metrics from the registration snapshot in '
+                 'this directory, instead of from the database')
+
+    def handle(self, *args, **options):
+        output_dir = options['output_dir']
+        if not os.path.isdir(output_dir):
+            raise CommandError(
+                'Output directory %s does not exist' % output_dir)
+
+        metric_names = options['metric_names'] or get_available_metrics()
+        exporter = GraphiteFileExporter(
+            output_dir, prefix=options['prefix'],
+            export_format=options['export_format'],
+            points_per_file=options['points_per_file'])
+
+        generator = None
+        if options['snapshot']:
+            snapshot = RegistrationSnapshot(options['snapshot'])
+            generator = SnapshotMetricGenerator(snapshot)
+            if snapshot.meta['exported_until'] is not None:
+                self.stdout.write(
+                    "The snapshot only covers registrations created before "
+                    "%s, later time buckets are skipped" % from_timestamp(
+                        snapshot.meta['exported_until']).isoformat())
+
+        ret = RetentionScheme(options['retentions'])
+        for buckets in ret.get_retention_buckets():
+            repopulate_metrics.generate_and_send_histogram(
+                exporter, metric_names, buckets, generator=generator)
+        exporter.flush()
+
+        stats = exporter.get_stats()
+        self.stdout.write(
+            "Wrote %(points)s metrics to %(files)s files "
+            "(%(points_per_second).1f metrics/s)" % stats)
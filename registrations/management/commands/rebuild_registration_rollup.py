@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+from registrations.models import Registration, RegistrationRollup
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds the hourly registration rollup from the registrations. "
+            "Replaces all of the existing rollup rows.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='The amount of rollup rows to insert at a time')
+
+    def handle(self, *args, **options):
+        rows = Registration.objects\
+            .annotate(hour=TruncHour('created_at', tzinfo=timezone.utc))\
+            .values(
+                'hour', 'stage', 'source__authority', 'language', 'validated')\
+            .annotate(count=Count('id'))\
+            .order_by()
+
+        with transaction.atomic():
+            RegistrationRollup.objects.all().delete()
+            rollups = RegistrationRollup.objects.bulk_create((
+                RegistrationRollup(
+                    hour=row['hour'],
+                    stage=row['stage'],
+                    authority=row['source__authority'],
+                    language=row['language'] or '',
+                    validated=row['validated'],
+                    count=row['count'],
+                ) for row in rows), batch_size=options['batch_size'])
+
+        self.stdout.write("Rebuilt %s rollup rows" % len(rollups))
@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from registrations.snapshot import RegistrationSnapshot
+
+
+class Command(BaseCommand):
+    help = ("Appends the registrations created since the previous update to "
+            "the columnar registration snapshot, or rebuilds the snapshot.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path', default=settings.REGISTRATION_SNAPSHOT_PATH,
+            help='The snapshot directory. Defaults to the '
+                 'REGISTRATION_SNAPSHOT_PATH setting')
+        parser.add_argument(
+            '--rebuild', action='store_true', default=False,
+            help='Replace the snapshot with all of the registrations')
+        parser.add_argument(
+            '--batch-size', type=int, default=10000,
+            help='The amount of registrations to write at a time')
+
+    def handle(self, *args, **options):
+        if not options['path']:
+            raise CommandError(
+                'No snapshot path given, and REGISTRATION_SNAPSHOT_PATH is '
+                'not set')
+
+        snapshot = RegistrationSnapshot(options['path'])
+        if options['rebuild']:
+            added = snapshot.rebuild(batch_size=options['batch_size'])
+        else:
+            added = snapshot.update(batch_size=options['batch_size'])
+
+        self.stdout.write(
+            "Added %s registrations, the snapshot has %s registrations" % (
+                added, snapshot.meta['rows']))
@@ -1,10 +1,19 @@
+import gzip
+import os
 import pika
+import struct
+import time
+from collections import OrderedDict, defaultdict
+from six.moves import cPickle as pickle
 from django.conf import settings
+from django.db.models import Case, Count, IntegerField, Sum, When
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
 from functools import partial
 
 from familyconnect_registration import utils
 
-from .models import Registration
+from .models import Registration, RegistrationRollup
 
 
 class MetricGenerator(object):
@@ -56,13 +65,13 @@ class MetricGenerator(object):
         return Registration.objects\
             .filter(created_at__gt=start)\
             .filter(created_at__lte=end)\
-            .filter(data__language=language)\
+            .filter(language=language)\
             .count()
 
     def registrations_language_total_last(self, language, start, end):
         return Registration.objects\
             .filter(created_at__lte=end)\
-            .filter(data__language=language)\
+            .filter(language=language)\
             .count()
 
     def registrations_source_sum(self, source, start, end):
@@ -79,6 +88,215 @@ class MetricGenerator(object):
             .count()
 
 
+def get_metric_prefixes(row):
+    """
+    Returns the names, without the sum or total.last suffix, of all the
+    metrics that a row of grouped registration counts contributes to.
+    """
+    return (
+        'registrations.created',
+        'registrations.language.{}'.format(row['language']),
+        'registrations.source.{}'.format(row['source__authority']),
+    )
+
+
+def split_metric_name(name):
+    """
+    Splits a metric name into its prefix and its type, which is either 'sum'
+    or 'total.last'.
+    """
+    for metric_type in ('sum', 'total.last'):
+        suffix = '.{}'.format(metric_type)
+        if name.endswith(suffix):
+            return name[:-len(suffix)], metric_type
+    raise ValueError('Unknown metric type for metric {}'.format(name))
+
+
+class GroupedMetricGenerator(object):
+    """
+    Generates the values for all of the realtime metrics at once, using a
+    single query over the registrations grouped by language and source.
+    """
+    def get_counts(self, start, end):
+        """
+        Returns the amount of registrations for each language and source
+        combination, both within the given timeframe (window) and in total up
+        until the end of the timeframe (total).
+        """
+        return Registration.objects\
+            .filter(created_at__lte=end)\
+            .values('language', 'source__authority')\
+            .annotate(
+                total=Count('id'),
+                window=Sum(Case(
+                    When(created_at__gt=start, then=1),
+                    default=0, output_field=IntegerField())))
+
+    def generate_metrics(self, start, end):
+        """
+        Returns a dictionary of metric name to value for all of the realtime
+        metrics.
+
+        args:
+            start: Datetime for where the metric window starts
+            end: Datetime for where the metric window ends
+        """
+        metrics = dict((name, 0) for name in settings.METRICS_REALTIME)
+        for row in self.get_counts(start, end):
+            for prefix in get_metric_prefixes(row):
+                if '{}.sum'.format(prefix) in metrics:
+                    metrics['{}.sum'.format(prefix)] += row['window']
+                if '{}.total.last'.format(prefix) in metrics:
+                    metrics['{}.total.last'.format(prefix)] += row['total']
+        return metrics
+
+
+class RollupMetricGenerator(GroupedMetricGenerator):
+    """
+    Generates the values for all of the realtime metrics at once, from the
+    hourly registration rollup instead of the registrations themselves.
+    """
+    def get_counts(self, start, end):
+        """
+        Returns the amount of registrations for each language and source
+        combination, both within the hours from start up to, but not
+        including, end (window), and in total (total). start and end should
+        be on the hour.
+        """
+        rows = RegistrationRollup.objects\
+            .values('language', 'authority')\
+            .annotate(
+                total=Sum('count'),
+                window=Sum(Case(
+                    When(hour__gte=start, hour__lt=end, then='count'),
+                    default=0, output_field=IntegerField())))
+        return [{
+            'language': row['language'],
+            'source__authority': row['authority'],
+            'total': row['total'],
+            'window': row['window'],
+        } for row in rows]
+
+
+class HistogramMetricGenerator(object):
+    """
+    Generates the metric values for a run of consecutive time buckets at once.
+    The registrations are counted per bucket, language and source in a single
+    grouped query, and the total.last values are calculated as running sums
+    over the buckets, starting from the totals before the first bucket.
+    """
+    def get_bucket_counts(self, start, end, precision):
+        """
+        Returns the amount of registrations for each bucket, language and
+        source combination in the timeframe. Buckets are numbered from 0,
+        and include their end but not their start, to avoid duplication.
+
+        args:
+            start: Datetime for where the first bucket starts
+            end: Datetime for where the last bucket ends
+            precision: Timedelta of the size of each bucket
+        """
+        if timezone.is_naive(start):
+            start = timezone.make_aware(start, timezone.utc)
+        bucket = RawSQL(
+            'CEIL(EXTRACT(EPOCH FROM '
+            '("registrations_registration"."created_at" - %s)) / %s)::integer'
+            ' - 1',
+            (start, precision.total_seconds()))
+        return Registration.objects\
+            .filter(created_at__gt=start)\
+            .filter(created_at__lte=end)\
+            .annotate(bucket=bucket)\
+            .values('bucket', 'language', 'source__authority')\
+            .annotate(count=Count('id'))
+
+    def generate_metrics(self, metric_names, buckets):
+        """
+        Returns an iterator of (name, value, start, end) tuples, for each of
+        the metrics for each of the buckets.
+
+        args:
+            metric_names: The names of the metrics to generate
+            buckets: List of consecutive (start, end) tuples. All buckets
+                must be the same size, except for the last one, which may
+                be shorter.
+        """
+        if not buckets:
+            return
+        start, end = buckets[0][0], buckets[-1][1]
+        precision = buckets[0][1] - buckets[0][0]
+
+        sums = defaultdict(lambda: [0] * len(buckets))
+        for row in self.get_bucket_counts(start, end, precision):
+            for prefix in get_metric_prefixes(row):
+                sums[prefix][row['bucket']] += row['count']
+
+        totals = defaultdict(int)
+        for row in GroupedMetricGenerator().get_counts(start, start):
+            for prefix in get_metric_prefixes(row):
+                totals[prefix] += row['total']
+
+        for name in metric_names:
+            prefix, metric_type = split_metric_name(name)
+            total = totals[prefix]
+            for (bucket_start, bucket_end), count in zip(
+                    buckets, sums[prefix]):
+                total += count
+                if metric_type == 'sum':
+                    yield name, count, bucket_start, bucket_end
+                else:
+                    yield name, total, bucket_start, bucket_end
+
+
+class SnapshotMetricGenerator(object):
+    """
+    Generates the metric values for a run of consecutive time buckets from a
+    registration snapshot, instead of querying the database.
+    """
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def get_filters(self, prefix):
+        """
+        Returns the snapshot column filters for a metric name prefix.
+        """
+        if prefix == 'registrations.created':
+            return {}
+        for metric_type, column in (
+                ('language', 'language'), ('source', 'authority')):
+            start = 'registrations.{}.'.format(metric_type)
+            if prefix.startswith(start):
+                return {column: prefix[len(start):]}
+        raise ValueError('Unknown metric {}'.format(prefix))
+
+    def generate_metrics(self, metric_names, buckets):
+        """
+        Returns an iterator of (name, value, start, end) tuples, for each of
+        the metrics for each of the buckets. Buckets that end after the
+        registrations exported to the snapshot are skipped, since their
+        values would be incomplete.
+
+        args:
+            metric_names: The names of the metrics to generate
+            buckets: List of consecutive (start, end) tuples
+        """
+        buckets = [
+            (start, end) for start, end in buckets
+            if self.snapshot.is_exported(end)]
+        if not buckets:
+            return
+        for name in metric_names:
+            prefix, metric_type = split_metric_name(name)
+            total, counts = self.snapshot.get_bucket_counts(
+                buckets, **self.get_filters(prefix))
+            for (bucket_start, bucket_end), count in zip(buckets, counts):
+                total += int(count)
+                if metric_type == 'sum':
+                    yield name, int(count), bucket_start, bucket_end
+                else:
+                    yield name, total, bucket_start, bucket_end
+
+
 def send_metric(amqp_channel, prefix, name, value, timestamp):
     timestamp = utils.timestamp_to_epoch(timestamp)
 
@@ -88,3 +306,174 @@ def send_metric(amqp_channel, prefix, name, value, timestamp):
     amqp_channel.basic_publish(
         'graphite', name, '{} {}'.format(float(value), int(timestamp)),
         pika.BasicProperties(content_type='text/plain', delivery_mode=2))
+
+
+class MetricPublishError(Exception):
+    """
+    Raised when the broker doesn't confirm a batch of published metrics.
+    """
+
+
+class BatchMetricPublisher(object):
+    """
+    Publishes metrics to the graphite exchange in batches. Like send_metric,
+    each message has the metric name as its routing key, but has many
+    "value timestamp" lines in its body, one for each point of that metric in
+    the batch. This is the format that carbon's AMQP listener reads by
+    default.
+
+    Publisher confirms are enabled on the channel, and each message has to be
+    confirmed by the broker before the next one is published, so at most one
+    message is ever in flight.
+    """
+    def __init__(self, amqp_channel, prefix='', batch_size=1000):
+        self.amqp_channel = amqp_channel
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.lines = OrderedDict()
+        self.pending = 0
+        self.points = 0
+        self.messages = 0
+        self.started = time.time()
+        self.amqp_channel.confirm_delivery()
+
+    def publish(self, name, value, timestamp):
+        """
+        Adds a metric to the current batch, publishing the batch if it is
+        full.
+        """
+        if self.prefix:
+            name = '{}.{}'.format(self.prefix, name)
+        timestamp = utils.timestamp_to_epoch(timestamp)
+        self.lines.setdefault(name, []).append(
+            '{} {}'.format(float(value), int(timestamp)))
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Publishes the current batch as a message per metric name, and waits
+        for the broker to confirm each of them.
+        """
+        while self.lines:
+            name, lines = next(iter(self.lines.items()))
+            confirmed = self.amqp_channel.basic_publish(
+                'graphite', name, '\n'.join(lines),
+                pika.BasicProperties(
+                    content_type='text/plain', delivery_mode=2))
+            if not confirmed:
+                raise MetricPublishError(
+                    'Batch of {} points for {} was not confirmed'.format(
+                        len(lines), name))
+            del self.lines[name]
+            self.pending -= len(lines)
+            self.points += len(lines)
+            self.messages += 1
+
+    def get_stats(self):
+        """
+        Returns the amount of metrics and messages published so far, and the
+        throughput in metrics per second.
+        """
+        seconds = time.time() - self.started
+        return {
+            'points': self.points,
+            'messages': self.messages,
+            'seconds': seconds,
+            'points_per_second': self.points / seconds if seconds else 0.0,
+        }
+
+
+class GraphiteFileExporter(object):
+    """
+    Writes metrics to gzip compressed files in a local directory instead of
+    publishing them, so that they can be bulk loaded into carbon or whisper,
+    or compared between runs.
+
+    Has the same interface as the BatchMetricPublisher. The metrics are split
+    over multiple files of at most points_per_file metrics each, in either
+    the graphite plaintext format, or the carbon pickle protocol format with
+    batch_size metrics per length prefixed pickle.
+    """
+    FORMATS = ('plaintext', 'pickle')
+
+    def __init__(
+            self, output_dir, prefix='', export_format='plaintext',
+            points_per_file=1000000, batch_size=1000):
+        if export_format not in self.FORMATS:
+            raise ValueError('Unknown export format {}'.format(export_format))
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.export_format = export_format
+        self.points_per_file = points_per_file
+        self.batch_size = batch_size
+        self.batch = []
+        self.file = None
+        self.file_points = 0
+        self.filenames = []
+        self.points = 0
+        self.started = time.time()
+
+    def publish(self, name, value, timestamp):
+        """
+        Adds a metric to the current batch, writing the batch if it is full.
+        """
+        if self.prefix:
+            name = '{}.{}'.format(self.prefix, name)
+        timestamp = int(utils.timestamp_to_epoch(timestamp))
+        self.batch.append((name, (timestamp, float(value))))
+        if (len(self.batch) >= self.batch_size or
+                self.file_points + len(self.batch) >= self.points_per_file):
+            self.write_batch()
+
+    def write_batch(self):
+        if not self.batch:
+            return
+        if self.file is None:
+            filename = os.path.join(
+                self.output_dir, 'metrics-{:05d}.{}.gz'.format(
+                    len(self.filenames),
+                    'txt' if self.export_format == 'plaintext' else 'pickle'))
+            self.file = gzip.open(filename, 'wb')
+            self.filenames.append(filename)
+
+        if self.export_format == 'plaintext':
+            self.file.write(''.join(
+                '{} {} {}\n'.format(name, value, timestamp)
+                for name, (timestamp, value) in self.batch).encode('utf-8'))
+        else:
+            payload = pickle.dumps(self.batch, protocol=2)
+            self.file.write(struct.pack('!L', len(payload)) + payload)
+
+        self.file_points += len(self.batch)
+        self.points += len(self.batch)
+        self.batch = []
+        if self.file_points >= self.points_per_file:
+            self.close_file()
+
+    def close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.file_points = 0
+
+    def flush(self):
+        """
+        Writes the current batch, and closes the current file.
+        """
+        self.write_batch()
+        self.close_file()
+
+    def get_stats(self):
+        """
+        Returns the amount of metrics and files written so far, and the
+        throughput in metrics per second.
+        """
+        seconds = time.time() - self.started
+        return {
+            'points': self.points,
+            'files': len(self.filenames),
+            'seconds': seconds,
+            'points_per_second': self.points / seconds if seconds else 0.0,
+        }
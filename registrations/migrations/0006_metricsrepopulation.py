@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 07:40
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrations', '0005_auto_20160706_1335'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetricsRepopulation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amqp_url', models.CharField(max_length=255)),
+                ('prefix', models.CharField(blank=True, max_length=255)),
+                ('graphite_retentions', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MetricsRepopulationChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('metric_names', django.contrib.postgres.fields.jsonb.JSONField()),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField()),
+                ('precision', models.IntegerField(help_text='Bucket size in seconds')),
+                ('completed', models.BooleanField(default=False)),
+                ('repopulation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='registrations.MetricsRepopulation')),
+            ],
+        ),
+    ]
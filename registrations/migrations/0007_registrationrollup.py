@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 07:45
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrations', '0006_metricsrepopulation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegistrationRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('stage', models.CharField(max_length=30)),
+                ('authority', models.CharField(max_length=30)),
+                ('language', models.CharField(blank=True, max_length=255)),
+                ('validated', models.BooleanField(default=False)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='registrationrollup',
+            unique_together=set([('hour', 'stage', 'authority', 'language', 'validated')]),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 07:54
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrations', '0007_registrationrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MotherProfile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mother_id', models.CharField(max_length=36, unique=True)),
+                ('stage', models.CharField(max_length=30)),
+                ('authority', models.CharField(max_length=30)),
+                ('msg_receiver', models.CharField(blank=True, max_length=30, null=True)),
+                ('language', models.CharField(blank=True, max_length=255, null=True)),
+                ('subscribed', models.BooleanField(default=False)),
+                ('subscription_stage', models.CharField(blank=True, choices=[('prebirth', 'Mother is pregnant'), ('postbirth', 'Baby has been born'), ('loss', 'Baby loss')], max_length=30, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('registration', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='registrations.Registration')),
+            ],
+        ),
+    ]
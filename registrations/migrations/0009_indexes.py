@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 07:56
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrations', '0008_motherprofile'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='registration',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='registration',
+            name='mother_id',
+            field=models.CharField(db_index=True, max_length=36),
+        ),
+        migrations.AlterIndexTogether(
+            name='registration',
+            index_together=set([('source', 'created_at')]),
+        ),
+        # Language metrics filter on data -> 'language' for a time range
+        migrations.RunSQL(
+            "CREATE INDEX registrations_registration_language_created_at "
+            "ON registrations_registration "
+            "((data -> 'language'), created_at)",
+            "DROP INDEX registrations_registration_language_created_at"),
+        # Location reminders look up validated public prebirth registrations
+        migrations.RunSQL(
+            "CREATE INDEX registrations_registration_validated_prebirth "
+            "ON registrations_registration (source_id) "
+            "WHERE validated AND stage = 'prebirth'",
+            "DROP INDEX registrations_registration_validated_prebirth"),
+    ]
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 07:59
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registrations', '0009_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='registration',
+            name='hoh_id',
+            field=models.CharField(blank=True, db_index=True, max_length=36, null=True),
+        ),
+        migrations.AddField(
+            model_name='registration',
+            name='language',
+            field=models.CharField(blank=True, max_length=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='registration',
+            name='last_period_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='registration',
+            name='msg_receiver',
+            field=models.CharField(blank=True, max_length=30, null=True),
+        ),
+        migrations.AddField(
+            model_name='registration',
+            name='parish',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='registration',
+            name='preg_week',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='registration',
+            name='receiver_id',
+            field=models.CharField(blank=True, db_index=True, max_length=36, null=True),
+        ),
+        migrations.AddField(
+            model_name='registration',
+            name='reg_type',
+            field=models.CharField(blank=True, max_length=30, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='registration',
+            index_together=set([('language', 'created_at'), ('source', 'created_at')]),
+        ),
+        # The language metrics use the language field index instead. The
+        # fields of existing registrations are populated with the
+        # backfill_registration_fields management command.
+        migrations.RunSQL(
+            "DROP INDEX registrations_registration_language_created_at",
+            "CREATE INDEX registrations_registration_language_created_at "
+            "ON registrations_registration "
+            "((data -> 'language'), created_at)"),
+    ]
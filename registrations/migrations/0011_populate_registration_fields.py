@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, transaction
+
+from registrations.models import get_data_fields
+
+BATCH_SIZE = 1000
+
+
+def populate_registration_fields(apps, schema_editor):
+    """
+    Populates the typed fields of the existing registrations from their data,
+    a batch at a time, and then the profile fields that were created from
+    registrations that hadn't been populated yet.
+    """
+    Registration = apps.get_model('registrations', 'Registration')
+    last_id = None
+    while True:
+        registrations = Registration.objects.order_by('id')
+        if last_id is not None:
+            registrations = registrations.filter(id__gt=last_id)
+        batch = list(registrations.values_list('id', 'data')[:BATCH_SIZE])
+        if not batch:
+            break
+        with transaction.atomic():
+            for registration_id, data in batch:
+                Registration.objects.filter(id=registration_id).update(
+                    **get_data_fields(Registration, data))
+        last_id = batch[-1][0]
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            "UPDATE registrations_motherprofile AS p "
+            "SET msg_receiver = coalesce(p.msg_receiver, r.msg_receiver), "
+            "language = coalesce(p.language, r.language) "
+            "FROM registrations_registration AS r "
+            "WHERE p.registration_id = r.id "
+            "AND (p.msg_receiver IS NULL OR p.language IS NULL)")
+
+
+class Migration(migrations.Migration):
+    # Each batch of registrations is updated in its own transaction
+    atomic = False
+
+    dependencies = [
+        ('registrations', '0010_registration_data_fields'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            populate_registration_fields, migrations.RunPython.noop),
+    ]
@@ -1,12 +1,17 @@
+import six
 import uuid
+from datetime import datetime, timedelta
 
 from django.contrib.postgres.fields import JSONField
 from django.contrib.auth.models import User
 from django.conf import settings
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, models, transaction
 from django.core.cache import cache
+from django.db.models import F, Sum
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 
 
@@ -68,12 +73,13 @@ class Registration(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     stage = models.CharField(max_length=30, null=False, blank=False,
                              choices=STAGE_CHOICES)
-    mother_id = models.CharField(max_length=36, null=False, blank=False)
+    mother_id = models.CharField(max_length=36, null=False, blank=False,
+                                 db_index=True)
     data = JSONField(null=True, blank=True)
     validated = models.BooleanField(default=False)
     source = models.ForeignKey(Source, related_name='registrations',
                                null=False)
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     updated_at = models.DateTimeField(auto_now=True)
     created_by = models.ForeignKey(User, related_name='registrations_created',
                                    null=True)
@@ -81,20 +87,301 @@ class Registration(models.Model):
                                    null=True)
     user = property(lambda self: self.created_by)
 
+    # Typed copies of the most used values in data, which are set from data
+    # whenever the registration is saved, so that they can be filtered on
+    # and indexed. Values that don't fit the field are stored as null.
+    language = models.CharField(max_length=10, null=True, blank=True)
+    receiver_id = models.CharField(max_length=36, null=True, blank=True,
+                                   db_index=True)
+    hoh_id = models.CharField(max_length=36, null=True, blank=True,
+                              db_index=True)
+    msg_receiver = models.CharField(max_length=30, null=True, blank=True)
+    parish = models.CharField(max_length=255, null=True, blank=True)
+    last_period_date = models.DateField(null=True, blank=True)
+    reg_type = models.CharField(max_length=30, null=True, blank=True)
+    preg_week = models.IntegerField(null=True, blank=True)
+
+    DATA_FIELDS = ('language', 'receiver_id', 'hoh_id', 'msg_receiver',
+                   'parish', 'last_period_date', 'reg_type', 'preg_week')
+
     objects = RegistrationQuerySet.as_manager()
 
+    class Meta:
+        # The public registration index is a partial index, so it is created
+        # in the 0009_indexes migration
+        index_together = (
+            ('source', 'created_at'),
+            ('language', 'created_at'),
+        )
+
+    @classmethod
+    def get_data_fields(cls, data):
+        """
+        Returns the values of the typed fields for the registration data.
+        """
+        return get_data_fields(cls, data)
+
+    def save(self, *args, **kwargs):
+        for name, value in self.get_data_fields(self.data).items():
+            setattr(self, name, value)
+        return super(Registration, self).save(*args, **kwargs)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Registration, cls).from_db(db, field_names, values)
+        # Remember the stored validation status, so that the rollup can be
+        # updated when the registration gets validated
+        instance._rollup_validated = dict(
+            zip(field_names, values)).get('validated')
+        return instance
+
     def __str__(self):
         return str(self.id)
 
 
+def get_data_fields(model, data):
+    """
+    Returns the values of the typed fields of the registration model for the
+    registration data. Dates are stored in data in the YYYYMMDD format.
+    Takes the model so that migrations can use it with the historical model.
+    """
+    data = data or {}
+    fields = {}
+    for name in Registration.DATA_FIELDS:
+        field = model._meta.get_field(name)
+        value = data.get(name)
+        try:
+            if (isinstance(field, models.DateField) and
+                    isinstance(value, six.string_types)):
+                value = datetime.strptime(value, "%Y%m%d").date()
+            else:
+                value = field.to_python(value)
+        except (ValueError, ValidationError):
+            value = None
+        if (isinstance(value, six.string_types) and
+                len(value) > field.max_length):
+            value = None
+        fields[name] = value
+    return fields
+
+
+class RegistrationRollupQuerySet(models.QuerySet):
+    def increment(self, amount=1, **key):
+        """
+        Adds amount to the count of the rollup row for the given key, creating
+        the row if it doesn't exist yet.
+        """
+        if self.filter(**key).update(count=F('count') + amount):
+            return
+        try:
+            with transaction.atomic():
+                self.create(count=amount, **key)
+        except IntegrityError:
+            # Another process created the row in the meantime
+            self.filter(**key).update(count=F('count') + amount)
+
+    def total(self, **filters):
+        """
+        Returns the total amount of registrations for the rollup rows that
+        match the given filters.
+        """
+        return self.filter(**filters).aggregate(
+            total=Sum('count'))['total'] or 0
+
+
+@python_2_unicode_compatible
+class RegistrationRollup(models.Model):
+    """ The amount of registrations created in each hour, for each stage,
+    source authority, language and validation status.
+
+    Kept up to date as registrations are created and validated, and can be
+    rebuilt from the registrations with the rebuild_registration_rollup
+    management command.
+    """
+    hour = models.DateTimeField()
+    stage = models.CharField(max_length=30, null=False, blank=False)
+    authority = models.CharField(max_length=30, null=False, blank=False)
+    language = models.CharField(max_length=255, null=False, blank=True)
+    validated = models.BooleanField(default=False)
+    count = models.IntegerField(default=0)
+
+    objects = RegistrationRollupQuerySet.as_manager()
+
+    class Meta:
+        unique_together = (
+            ('hour', 'stage', 'authority', 'language', 'validated'),)
+
+    @classmethod
+    def get_key(cls, registration, validated):
+        """
+        Returns the key of the rollup row that the registration is counted in.
+        """
+        hour = registration.created_at.astimezone(timezone.utc).replace(
+            minute=0, second=0, microsecond=0)
+        return {
+            'hour': hour,
+            'stage': registration.stage,
+            'authority': registration.source.authority,
+            'language': registration.language or '',
+            'validated': validated,
+        }
+
+    def __str__(self):
+        return "%s %s %s %s %s: %s" % (
+            self.hour, self.stage, self.authority, self.language,
+            self.validated, self.count)
+
+
+@receiver(post_save, sender=Registration)
+def update_registration_rollup(sender, instance, created, **kwargs):
+    """ Post save hook to count the Registration in the hourly rollup
+    """
+    previous = getattr(instance, '_rollup_validated', None)
+    if created:
+        RegistrationRollup.objects.increment(
+            **RegistrationRollup.get_key(instance, instance.validated))
+    elif previous is not None and previous != instance.validated:
+        RegistrationRollup.objects.increment(
+            amount=-1, **RegistrationRollup.get_key(instance, previous))
+        RegistrationRollup.objects.increment(
+            **RegistrationRollup.get_key(instance, instance.validated))
+    instance._rollup_validated = instance.validated
+
+
+class MotherProfileQuerySet(models.QuerySet):
+    def get_for_mother(self, mother_id):
+        """
+        Returns the profile of the mother, creating it from her latest
+        registration if it doesn't exist yet. Raises Registration.DoesNotExist
+        if the mother has no registrations.
+        """
+        try:
+            return self.select_related('registration').get(
+                mother_id=mother_id)
+        except self.model.DoesNotExist:
+            pass
+        registration = Registration.objects\
+            .filter(mother_id=mother_id)\
+            .select_related('source')\
+            .order_by('-created_at')\
+            .first()
+        if registration is None:
+            raise Registration.DoesNotExist(
+                "No registration for mother %s" % mother_id)
+        defaults = MotherProfile.get_registration_fields(registration)
+        if registration.validated:
+            defaults['subscribed'] = True
+            defaults['subscription_stage'] = registration.stage
+        profile, _ = self.get_or_create(mother_id=mother_id, defaults=defaults)
+        return profile
+
+    def update_registration(self, registration):
+        """
+        Makes the registration the latest registration of the mother.
+        """
+        defaults = MotherProfile.get_registration_fields(registration)
+        defaults['subscribed'] = False
+        defaults['subscription_stage'] = None
+        self.update_or_create(
+            mother_id=registration.mother_id, defaults=defaults)
+
+    def registration_subscribed(self, registration):
+        """
+        Records that the mother has been subscribed for the registration, if
+        it is her latest registration.
+        """
+        self.filter(
+            mother_id=registration.mother_id, registration=registration,
+        ).update(subscribed=True, subscription_stage=registration.stage,
+                 updated_at=timezone.now())
+
+    def apply_change(self, mother_id, action, data):
+        """
+        Updates the subscription state of the mother for an implemented
+        change.
+        """
+        self.filter(mother_id=mother_id).update(
+            updated_at=timezone.now(),
+            **MotherProfile.get_change_fields(action, data))
+
+
+@python_2_unicode_compatible
+class MotherProfile(models.Model):
+    """ The current state of a mother, projected from her latest registration
+    and the changes made since then, so that it can be looked up by mother_id
+    without searching through the registrations.
+
+    Can be rebuilt with the rebuild_mother_profiles management command.
+
+    Args:
+        registration (object): The mother's latest registration
+        subscribed (bool): True if the mother currently has subscriptions
+        subscription_stage (str): The stage of her current subscriptions
+    """
+    mother_id = models.CharField(max_length=36, unique=True)
+    registration = models.ForeignKey(Registration, related_name='+')
+    stage = models.CharField(max_length=30)
+    authority = models.CharField(max_length=30)
+    msg_receiver = models.CharField(max_length=30, null=True, blank=True)
+    language = models.CharField(max_length=255, null=True, blank=True)
+    subscribed = models.BooleanField(default=False)
+    subscription_stage = models.CharField(
+        max_length=30, null=True, blank=True,
+        choices=Registration.STAGE_CHOICES)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = MotherProfileQuerySet.as_manager()
+
+    @classmethod
+    def get_registration_fields(cls, registration):
+        """
+        Returns the profile fields that come from the registration.
+        """
+        return {
+            'registration': registration,
+            'stage': registration.stage,
+            'authority': registration.source.authority,
+            'msg_receiver': registration.msg_receiver,
+            'language': registration.language,
+        }
+
+    @classmethod
+    def get_change_fields(cls, action, data):
+        """
+        Returns the profile fields that are updated by a change.
+        """
+        return {
+            'change_baby': {'subscribed': True,
+                            'subscription_stage': 'postbirth'},
+            'change_loss': {'subscribed': True, 'subscription_stage': 'loss'},
+            'unsubscribe': {'subscribed': False},
+            'change_language': {
+                'language': (data or {}).get('new_language')},
+        }[action]
+
+    def __str__(self):
+        return self.mother_id
+
+
+@receiver(post_save, sender=Registration)
+def update_mother_profile(sender, instance, created, **kwargs):
+    """ Post save hook to make a new Registration the mother's latest
+    registration
+    """
+    if created:
+        MotherProfile.objects.update_registration(instance)
+
+
 @receiver(post_save, sender=Registration)
 def registration_post_save(sender, instance, created, **kwargs):
     """ Post save hook to fire Registration validation task
     """
     if created:
         from .tasks import validate_registration
-        validate_registration.apply_async(
-            kwargs={"registration_id": str(instance.id)})
+        validate_registration.apply_async(kwargs={
+            "registration_id": str(instance.id),
+            "mother_id": instance.mother_id,
+        })
 
 
 @receiver(post_save, sender=Registration)
@@ -109,7 +396,7 @@ def fire_created_metric(sender, instance, created, **kwargs):
         total_key = 'registrations.created.total.last'
         total = get_or_incr_cache(
             total_key,
-            Registration.objects.count)
+            RegistrationRollup.objects.total)
         fire_metric.apply_async(kwargs={
             'metric_name': total_key,
             'metric_value': total,
@@ -123,9 +410,8 @@ def fire_language_metric(sender, instance, created, **kwargs):
     the registrations over time, and a last metric for the total count.
     """
     from .tasks import fire_metric, is_valid_lang
-    if (created and instance.data and instance.data.get('language') and
-            is_valid_lang(instance.data['language'])):
-        lang = instance.data['language']
+    if created and instance.language and is_valid_lang(instance.language):
+        lang = instance.language
         fire_metric.apply_async(kwargs={
             'metric_name': "registrations.language.%s.sum" % lang,
             'metric_value': 1.0,
@@ -134,7 +420,7 @@ def fire_language_metric(sender, instance, created, **kwargs):
         total_key = "registrations.language.%s.total.last" % lang
         total = get_or_incr_cache(
             total_key,
-            Registration.objects.filter(data__language=lang).count)
+            lambda: RegistrationRollup.objects.total(language=lang))
         fire_metric.apply_async(kwargs={
             'metric_name': total_key,
             'metric_value': total,
@@ -159,7 +445,7 @@ def fire_source_metric(sender, instance, created, **kwargs):
         total_key = "registrations.source.%s.total.last" % source
         total = get_or_incr_cache(
             total_key,
-            Registration.objects.filter(source__authority=source).count)
+            lambda: RegistrationRollup.objects.total(authority=source))
         fire_metric.apply_async(kwargs={
             'metric_name': total_key,
             'metric_value': total,
@@ -220,3 +506,52 @@ class SubscriptionRequest(models.Model):
 
     def __str__(self):
         return str(self.id)
+
+
+@python_2_unicode_compatible
+class MetricsRepopulation(models.Model):
+    """ A run of the historical metrics repopulation, split up into chunks
+    that are generated in parallel. Chunks are marked as completed as they
+    finish, so that a failed run can be resumed from where it stopped.
+    """
+    amqp_url = models.CharField(max_length=255, null=False, blank=False)
+    prefix = models.CharField(max_length=255, null=False, blank=True)
+    graphite_retentions = models.CharField(
+        max_length=255, null=False, blank=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "Repopulation %s (%s)" % (self.id, self.graphite_retentions)
+
+
+@python_2_unicode_compatible
+class MetricsRepopulationChunk(models.Model):
+    """ A part of a metrics repopulation, covering a time range of consecutive
+    buckets of the same precision for some of the metrics.
+    """
+    repopulation = models.ForeignKey(MetricsRepopulation,
+                                     related_name='chunks', null=False)
+    metric_names = JSONField()
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    precision = models.IntegerField(help_text="Bucket size in seconds")
+    completed = models.BooleanField(default=False)
+
+    def get_buckets(self):
+        """
+        Returns a list of the (start, end) tuples of the buckets that this
+        chunk covers, as naive UTC datetimes.
+        """
+        precision = timedelta(seconds=self.precision)
+        start = timezone.make_naive(self.start, timezone.utc)
+        finish = timezone.make_naive(self.end, timezone.utc)
+        buckets = []
+        while start < finish:
+            end = min(start + precision, finish)
+            buckets.append((start, end))
+            start = end
+        return buckets
+
+    def __str__(self):
+        return "%s to %s" % (self.start, self.end)
@@ -0,0 +1,235 @@
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import six
+from django.utils import timezone
+
+from .models import Registration
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def to_timestamp(dt):
+    """
+    Returns the amount of microseconds since the epoch for the datetime.
+    Naive datetimes are assumed to be in UTC.
+    """
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt, timezone.utc)
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def from_timestamp(timestamp):
+    return EPOCH + timedelta(microseconds=timestamp)
+
+
+class RegistrationSnapshot(object):
+    """
+    A columnar on-disk copy of the registrations, for analytics and metric
+    generation without querying the database.
+
+    Each column is a flat binary file of fixed size values, which is memory
+    mapped for reading. Rows are stored in order of creation, so that time
+    ranges can be found with a binary search. String columns are stored as
+    indexes into a dictionary of values, which is kept in the metadata file
+    along with the amount of rows.
+
+    The snapshot is appended to with the registrations created since the
+    previous update. Registrations are only exported once they are older than
+    settle_time, so that they have been validated.
+    """
+    COLUMNS = (
+        ('created_at', 'int64'),
+        ('stage', 'int16'),
+        ('authority', 'int16'),
+        ('language', 'int16'),
+        ('validated', 'bool'),
+        ('reg_type', 'int16'),
+        ('preg_week', 'int16'),
+    )
+    DICTIONARY_COLUMNS = ('stage', 'authority', 'language', 'reg_type')
+    META_FILE = 'meta.json'
+
+    def __init__(self, path, settle_time=timedelta(hours=1)):
+        self.path = path
+        self.settle_time = settle_time
+        self.meta = self.load_meta()
+
+    def get_column_path(self, name):
+        return os.path.join(self.path, '{}.bin'.format(name))
+
+    def load_meta(self):
+        meta_path = os.path.join(self.path, self.META_FILE)
+        if not os.path.exists(meta_path):
+            return {
+                'rows': 0,
+                'exported_until': None,
+                'dictionaries': dict(
+                    (name, ['']) for name in self.DICTIONARY_COLUMNS),
+            }
+        with open(meta_path) as f:
+            return json.load(f)
+
+    def save_meta(self):
+        """
+        Replaces the metadata file, which makes the rows appended since it was
+        last saved visible to readers.
+        """
+        meta_path = os.path.join(self.path, self.META_FILE)
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(self.meta, f)
+        os.rename(meta_path + '.tmp', meta_path)
+
+    def encode_row(self, row, lookups):
+        """
+        Returns the column values of a row of registration values, adding
+        unknown strings to the dictionaries.
+        """
+        values = dict(zip((name for name, _ in self.COLUMNS), row))
+        values['created_at'] = to_timestamp(values['created_at'])
+        for name in self.DICTIONARY_COLUMNS:
+            value = values[name]
+            value = '' if value is None else six.text_type(value)
+            if value not in lookups[name]:
+                lookups[name][value] = len(self.meta['dictionaries'][name])
+                self.meta['dictionaries'][name].append(value)
+            values[name] = lookups[name][value]
+        try:
+            values['preg_week'] = int(values['preg_week'])
+        except (TypeError, ValueError):
+            values['preg_week'] = -1
+        return [values[name] for name, _ in self.COLUMNS]
+
+    def append(self, rows):
+        """
+        Appends the encoded rows to the column files.
+        """
+        for (name, dtype), values in zip(self.COLUMNS, zip(*rows)):
+            with open(self.get_column_path(name), 'ab') as f:
+                f.write(np.array(values, dtype=dtype).tobytes())
+        self.meta['rows'] += len(rows)
+
+    def truncate(self):
+        """
+        Truncates the column files to the amount of rows in the metadata, to
+        remove any rows left behind by an update that failed.
+        """
+        for name, dtype in self.COLUMNS:
+            column_path = self.get_column_path(name)
+            with open(column_path, 'ab') as f:
+                f.truncate(self.meta['rows'] * np.dtype(dtype).itemsize)
+
+    def update(self, now=None, batch_size=10000):
+        """
+        Appends the registrations created since the previous update, and
+        returns the amount of registrations that were added.
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.truncate()
+
+        until = (now or timezone.now()) - self.settle_time
+        registrations = Registration.objects.filter(created_at__lt=until)
+        if self.meta['exported_until'] is not None:
+            registrations = registrations.filter(
+                created_at__gte=from_timestamp(self.meta['exported_until']))
+        registrations = registrations\
+            .order_by('created_at')\
+            .values_list(
+                'created_at', 'stage', 'source__authority', 'language',
+                'validated', 'reg_type', 'preg_week')
+
+        lookups = dict(
+            (name, dict((v, i) for i, v in enumerate(values)))
+            for name, values in self.meta['dictionaries'].items())
+        rows_before = self.meta['rows']
+        batch = []
+        for row in registrations.iterator():
+            batch.append(self.encode_row(row, lookups))
+            if len(batch) >= batch_size:
+                self.append(batch)
+                batch = []
+        if batch:
+            self.append(batch)
+
+        self.meta['exported_until'] = to_timestamp(until)
+        self.save_meta()
+        return self.meta['rows'] - rows_before
+
+    def rebuild(self, now=None, batch_size=10000):
+        """
+        Removes the existing snapshot, and exports all of the registrations.
+        """
+        self.meta = {
+            'rows': 0,
+            'exported_until': None,
+            'dictionaries': dict(
+                (name, ['']) for name in self.DICTIONARY_COLUMNS),
+        }
+        if os.path.isdir(self.path):
+            self.save_meta()
+        return self.update(now=now, batch_size=batch_size)
+
+    def is_exported(self, dt):
+        """
+        Returns whether all of the registrations created up until and
+        including the datetime have been exported to the snapshot.
+        """
+        return (self.meta['exported_until'] is not None and
+                to_timestamp(dt) < self.meta['exported_until'])
+
+    def column(self, name):
+        """
+        Returns a read only array of the values of the column.
+        """
+        dtype = dict(self.COLUMNS)[name]
+        if self.meta['rows'] == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(
+            self.get_column_path(name), dtype=dtype, mode='r',
+            shape=(self.meta['rows'],))
+
+    def get_mask(self, **filters):
+        """
+        Returns a boolean array of which rows match all of the filters, or
+        None if there are no filters.
+        """
+        mask = None
+        for name, value in filters.items():
+            if name in self.DICTIONARY_COLUMNS:
+                values = self.meta['dictionaries'][name]
+                if value not in values:
+                    return np.zeros(self.meta['rows'], dtype='bool')
+                value = values.index(value)
+            matches = self.column(name) == value
+            mask = matches if mask is None else mask & matches
+        return mask
+
+    def get_bucket_counts(self, buckets, **filters):
+        """
+        Returns the amount of registrations matching the filters created up
+        until the start of the first bucket, and an array of the amount
+        created in each bucket. Buckets include their end but not their
+        start, like the other metric generators.
+
+        args:
+            buckets: List of consecutive (start, end) tuples
+            filters: Column values that the registrations should have, eg.
+                language='eng_UG'
+        """
+        edges = [to_timestamp(buckets[0][0])]
+        edges.extend(to_timestamp(end) for _, end in buckets)
+        indexes = np.searchsorted(
+            self.column('created_at'), np.array(edges, dtype='int64'),
+            side='right')
+
+        mask = self.get_mask(**filters)
+        if mask is None:
+            cumulative = indexes
+        else:
+            cumulative = np.concatenate(([0], np.cumsum(mask)))[indexes]
+        return int(cumulative[0]), np.diff(cumulative)
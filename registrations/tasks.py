@@ -5,16 +5,24 @@ import json
 import uuid
 
 import pika
+from celery import chord
 from django.conf import settings
+from django.core.cache import cache
 from django.db.models import Q
+from django.utils import timezone
 from celery.task import Task
 from celery.utils.log import get_task_logger
 from go_http.metrics import MetricsApiClient
 
-from .models import Registration, SubscriptionRequest
+from .models import (
+    Registration, SubscriptionRequest, MetricsRepopulation,
+    MetricsRepopulationChunk, MotherProfile)
 from familyconnect_registration import utils
 from .graphite import RetentionScheme
-from .metrics import MetricGenerator, send_metric
+from .metrics import (
+    BatchMetricPublisher, HistogramMetricGenerator, MetricGenerator,
+    RollupMetricGenerator, send_metric)
+from .snapshot import RegistrationSnapshot
 
 
 logger = get_task_logger(__name__)
@@ -307,6 +315,7 @@ class ValidateRegistration(Task):
         if reg_validates:
             validation_string += "Success"
             self.create_subscriptionrequests(registration)
+            MotherProfile.objects.registration_subscribed(registration)
         else:
             validation_string += "Failure"
 
@@ -347,7 +356,13 @@ def deliver_hook_wrapper(target, payload, instance, hook):
 
 
 class SendLocationReminders(Task):
-    def send_location_reminder(self, recipient, language):
+    """
+    Sends a reminder SMS to the receivers of the registrations that don't
+    have their location set, fanned out across chunked tasks.
+    """
+    name = 'registrations.tasks.send_location_reminders'
+
+    def send_location_reminder(self, recipient, language, session=None):
         """
         Sends a location reminder to the receiver specified by the registration
         """
@@ -355,36 +370,102 @@ class SendLocationReminders(Task):
             settings,
             'LOCATION_UPDATE_REMINDER_TEXT_{}'.format(language.upper()))
         utils.post_message({
-            'to_addr': utils.get_identity_address(recipient),
+            'to_addr': utils.get_identity_address(recipient, session=session),
             'content': content,
             'metadata': {},
-        })
+        }, session=session)
 
-    def run(self, **kwargs):
+    def get_registrations(self):
         """
-        Looks up registrations that don't have their location set, and sends
-        a reminder SMS to the receiver to update their location.
+        Returns the validated public registrations that don't have their
+        location set.
         """
-        l = self.get_logger(**kwargs)
-        l.info("Looking up registrations that don't have locations")
-
-        registrations = Registration.objects \
+        return Registration.objects \
             .validated() \
             .public_registrations() \
-            .filter(
-                ~Q(data__has_key='parish') |
-                Q(data__contains={'parish': None}) |
-                Q(data__contains={'parish': ""})
-            )
+            .filter(Q(parish__isnull=True) | Q(parish=""))
 
-        for registration in registrations:
-            self.send_location_reminder(
-                registration.data['receiver_id'],
-                registration.data['language'])
+    def get_reminders(self):
+        """
+        Returns an iterator over the (receiver_id, language) of the
+        registrations that don't have their location set, with each receiver
+        only once. Only those columns are loaded, a batch at a time.
+        """
+        receivers = set()
+        reminders = self.get_registrations() \
+            .filter(receiver_id__isnull=False) \
+            .order_by() \
+            .values_list('receiver_id', 'language') \
+            .iterator()
+        for receiver_id, language in reminders:
+            if receiver_id not in receivers:
+                receivers.add(receiver_id)
+                yield receiver_id, language
+
+    def run(self, chunk_size=None, **kwargs):
+        """
+        Looks up registrations that don't have their location set, and queues
+        send_location_reminder_chunk tasks for chunks of their receivers.
+
+        chunk_size:   the amount of reminders sent by each task, defaults to
+                      LOCATION_REMINDER_CHUNK_SIZE
+        """
+        l = self.get_logger(**kwargs)
+        l.info("Looking up registrations that don't have locations")
+        if chunk_size is None:
+            chunk_size = settings.LOCATION_REMINDER_CHUNK_SIZE
+
+        reminders, chunk, tasks = 0, [], 0
+        for reminder in self.get_reminders():
+            chunk.append(reminder)
+            if len(chunk) >= chunk_size:
+                send_location_reminder_chunk.apply_async(
+                    kwargs={"reminders": chunk})
+                reminders += len(chunk)
+                chunk = []
+                tasks += 1
+        if chunk:
+            send_location_reminder_chunk.apply_async(
+                kwargs={"reminders": chunk})
+            reminders += len(chunk)
+            tasks += 1
+
+        return "Queued %s location reminders in %s tasks" % (reminders, tasks)
 
 send_location_reminders = SendLocationReminders()
 
 
+class SendLocationReminderChunk(Task):
+    """
+    Sends location reminders to a chunk of receivers concurrently, reusing
+    the connections to the identity store and message sender.
+    """
+    name = 'registrations.tasks.send_location_reminder_chunk'
+
+    def run(self, reminders, **kwargs):
+        """
+        reminders:   list of (receiver_id, language) to send reminders to
+        """
+        session = utils.get_session()
+        results = utils.run_concurrently((
+            (send_location_reminders.send_location_reminder,
+             (receiver_id, language, session))
+            for receiver_id, language in reminders), raise_errors=False)
+
+        failed = 0
+        for (receiver_id, language), result in zip(reminders, results):
+            if isinstance(result, Exception):
+                logger.warning(
+                    "Failed to send location reminder to <%s>: %s" % (
+                        receiver_id, result))
+                failed += 1
+
+        return "Sent %s location reminders, %s failed" % (
+            len(reminders) - failed, failed)
+
+send_location_reminder_chunk = SendLocationReminderChunk()
+
+
 def get_metric_client(session=None):
     return MetricsApiClient(
         auth_token=settings.METRICS_AUTH_TOKEN,
@@ -411,6 +492,51 @@ class FireMetric(Task):
 fire_metric = FireMetric()
 
 
+class ScheduledMetrics(Task):
+    """
+    Fires all of the realtime total metrics in a single batch, generated
+    from the hourly registration rollup. The sum metrics aren't fired,
+    because they are already fired for each registration as it is created.
+    """
+    name = 'registrations.tasks.scheduled_metrics'
+    period = datetime.timedelta(hours=1)
+
+    def run(self, **kwargs):
+        end = timezone.now().replace(minute=0, second=0, microsecond=0)
+        start = end - self.period
+        metrics = dict(
+            (name, value) for name, value in
+            RollupMetricGenerator().generate_metrics(start, end).items()
+            if name.endswith('.total.last'))
+
+        # Keep the cached totals used by the realtime metrics in sync
+        cache.set_many(metrics)
+
+        metric_client = get_metric_client()
+        metric_client.fire(
+            dict((name, float(value)) for name, value in metrics.items()))
+        return "Fired %s scheduled metrics" % len(metrics)
+
+scheduled_metrics = ScheduledMetrics()
+
+
+class UpdateRegistrationSnapshot(Task):
+    """
+    Appends the newly created registrations to the registration snapshot, if
+    a snapshot path is configured.
+    """
+    name = 'registrations.tasks.update_registration_snapshot'
+
+    def run(self, **kwargs):
+        if not settings.REGISTRATION_SNAPSHOT_PATH:
+            return "Registration snapshot is disabled"
+        snapshot = RegistrationSnapshot(settings.REGISTRATION_SNAPSHOT_PATH)
+        added = snapshot.update()
+        return "Added %s registrations to the snapshot" % added
+
+update_registration_snapshot = UpdateRegistrationSnapshot()
+
+
 class RepopulateMetrics(Task):
     """
     Repopulates historical metrics.
@@ -427,19 +553,158 @@ class RepopulateMetrics(Task):
         timestamp = start + (end - start) / 2
         send_metric(amqp_url, prefix, metric_name, value, timestamp)
 
+    def generate_and_send_histogram(
+            self, publisher, metric_names, buckets, generator=None):
+        """
+        Generates the values for the specified metrics for a run of
+        consecutive buckets using the histogram generator, or the given
+        generator, and adds them to the publisher's batches.
+        """
+        if generator is None:
+            generator = HistogramMetricGenerator()
+        for metric_name, value, start, end in generator.generate_metrics(
+                metric_names, buckets):
+            timestamp = start + (end - start) / 2
+            publisher.publish(metric_name, value, timestamp)
+
+    def format_stats(self, publisher):
+        return "Published %(points)s metrics in %(messages)s messages " \
+            "(%(points_per_second).1f metrics/s)" % publisher.get_stats()
+
     def run(
             self, amqp_url, prefix, metric_names, graphite_retentions,
-            **kwargs):
+            histogram=False, **kwargs):
+        """
+        histogram: If True, generates the metrics with a few grouped queries
+            per retention, instead of a query per metric per bucket, and
+            publishes them in confirmed batches.
+        """
+        l = self.get_logger(**kwargs)
         parameters = pika.URLParameters(amqp_url)
         connection = pika.BlockingConnection(parameters)
         amqp_channel = connection.channel()
 
         ret = RetentionScheme(graphite_retentions)
-        for start, end in ret.get_buckets():
-            for metric in metric_names:
-                self.generate_and_send(
-                    amqp_channel, prefix, metric, start, end)
+        if histogram:
+            publisher = BatchMetricPublisher(amqp_channel, prefix)
+            for buckets in ret.get_retention_buckets():
+                self.generate_and_send_histogram(
+                    publisher, metric_names, buckets)
+            publisher.flush()
+            l.info(self.format_stats(publisher))
+        else:
+            for start, end in ret.get_buckets():
+                for metric in metric_names:
+                    self.generate_and_send(
+                        amqp_channel, prefix, metric, start, end)
 
         connection.close()
 
 repopulate_metrics = RepopulateMetrics()
+
+
+class RepopulateMetricsChunk(Task):
+    """
+    Repopulates the historical metrics for one chunk of a metrics
+    repopulation, and marks the chunk as completed.
+    """
+    name = 'registrations.tasks.repopulate_metrics_chunk'
+
+    def run(self, chunk_id, **kwargs):
+        l = self.get_logger(**kwargs)
+        chunk = MetricsRepopulationChunk.objects\
+            .select_related('repopulation')\
+            .get(id=chunk_id)
+        if chunk.completed:
+            return "Chunk %s already completed" % chunk_id
+
+        parameters = pika.URLParameters(chunk.repopulation.amqp_url)
+        connection = pika.BlockingConnection(parameters)
+        amqp_channel = connection.channel()
+
+        publisher = BatchMetricPublisher(
+            amqp_channel, chunk.repopulation.prefix)
+        repopulate_metrics.generate_and_send_histogram(
+            publisher, chunk.metric_names, chunk.get_buckets())
+        publisher.flush()
+        l.info("Chunk %s: %s" % (
+            chunk_id, repopulate_metrics.format_stats(publisher)))
+
+        connection.close()
+
+        chunk.completed = True
+        chunk.save(update_fields=['completed'])
+        return "Chunk %s completed" % chunk_id
+
+repopulate_metrics_chunk = RepopulateMetricsChunk()
+
+
+class FinishMetricsRepopulation(Task):
+    """
+    Logs the result of a metrics repopulation once all of its chunks have
+    been run.
+    """
+    name = 'registrations.tasks.finish_metrics_repopulation'
+
+    def run(self, repopulation_id, **kwargs):
+        l = self.get_logger(**kwargs)
+        repopulation = MetricsRepopulation.objects.get(id=repopulation_id)
+        total = repopulation.chunks.count()
+        completed = repopulation.chunks.filter(completed=True).count()
+        l.info("Metrics repopulation %s completed %s of %s chunks" % (
+            repopulation_id, completed, total))
+        return completed == total
+
+finish_metrics_repopulation = FinishMetricsRepopulation()
+
+
+def start_metrics_repopulation(
+        amqp_url, prefix, metric_names, graphite_retentions,
+        buckets_per_chunk=1000, metrics_per_chunk=None):
+    """
+    Splits the repopulation of the given metrics up into chunks of at most
+    buckets_per_chunk buckets and metrics_per_chunk metrics, and runs the
+    chunks in parallel across the workers.
+    """
+    metrics_per_chunk = metrics_per_chunk or len(metric_names)
+    repopulation = MetricsRepopulation.objects.create(
+        amqp_url=amqp_url, prefix=prefix,
+        graphite_retentions=graphite_retentions)
+
+    chunks = []
+    ret = RetentionScheme(graphite_retentions)
+    for buckets in ret.get_retention_buckets():
+        if not buckets:
+            continue
+        precision = buckets[0][1] - buckets[0][0]
+        for i in range(0, len(buckets), buckets_per_chunk):
+            start = buckets[i][0]
+            end = buckets[i:i + buckets_per_chunk][-1][1]
+            for j in range(0, len(metric_names), metrics_per_chunk):
+                chunks.append(MetricsRepopulationChunk(
+                    repopulation=repopulation,
+                    metric_names=metric_names[j:j + metrics_per_chunk],
+                    start=timezone.make_aware(start, timezone.utc),
+                    end=timezone.make_aware(end, timezone.utc),
+                    precision=int(precision.total_seconds())))
+    MetricsRepopulationChunk.objects.bulk_create(chunks)
+
+    resume_metrics_repopulation(repopulation)
+    return repopulation
+
+
+def resume_metrics_repopulation(repopulation):
+    """
+    Runs all of the chunks of the repopulation that haven't completed yet in
+    parallel, and logs the result once they have all been run.
+    """
+    chunk_ids = list(repopulation.chunks
+                     .filter(completed=False)
+                     .order_by('id')
+                     .values_list('id', flat=True))
+    if not chunk_ids:
+        return finish_metrics_repopulation.apply_async(
+            args=[repopulation.id])
+    return chord(
+        repopulate_metrics_chunk.si(chunk_id) for chunk_id in chunk_ids
+    )(finish_metrics_repopulation.si(repopulation.id))
@@ -172,3 +172,40 @@ class TestGraphiteRetentions(TestCase):
         expected.sort(key=lambda d: d[0])
 
         self.assertEqual(buckets, expected)
+
+    def test_get_retention_buckets(self):
+        """
+        The get_retention_buckets function should return a list of
+        consecutive buckets for each of the retentions, with no overlap
+        between the retentions.
+        """
+        ret = RetentionScheme('30s:1m,1m:3m')
+        now = datetime(2016, 10, 26, 12, 00, 00)
+        buckets = list(ret.get_retention_buckets(now=now))
+
+        expected = [
+            # 30 second accuracy
+            [
+                (
+                    datetime(2016, 10, 26, 11, 59, 00),
+                    datetime(2016, 10, 26, 11, 59, 30)
+                ),
+                (
+                    datetime(2016, 10, 26, 11, 59, 30),
+                    datetime(2016, 10, 26, 12, 00, 00)
+                ),
+            ],
+            # 1 minute accuracy
+            [
+                (
+                    datetime(2016, 10, 26, 11, 57, 00),
+                    datetime(2016, 10, 26, 11, 58, 00)
+                ),
+                (
+                    datetime(2016, 10, 26, 11, 58, 00),
+                    datetime(2016, 10, 26, 11, 59, 00)
+                ),
+            ],
+        ]
+
+        self.assertEqual(buckets, expected)
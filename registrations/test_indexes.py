@@ -0,0 +1,152 @@
+import uuid
+from datetime import datetime, timedelta
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from changes.models import Change
+from changes.views import ChangeFilter
+from uniqueids.models import Record
+from .metrics import MetricGenerator
+from .models import Registration, Source
+from .tasks import send_location_reminders
+from .tests import AuthenticatedAPITestCase
+from .views import RegistrationFilter
+
+
+class QueryPlanTestCase(AuthenticatedAPITestCase):
+    """
+    Checks that the hot lookups can use an index, by looking at their query
+    plans with sequential scans disabled. If no index matches a query, the
+    planner still has to use a sequential scan.
+    """
+    def setUp(self):
+        super(QueryPlanTestCase, self).setUp()
+        user = User.objects.create(username='user1')
+        self.sources = [
+            Source.objects.create(
+                name='Source %s' % authority, authority=authority, user=user)
+            for authority in ('hw_full', 'patient', 'advisor')]
+        self.start = timezone.make_aware(datetime(2016, 1, 1), timezone.utc)
+
+        registrations = []
+        for i in range(300):
+            registrations.append(Registration(
+                mother_id=str(uuid.uuid4()), stage='prebirth',
+                source=self.sources[i % 3], validated=bool(i % 2),
+                language=['eng_UG', 'cgg_UG'][i % 2]))
+        Registration.objects.bulk_create(registrations)
+        Change.objects.bulk_create(
+            Change(mother_id=r.mother_id, action='unsubscribe',
+                   source=r.source) for r in registrations[:100])
+        Record.objects.bulk_create(
+            Record(id=i, identity=uuid.uuid4(), write_to='health_id')
+            for i in range(100))
+
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+            cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def get_plans(self, func):
+        """
+        Returns the query plans of all of the queries made by func.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            func()
+        return [self.explain(query['sql']) for query in queries]
+
+    def explain(self, sql, params=None):
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN " + sql, params)
+            return '\n'.join(row[0] for row in cursor.fetchall())
+
+    def explain_queryset(self, queryset):
+        return self.explain(*queryset.query.sql_with_params())
+
+    def assertUsesIndex(self, plan, table, index=None):
+        self.assertNotIn('Seq Scan on %s' % table, plan)
+        self.assertIn('Index', plan)
+        if index is not None:
+            self.assertIn(index, plan)
+
+
+class RegistrationQueryPlanTests(QueryPlanTestCase):
+    table = 'registrations_registration'
+
+    def test_metric_created(self):
+        start, end = self.start, self.start + timedelta(days=1)
+        for plan in self.get_plans(
+                lambda: MetricGenerator().registrations_created_sum(
+                    start, end)):
+            self.assertUsesIndex(plan, self.table)
+
+    def test_metric_language(self):
+        start, end = self.start, self.start + timedelta(days=1)
+        for plan in self.get_plans(
+                lambda: MetricGenerator().registrations_language_sum(
+                    'eng_UG', start, end)):
+            self.assertUsesIndex(plan, self.table)
+
+    def test_metric_source(self):
+        start, end = self.start, self.start + timedelta(days=1)
+        for plan in self.get_plans(
+                lambda: MetricGenerator().registrations_source_sum(
+                    'patient', start, end)):
+            self.assertUsesIndex(plan, self.table)
+
+    def test_location_reminders(self):
+        plan = self.explain_queryset(
+            send_location_reminders.get_registrations())
+        self.assertUsesIndex(
+            plan, self.table, 'registrations_registration_validated_prebirth')
+
+    def test_filter_mother_id(self):
+        plan = self.explain_queryset(RegistrationFilter(
+            {'mother_id': 'mother01'},
+            queryset=Registration.objects.all()).qs)
+        self.assertUsesIndex(plan, self.table)
+
+    def test_filter_created_after(self):
+        plan = self.explain_queryset(RegistrationFilter(
+            {'created_after': '2016-01-01T00:00:00Z',
+             'created_before': '2016-01-02T00:00:00Z'},
+            queryset=Registration.objects.all()).qs)
+        self.assertUsesIndex(plan, self.table)
+
+    def test_filter_receiver_id(self):
+        plan = self.explain_queryset(RegistrationFilter(
+            {'receiver_id': 'mother01'},
+            queryset=Registration.objects.all()).qs)
+        self.assertUsesIndex(plan, self.table)
+
+    def test_latest_registration_for_mother(self):
+        plan = self.explain_queryset(
+            Registration.objects.filter(mother_id='mother01')
+            .order_by('-created_at'))
+        self.assertUsesIndex(plan, self.table)
+
+
+class ChangeQueryPlanTests(QueryPlanTestCase):
+    table = 'changes_change'
+
+    def test_filter_mother_id(self):
+        plan = self.explain_queryset(ChangeFilter(
+            {'mother_id': 'mother01'}, queryset=Change.objects.all()).qs)
+        self.assertUsesIndex(plan, self.table)
+
+    def test_filter_created_after(self):
+        plan = self.explain_queryset(ChangeFilter(
+            {'created_after': '2016-01-01T00:00:00Z'},
+            queryset=Change.objects.all()).qs)
+        self.assertUsesIndex(plan, self.table)
+
+
+class RecordQueryPlanTests(QueryPlanTestCase):
+    table = 'uniqueids_record'
+
+    def test_identity(self):
+        plan = self.explain_queryset(
+            Record.objects.filter(identity=uuid.uuid4()))
+        self.assertUsesIndex(plan, self.table)
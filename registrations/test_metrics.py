@@ -3,17 +3,46 @@ try:
 except ImportError:
     from unittest import mock
 
-from datetime import datetime
+import gzip
+import os
+import shutil
+import struct
+import tempfile
+from datetime import datetime, timedelta
 from django.contrib.auth.models import User
 from django.test import TestCase
+from django.utils import timezone
+from six.moves import cPickle as pickle
 
-from .metrics import MetricGenerator, send_metric
+from .metrics import (
+    BatchMetricPublisher, GraphiteFileExporter, GroupedMetricGenerator,
+    HistogramMetricGenerator, MetricGenerator, MetricPublishError,
+    RollupMetricGenerator, send_metric)
 from .tests import AuthenticatedAPITestCase
-from .models import Source, Registration
+from .models import Source, Registration, RegistrationRollup
 from familyconnect_registration import utils
 
 
-class MetricsGeneratorTests(AuthenticatedAPITestCase):
+class RegistrationOnMixin(object):
+    """
+    Creates registrations at given times, for testing metrics.
+    """
+    def create_registration_on(self, timestamp, source, **kwargs):
+        """
+        Creates a registration from the source with kwargs as its data.
+        Naive timestamps are assumed to be in UTC.
+        """
+        r = Registration.objects.create(
+            mother_id='motherid', source=source, stage='prebirth',
+            data=kwargs)
+        if timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp, timezone.utc)
+        r.created_at = timestamp
+        r.save()
+        return r
+
+
+class MetricsGeneratorTests(RegistrationOnMixin, AuthenticatedAPITestCase):
 
     def setUp(self):
         super(MetricsGeneratorTests, self).setUp()
@@ -34,13 +63,6 @@ class MetricsGeneratorTests(AuthenticatedAPITestCase):
 
         generator.foo_bar.assert_called_once_with(start, end)
 
-    def create_registration_on(self, timestamp, source, **kwargs):
-        r = Registration.objects.create(
-            mother_id='motherid', source=source, data=kwargs)
-        r.created_at = timestamp
-        r.save()
-        return r
-
     def test_registrations_created_sum(self):
         """
         Should return the amount of registrations in the given timeframe.
@@ -210,6 +232,167 @@ class MetricsGeneratorTests(AuthenticatedAPITestCase):
                 MetricGenerator(), metric.replace('.', '_'))))
 
 
+class GroupedMetricGeneratorTests(
+        RegistrationOnMixin, AuthenticatedAPITestCase):
+
+    def test_generate_metrics(self):
+        """
+        Should return the sum and total values for all of the realtime
+        metrics, where the sum only includes registrations in the timeframe.
+        """
+        user = User.objects.create(username='user1')
+        hw_source = Source.objects.create(
+            name='TestSource', authority='hw_full', user=user)
+        patient_source = Source.objects.create(
+            name='TestSource 2', authority='patient', user=user)
+
+        start = datetime(2016, 10, 15)
+        end = datetime(2016, 10, 25)
+
+        self.create_registration_on(
+            datetime(2016, 10, 14), hw_source, language='eng_UG')  # Before
+        self.create_registration_on(
+            datetime(2016, 10, 20), hw_source, language='cgg_UG')  # During
+        self.create_registration_on(
+            datetime(2016, 10, 25), patient_source,
+            language='eng_UG')  # On
+        self.create_registration_on(
+            datetime(2016, 10, 26), hw_source, language='eng_UG')  # After
+
+        metrics = GroupedMetricGenerator().generate_metrics(start, end)
+
+        self.assertEqual(
+            sorted(metrics.keys()), sorted(utils.get_available_metrics()))
+        self.assertEqual(metrics['registrations.created.sum'], 2)
+        self.assertEqual(metrics['registrations.created.total.last'], 3)
+        self.assertEqual(metrics['registrations.language.eng_UG.sum'], 1)
+        self.assertEqual(
+            metrics['registrations.language.eng_UG.total.last'], 2)
+        self.assertEqual(metrics['registrations.language.cgg_UG.sum'], 1)
+        self.assertEqual(metrics['registrations.language.xog_UG.sum'], 0)
+        self.assertEqual(metrics['registrations.source.hw_full.sum'], 1)
+        self.assertEqual(
+            metrics['registrations.source.hw_full.total.last'], 2)
+        self.assertEqual(
+            metrics['registrations.source.patient.total.last'], 1)
+        self.assertEqual(
+            metrics['registrations.source.advisor.total.last'], 0)
+
+
+class RollupMetricGeneratorTests(AuthenticatedAPITestCase):
+
+    def create_rollup(self, hour, authority, language, count):
+        return RegistrationRollup.objects.create(
+            hour=timezone.make_aware(hour, timezone.utc), stage='prebirth',
+            authority=authority, language=language, count=count)
+
+    def test_generate_metrics(self):
+        """
+        Should return the sum and total values for all of the realtime
+        metrics from the rollup, where the sum only includes the hours from
+        the start up until the end, and the total includes all hours.
+        """
+        start = timezone.make_aware(datetime(2016, 10, 15, 10), timezone.utc)
+        end = timezone.make_aware(datetime(2016, 10, 15, 12), timezone.utc)
+
+        self.create_rollup(datetime(2016, 10, 15, 9), 'hw_full', 'eng_UG', 1)
+        self.create_rollup(datetime(2016, 10, 15, 10), 'hw_full', 'cgg_UG', 2)
+        self.create_rollup(datetime(2016, 10, 15, 11), 'patient', 'eng_UG', 3)
+        self.create_rollup(datetime(2016, 10, 15, 12), 'hw_full', 'eng_UG', 4)
+
+        metrics = RollupMetricGenerator().generate_metrics(start, end)
+
+        self.assertEqual(
+            sorted(metrics.keys()), sorted(utils.get_available_metrics()))
+        self.assertEqual(metrics['registrations.created.sum'], 5)
+        self.assertEqual(metrics['registrations.created.total.last'], 10)
+        self.assertEqual(metrics['registrations.language.eng_UG.sum'], 3)
+        self.assertEqual(
+            metrics['registrations.language.eng_UG.total.last'], 8)
+        self.assertEqual(metrics['registrations.language.cgg_UG.sum'], 2)
+        self.assertEqual(metrics['registrations.source.hw_full.sum'], 2)
+        self.assertEqual(
+            metrics['registrations.source.hw_full.total.last'], 7)
+        self.assertEqual(
+            metrics['registrations.source.advisor.total.last'], 0)
+
+
+class HistogramMetricGeneratorTests(
+        RegistrationOnMixin, AuthenticatedAPITestCase):
+
+    def create_registrations(self):
+        user = User.objects.create(username='user1')
+        hw_source = Source.objects.create(
+            name='TestSource', authority='hw_full', user=user)
+        patient_source = Source.objects.create(
+            name='TestSource 2', authority='patient', user=user)
+
+        self.create_registration_on(
+            datetime(2016, 10, 14), hw_source, language='eng_UG')
+        self.create_registration_on(
+            datetime(2016, 10, 15), hw_source, language='eng_UG')
+        self.create_registration_on(
+            datetime(2016, 10, 16, 12), patient_source, language='cgg_UG')
+        self.create_registration_on(
+            datetime(2016, 10, 17), hw_source, language='cgg_UG')
+        self.create_registration_on(
+            datetime(2016, 10, 18, 6), patient_source, language='eng_UG')
+        self.create_registration_on(
+            datetime(2016, 10, 19), hw_source, language='eng_UG')
+
+    def test_generate_metrics_matches_metric_generator(self):
+        """
+        The histogram generator should produce the same values for every
+        bucket as the per bucket MetricGenerator, including on the bucket
+        borders and for a shorter last bucket.
+        """
+        self.create_registrations()
+        buckets = [
+            (datetime(2016, 10, 15), datetime(2016, 10, 16)),
+            (datetime(2016, 10, 16), datetime(2016, 10, 17)),
+            (datetime(2016, 10, 17), datetime(2016, 10, 18)),
+            (datetime(2016, 10, 18), datetime(2016, 10, 18, 12)),
+        ]
+        metric_names = utils.get_available_metrics()
+
+        values = list(HistogramMetricGenerator().generate_metrics(
+            metric_names, buckets))
+
+        generator = MetricGenerator()
+        expected = [
+            (name, generator.generate_metric(name, start, end), start, end)
+            for name in metric_names for start, end in buckets]
+        self.assertEqual(values, expected)
+
+    def test_generate_metrics_query_count(self):
+        """
+        The amount of queries should not depend on the amount of buckets or
+        metrics.
+        """
+        self.create_registrations()
+        start = datetime(2016, 10, 14)
+        buckets = [
+            (start + timedelta(minutes=i), start + timedelta(minutes=i + 1))
+            for i in range(60 * 24 * 7)]
+
+        with self.assertNumQueries(2):
+            values = list(HistogramMetricGenerator().generate_metrics(
+                utils.get_available_metrics(), buckets))
+
+        self.assertEqual(
+            len(values), len(buckets) * len(utils.get_available_metrics()))
+        self.assertEqual(
+            sum(v for n, v, s, e in values
+                if n == 'registrations.created.sum'), 5)
+
+    def test_generate_metrics_no_buckets(self):
+        """
+        If there are no buckets, no metrics should be generated.
+        """
+        self.assertEqual(list(HistogramMetricGenerator().generate_metrics(
+            ['registrations.created.sum'], [])), [])
+
+
 class SendMetricTests(TestCase):
     def test_send_metric(self):
         """
@@ -245,3 +428,123 @@ class SendMetricTests(TestCase):
         self.assertEqual(message, '17.0 1317')
         self.assertEquals(properties.delivery_mode, 2)
         self.assertEquals(properties.content_type, 'text/plain')
+
+
+class BatchMetricPublisherTests(TestCase):
+    def test_publish_batches(self):
+        """
+        Metrics should be published in batches of up to batch_size points,
+        with a persistent message per metric name that has the name as the
+        routing key and "value timestamp" lines, once publisher confirms have
+        been enabled.
+        """
+        channel = mock.MagicMock()
+        channel.basic_publish.return_value = True
+        publisher = BatchMetricPublisher(channel, 'test.prefix', batch_size=3)
+        channel.confirm_delivery.assert_called_once_with()
+
+        for i in range(2):
+            publisher.publish(
+                'foo.bar', i, datetime.utcfromtimestamp(1317 + i))
+        publisher.publish('foo.baz', 5, datetime.utcfromtimestamp(1317))
+        self.assertEqual(channel.basic_publish.call_count, 2)
+        publisher.publish('foo.bar', 2, datetime.utcfromtimestamp(1319))
+        publisher.flush()
+        publisher.flush()
+
+        [(args1, _), (args2, _), (args3, _)] = \
+            channel.basic_publish.call_args_list
+        [exchange, routing_key, message, properties] = args1
+        self.assertEqual(exchange, 'graphite')
+        self.assertEqual(routing_key, 'test.prefix.foo.bar')
+        self.assertEqual(message, '0.0 1317\n1.0 1318')
+        self.assertEqual(properties.delivery_mode, 2)
+        self.assertEqual(properties.content_type, 'text/plain')
+        self.assertEqual(args2[1:3], ('test.prefix.foo.baz', '5.0 1317'))
+        self.assertEqual(args3[1:3], ('test.prefix.foo.bar', '2.0 1319'))
+
+        stats = publisher.get_stats()
+        self.assertEqual(stats['points'], 4)
+        self.assertEqual(stats['messages'], 3)
+
+    def test_publish_not_confirmed(self):
+        """
+        If the broker doesn't confirm a batch, an error should be raised.
+        """
+        channel = mock.MagicMock()
+        channel.basic_publish.return_value = False
+        publisher = BatchMetricPublisher(channel)
+        publisher.publish('foo.bar', 1, datetime.utcfromtimestamp(1317))
+
+        with self.assertRaises(MetricPublishError):
+            publisher.flush()
+        self.assertEqual(publisher.get_stats()['points'], 0)
+
+
+class GraphiteFileExporterTests(TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def read_file(self, filename):
+        with gzip.open(os.path.join(self.output_dir, filename), 'rb') as f:
+            return f.read()
+
+    def test_export_plaintext(self):
+        """
+        Metrics should be written as graphite plaintext lines, split over
+        gzip compressed files of at most points_per_file metrics.
+        """
+        exporter = GraphiteFileExporter(
+            self.output_dir, prefix='test.prefix', points_per_file=2,
+            batch_size=10)
+        for i in range(3):
+            exporter.publish(
+                'foo.bar', i, datetime.utcfromtimestamp(1317 + i))
+        exporter.flush()
+
+        self.assertEqual(
+            sorted(os.listdir(self.output_dir)),
+            ['metrics-00000.txt.gz', 'metrics-00001.txt.gz'])
+        self.assertEqual(
+            self.read_file('metrics-00000.txt.gz'),
+            b'test.prefix.foo.bar 0.0 1317\n'
+            b'test.prefix.foo.bar 1.0 1318\n')
+        self.assertEqual(
+            self.read_file('metrics-00001.txt.gz'),
+            b'test.prefix.foo.bar 2.0 1319\n')
+        self.assertEqual(exporter.get_stats()['points'], 3)
+        self.assertEqual(exporter.get_stats()['files'], 2)
+
+    def test_export_pickle(self):
+        """
+        Metrics should be written as length prefixed pickles of
+        (name, (timestamp, value)) tuples, as used by carbon's pickle
+        protocol.
+        """
+        exporter = GraphiteFileExporter(
+            self.output_dir, export_format='pickle', batch_size=2)
+        for i in range(3):
+            exporter.publish(
+                'foo.bar', i, datetime.utcfromtimestamp(1317 + i))
+        exporter.flush()
+
+        data = self.read_file('metrics-00000.pickle.gz')
+        batches = []
+        while data:
+            [length] = struct.unpack('!L', data[:4])
+            batches.append(pickle.loads(data[4:4 + length]))
+            data = data[4 + length:]
+        self.assertEqual(batches, [
+            [('foo.bar', (1317, 0.0)), ('foo.bar', (1318, 1.0))],
+            [('foo.bar', (1319, 2.0))],
+        ])
+
+    def test_unknown_format(self):
+        """
+        An unknown export format should raise an error.
+        """
+        with self.assertRaises(ValueError):
+            GraphiteFileExporter(self.output_dir, export_format='csv')
@@ -0,0 +1,291 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import override_settings
+from django.utils import timezone
+from django.utils.six import StringIO
+
+from .metrics import HistogramMetricGenerator, SnapshotMetricGenerator
+from .models import Source
+from .snapshot import RegistrationSnapshot, from_timestamp, to_timestamp
+from .tasks import update_registration_snapshot
+from .test_metrics import RegistrationOnMixin
+from .tests import AuthenticatedAPITestCase
+
+
+class RegistrationSnapshotTests(
+        RegistrationOnMixin, AuthenticatedAPITestCase):
+
+    def setUp(self):
+        super(RegistrationSnapshotTests, self).setUp()
+        self.path = os.path.join(tempfile.mkdtemp(), 'snapshot')
+        user = User.objects.create(username='user1')
+        self.hw_source = Source.objects.create(
+            name='TestSource', authority='hw_full', user=user)
+        self.patient_source = Source.objects.create(
+            name='TestSource 2', authority='patient', user=user)
+
+    def tearDown(self):
+        super(RegistrationSnapshotTests, self).tearDown()
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def test_timestamps(self):
+        """
+        Datetimes should be stored as microseconds since the epoch, with
+        naive datetimes in UTC.
+        """
+        dt = datetime(2016, 10, 15, 1, 2, 3, 4)
+        self.assertEqual(to_timestamp(dt), 1476493323000004)
+        self.assertEqual(
+            from_timestamp(to_timestamp(dt)),
+            timezone.make_aware(dt, timezone.utc))
+
+    def test_update(self):
+        """
+        Updating should write the registrations that are older than the
+        settle time to the columns in order of creation, with strings
+        stored as dictionary indexes.
+        """
+        self.create_registration_on(
+            datetime(2016, 10, 15, 12), self.patient_source,
+            language='cgg_UG')
+        self.create_registration_on(
+            datetime(2016, 10, 15, 10), self.hw_source, language='eng_UG',
+            reg_type='hw_pre', preg_week=20)
+        self.create_registration_on(
+            datetime(2016, 10, 15, 13, 30), self.hw_source)  # Too new
+
+        snapshot = RegistrationSnapshot(self.path)
+        added = snapshot.update(now=timezone.make_aware(
+            datetime(2016, 10, 15, 14), timezone.utc))
+
+        self.assertEqual(added, 2)
+        self.assertEqual(snapshot.meta['rows'], 2)
+        self.assertEqual(
+            list(snapshot.column('created_at')), [
+                to_timestamp(datetime(2016, 10, 15, 10)),
+                to_timestamp(datetime(2016, 10, 15, 12))])
+        self.assertEqual(
+            snapshot.meta['dictionaries']['language'],
+            ['', 'eng_UG', 'cgg_UG'])
+        self.assertEqual(list(snapshot.column('language')), [1, 2])
+        self.assertEqual(list(snapshot.column('reg_type')), [1, 0])
+        self.assertEqual(list(snapshot.column('preg_week')), [20, -1])
+        self.assertEqual(list(snapshot.column('validated')), [False, False])
+
+        # The metadata should be stored with the columns
+        snapshot = RegistrationSnapshot(self.path)
+        self.assertEqual(snapshot.meta['rows'], 2)
+        self.assertEqual(
+            list(snapshot.column('authority')), [
+                snapshot.meta['dictionaries']['authority'].index('hw_full'),
+                snapshot.meta['dictionaries']['authority'].index('patient')])
+
+    def test_update_incremental(self):
+        """
+        Updating should only append the registrations created since the
+        previous update, and remove any rows left by a failed update.
+        """
+        self.create_registration_on(
+            datetime(2016, 10, 15, 10), self.hw_source, language='eng_UG')
+        snapshot = RegistrationSnapshot(self.path)
+        snapshot.update(now=timezone.make_aware(
+            datetime(2016, 10, 15, 12), timezone.utc))
+
+        # Partial write from a failed update
+        snapshot.append([[0, 0, 0, 0, False, 0, 0]])
+
+        self.create_registration_on(
+            datetime(2016, 10, 15, 11, 30), self.hw_source,
+            language='xog_UG')
+        snapshot = RegistrationSnapshot(self.path)
+        added = snapshot.update(now=timezone.make_aware(
+            datetime(2016, 10, 15, 13), timezone.utc))
+
+        self.assertEqual(added, 1)
+        self.assertEqual(
+            [snapshot.meta['dictionaries']['language'][i]
+             for i in snapshot.column('language')], ['eng_UG', 'xog_UG'])
+        self.assertEqual(
+            os.path.getsize(snapshot.get_column_path('created_at')), 2 * 8)
+
+    def test_rebuild(self):
+        """
+        Rebuilding should replace the snapshot with all of the
+        registrations.
+        """
+        self.create_registration_on(
+            datetime(2016, 10, 15, 10), self.hw_source, language='eng_UG')
+        snapshot = RegistrationSnapshot(self.path)
+        snapshot.update()
+        added = snapshot.rebuild()
+
+        self.assertEqual(added, 1)
+        self.assertEqual(RegistrationSnapshot(self.path).meta['rows'], 1)
+
+    def test_empty_snapshot(self):
+        """
+        A snapshot that hasn't been updated yet should have no rows.
+        """
+        snapshot = RegistrationSnapshot(self.path)
+        self.assertEqual(len(snapshot.column('created_at')), 0)
+        before, counts = snapshot.get_bucket_counts(
+            [(datetime(2016, 10, 15), datetime(2016, 10, 16))],
+            language='eng_UG')
+        self.assertEqual(before, 0)
+        self.assertEqual(list(counts), [0])
+
+    def test_get_bucket_counts(self):
+        """
+        Should return the amount of matching registrations before the first
+        bucket, and in each of the buckets, including the bucket end but not
+        the start.
+        """
+        for day, source, language in (
+                (14, self.hw_source, 'eng_UG'),
+                (15, self.hw_source, 'eng_UG'),
+                (16, self.patient_source, 'eng_UG'),
+                (16, self.hw_source, 'cgg_UG'),
+                (17, self.hw_source, 'eng_UG')):
+            self.create_registration_on(
+                datetime(2016, 10, day), source, language=language)
+        snapshot = RegistrationSnapshot(self.path)
+        snapshot.update()
+        buckets = [
+            (datetime(2016, 10, 15), datetime(2016, 10, 16)),
+            (datetime(2016, 10, 16), datetime(2016, 10, 17)),
+        ]
+
+        before, counts = snapshot.get_bucket_counts(buckets)
+        self.assertEqual((before, list(counts)), (2, [2, 1]))
+
+        before, counts = snapshot.get_bucket_counts(
+            buckets, language='eng_UG', authority='hw_full')
+        self.assertEqual((before, list(counts)), (2, [0, 1]))
+
+        before, counts = snapshot.get_bucket_counts(
+            buckets, language='xog_UG')
+        self.assertEqual((before, list(counts)), (0, [0, 0]))
+
+    def test_snapshot_metric_generator(self):
+        """
+        The snapshot metric generator should generate the same metrics as the
+        histogram generator does from the database.
+        """
+        for hour, source, language in (
+                (1, self.hw_source, 'eng_UG'),
+                (3, self.patient_source, 'cgg_UG'),
+                (4, self.hw_source, 'eng_UG'),
+                (4, self.hw_source, None),
+                (7, self.patient_source, 'eng_UG')):
+            self.create_registration_on(
+                datetime(2016, 10, 15, hour), source, language=language)
+        snapshot = RegistrationSnapshot(self.path)
+        snapshot.update()
+
+        metric_names = [
+            'registrations.created.sum',
+            'registrations.created.total.last',
+            'registrations.language.eng_UG.sum',
+            'registrations.language.eng_UG.total.last',
+            'registrations.source.patient.total.last',
+        ]
+        buckets = [
+            (datetime(2016, 10, 15, h), datetime(2016, 10, 15, h + 2))
+            for h in range(2, 8, 2)]
+
+        self.assertEqual(
+            list(SnapshotMetricGenerator(snapshot).generate_metrics(
+                metric_names, buckets)),
+            list(HistogramMetricGenerator().generate_metrics(
+                metric_names, buckets)))
+
+    def test_snapshot_metric_generator_not_exported(self):
+        """
+        The snapshot metric generator should skip the buckets that end after
+        the registrations that have been exported to the snapshot.
+        """
+        self.create_registration_on(
+            datetime(2016, 10, 15, 10), self.hw_source, language='eng_UG')
+        snapshot = RegistrationSnapshot(self.path)
+        snapshot.update(now=timezone.make_aware(
+            datetime(2016, 10, 15, 13), timezone.utc))
+        buckets = [
+            (datetime(2016, 10, 15, h), datetime(2016, 10, 15, h + 1))
+            for h in range(9, 14)]
+
+        self.assertEqual(
+            list(SnapshotMetricGenerator(snapshot).generate_metrics(
+                ['registrations.created.total.last'], buckets)),
+            [('registrations.created.total.last', total, start, end)
+             for total, (start, end) in zip([1, 1], buckets)])
+
+        self.assertEqual(list(SnapshotMetricGenerator(
+            RegistrationSnapshot(self.path + '2')).generate_metrics(
+                ['registrations.created.total.last'], buckets)), [])
+
+    def test_update_command(self):
+        """
+        The command should update the snapshot, and report the amount of
+        registrations added.
+        """
+        self.create_registration_on(
+            datetime(2016, 10, 15, 10), self.hw_source, language='eng_UG')
+        stdout = StringIO()
+        call_command(
+            'update_registration_snapshot', '--path', self.path,
+            stdout=stdout)
+        self.assertEqual(
+            stdout.getvalue().strip(),
+            "Added 1 registrations, the snapshot has 1 registrations")
+
+    def test_update_task(self):
+        """
+        The task should update the configured snapshot, and do nothing if
+        there is no snapshot configured.
+        """
+        self.create_registration_on(
+            datetime(2016, 10, 15, 10), self.hw_source, language='eng_UG')
+
+        with override_settings(REGISTRATION_SNAPSHOT_PATH=None):
+            result = update_registration_snapshot.apply_async()
+        self.assertEqual(result.get(), "Registration snapshot is disabled")
+
+        with override_settings(REGISTRATION_SNAPSHOT_PATH=self.path):
+            result = update_registration_snapshot.apply_async()
+        self.assertEqual(
+            result.get(), "Added 1 registrations to the snapshot")
+        self.assertEqual(RegistrationSnapshot(self.path).meta['rows'], 1)
+
+    def test_export_metrics_from_snapshot(self):
+        """
+        The export_metrics command should be able to generate the metrics
+        from a snapshot, skipping the buckets that the snapshot doesn't
+        cover yet.
+        """
+        self.create_registration_on(
+            datetime(2016, 10, 15, 10), self.hw_source, language='eng_UG')
+        RegistrationSnapshot(self.path).update(
+            now=timezone.now() + timedelta(hours=2))
+        output_dir = os.path.join(os.path.dirname(self.path), 'output')
+        os.makedirs(output_dir)
+        stdout = StringIO()
+        call_command(
+            'export_metrics', output_dir, '--retentions', '1m:5m',
+            '--metric', 'registrations.created.total.last',
+            '--snapshot', self.path, stdout=stdout)
+        self.assertIn('Wrote 5 metrics to 1 files', stdout.getvalue())
+
+        RegistrationSnapshot(self.path).rebuild()
+        stdout = StringIO()
+        call_command(
+            'export_metrics', output_dir, '--retentions', '1m:5m',
+            '--metric', 'registrations.created.total.last',
+            '--snapshot', self.path, stdout=stdout)
+        self.assertIn('Wrote 0 metrics', stdout.getvalue())
+        self.assertIn(
+            'only covers registrations created before', stdout.getvalue())
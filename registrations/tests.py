@@ -1,10 +1,21 @@
-﻿import json
+﻿import gzip
+import importlib
+import json
+import os
+import shutil
+import tempfile
+import time
 import uuid
+import zlib
 from datetime import timedelta, datetime
 import responses
 
+from django.apps import apps
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import TestCase
+from django.db import connection
 from django.db.models.signals import post_save
 from django.conf import settings
 from django.core.cache import cache
@@ -20,21 +31,31 @@ try:
 except ImportError:
     from urlparse import urlparse
 
+from django.utils.six import StringIO
+from django.utils import timezone
+
 try:
-    from unittest.mock import patch
+    from unittest.mock import ANY, Mock, patch
 except ImportError:
-    from mock import patch
+    from mock import ANY, Mock, patch
 
 from registrations import tasks
 from .models import (Source, Registration, SubscriptionRequest,
-                     registration_post_save, fire_created_metric,
-                     fire_language_metric, fire_source_metric)
+                     MetricsRepopulation, RegistrationRollup, MotherProfile,
+                     registration_post_save, update_registration_rollup,
+                     update_mother_profile,
+                     fire_created_metric, fire_language_metric,
+                     fire_source_metric)
 from .tasks import (
     validate_registration, send_location_reminders,
+    send_location_reminder_chunk,
     is_valid_date, is_valid_uuid, is_valid_lang, is_valid_msg_type,
     is_valid_msg_receiver, is_valid_loss_reason, is_valid_name,
-    repopulate_metrics)
+    repopulate_metrics, start_metrics_repopulation,
+    resume_metrics_repopulation)
 from familyconnect_registration import utils
+from familyconnect_registration.routers import (
+    MotherShardRouter, get_mother_shard_queue)
 
 
 def override_get_today():
@@ -191,6 +212,10 @@ class AuthenticatedAPITestCase(APITestCase):
         assert has_listeners(), (
             "Registration model has no post_save listeners. Make sure"
             " helpers cleaned up properly in earlier tests.")
+        post_save.disconnect(receiver=update_registration_rollup,
+                             sender=Registration)
+        post_save.disconnect(receiver=update_mother_profile,
+                             sender=Registration)
         post_save.disconnect(receiver=registration_post_save,
                              sender=Registration)
         post_save.disconnect(receiver=model_saved,
@@ -209,6 +234,10 @@ class AuthenticatedAPITestCase(APITestCase):
         assert not has_listeners(), (
             "Registration model still has post_save listeners. Make sure"
             " helpers removed them properly in earlier tests.")
+        post_save.connect(receiver=update_registration_rollup,
+                          sender=Registration)
+        post_save.connect(receiver=update_mother_profile,
+                          sender=Registration)
         post_save.connect(registration_post_save, sender=Registration)
         post_save.connect(receiver=fire_created_metric, sender=Registration)
         post_save.connect(receiver=fire_language_metric, sender=Registration)
@@ -560,6 +589,22 @@ class TestRegistrationAPI(AuthenticatedAPITestCase):
         result = response.data["results"][0]
         self.assertEqual(result["id"], str(registration1.id))
 
+    def test_filter_registration_language(self):
+        # Setup
+        registration1, registration2 = self.make_different_registrations()
+        registration2.data["language"] = "cgg_UG"
+        registration2.save()
+        # Execute
+        response = self.adminclient.get(
+            '/api/v1/registrations/?language=%s' %
+            registration1.data["language"],
+            content_type='application/json')
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["count"], 1)
+        result = response.data["results"][0]
+        self.assertEqual(result["id"], str(registration1.id))
+
     def test_filter_registration_stage(self):
         # Setup
         registration1, registration2 = self.make_different_registrations()
@@ -1327,6 +1372,88 @@ class TestRegistrationModel(AuthenticatedAPITestCase):
         [reg] = Registration.objects.public_registrations()
         self.assertEqual(reg.pk, r1.pk)
 
+    def test_data_fields(self):
+        """
+        The typed fields should be set from the registration data when the
+        registration is saved, with values that don't fit the field stored
+        as null.
+        """
+        registration = Registration.objects.create(
+            stage='prebirth', mother_id='mother01',
+            source=self.make_source_adminuser(), data={
+                'language': 'eng_UG',
+                'receiver_id': 'mother01',
+                'msg_receiver': 'mother_to_be',
+                'last_period_date': '20150202',
+                'preg_week': '20',
+                'parish': ['not', 'a', 'parish'],
+                'reg_type': 'x' * 31,
+            })
+        registration = Registration.objects.get(id=registration.id)
+        self.assertEqual(registration.language, 'eng_UG')
+        self.assertEqual(registration.receiver_id, 'mother01')
+        self.assertEqual(registration.hoh_id, None)
+        self.assertEqual(registration.msg_receiver, 'mother_to_be')
+        self.assertEqual(
+            registration.last_period_date, datetime(2015, 2, 2).date())
+        self.assertEqual(registration.preg_week, 20)
+        self.assertEqual(registration.reg_type, None)
+
+        registration.data['last_period_date'] = '2015-02-02'
+        registration.data['reg_type'] = 'hw_pre'
+        registration.save()
+        registration = Registration.objects.get(id=registration.id)
+        self.assertEqual(registration.last_period_date, None)
+        self.assertEqual(registration.reg_type, 'hw_pre')
+
+    def test_backfill_data_fields_command(self):
+        """
+        The backfill command should populate the typed fields of the
+        registrations that are out of date.
+        """
+        r1 = self.make_registration_adminuser()
+        r2 = self.make_registration_normaluser()
+        Registration.objects.filter(id=r1.id).update(
+            language=None, preg_week=3)
+
+        stdout = StringIO()
+        call_command(
+            'backfill_registration_fields', '--batch-size', '1',
+            stdout=stdout)
+
+        self.assertEqual(stdout.getvalue().strip(), "Updated 1 registrations")
+        r1 = Registration.objects.get(id=r1.id)
+        self.assertEqual(r1.language, 'eng_UG')
+        self.assertEqual(r1.preg_week, None)
+        r2 = Registration.objects.get(id=r2.id)
+        self.assertEqual(r2.language, None)
+
+    def test_populate_registration_fields_migration(self):
+        """
+        The migration should populate the typed fields of the existing
+        registrations, and the profile fields that were created before they
+        were populated.
+        """
+        migration = importlib.import_module(
+            'registrations.migrations.0011_populate_registration_fields')
+        registration = self.make_registration_adminuser()
+        registration.data['msg_receiver'] = 'mother_to_be'
+        Registration.objects.filter(id=registration.id).update(
+            data=registration.data, language=None, msg_receiver=None)
+        profile = MotherProfile.objects.create(
+            mother_id=registration.mother_id, registration=registration,
+            stage=registration.stage, authority='hw_partial')
+
+        migration.populate_registration_fields(
+            apps, Mock(connection=connection))
+
+        registration = Registration.objects.get(id=registration.id)
+        self.assertEqual(registration.language, 'eng_UG')
+        self.assertEqual(registration.msg_receiver, 'mother_to_be')
+        profile = MotherProfile.objects.get(id=profile.id)
+        self.assertEqual(profile.language, 'eng_UG')
+        self.assertEqual(profile.msg_receiver, 'mother_to_be')
+
 
 class TestSendLocationRemindersTask(AuthenticatedAPITestCase):
     @responses.activate
@@ -1361,7 +1488,7 @@ class TestSendLocationRemindersTask(AuthenticatedAPITestCase):
     def test_send_locations_task(self):
         """
         The send_locations_reminder task should look up registrations, and send
-        messages to the correct ones.
+        messages to the correct ones, once per receiver, in chunked tasks.
         """
         # Should be called
         r1 = self.make_registration_normaluser()
@@ -1387,16 +1514,65 @@ class TestSendLocationRemindersTask(AuthenticatedAPITestCase):
         r5.validated = True
         r5.data['parish'] = 'Kawaaga'
         r5.save()
+        # Same receiver as r1, shouldn't be called again
+        r6 = self.make_registration_normaluser()
+        r6.validated = True
+        r6.data['receiver_id'] = 'mother01-63e2-4acc-9b94-26663b9bc267'
+        r6.data['language'] = 'eng_UG'
+        r6.save()
 
         with patch.object(send_location_reminders, 'send_location_reminder') \
                 as send_location_reminder:
-            send_location_reminders.run()
+            result = send_location_reminders.apply_async(
+                kwargs={'chunk_size': 1})
 
+        self.assertEqual(
+            result.get(), "Queued 2 location reminders in 2 tasks")
         self.assertEqual(send_location_reminder.call_count, 2)
         send_location_reminder.assert_any_call(
-            'mother01-63e2-4acc-9b94-26663b9bc267', 'eng_UG')
+            'mother01-63e2-4acc-9b94-26663b9bc267', 'eng_UG', ANY)
         send_location_reminder.assert_any_call(
-            'mother03-63e2-4acc-9b94-26663b9bc267', 'cgg_UG')
+            'mother03-63e2-4acc-9b94-26663b9bc267', 'cgg_UG', ANY)
+
+    @responses.activate
+    def test_send_location_reminder_chunk(self):
+        """
+        The chunk task should send the reminders, and carry on if sending
+        one of them fails.
+        """
+        responses.add(
+            responses.POST,
+            'http://localhost:8006/api/v1/outbound/',
+            json={'id': 1})
+        responses.add(
+            responses.GET,
+            ('http://localhost:8001/api/v1/identities/%s/addresses/msisdn?'
+             'default=True') % 'mother01-63e2-4acc-9b94-26663b9bc267',
+            json={"results": [{"address": "+4321"}]},
+            match_querystring=True,
+        )
+        responses.add(
+            responses.GET,
+            ('http://localhost:8001/api/v1/identities/%s/addresses/msisdn?'
+             'default=True') % 'mother03-63e2-4acc-9b94-26663b9bc267',
+            status=500, body='Error',
+            match_querystring=True,
+        )
+
+        result = send_location_reminder_chunk.apply_async(kwargs={
+            'reminders': [
+                ['mother01-63e2-4acc-9b94-26663b9bc267', 'eng_UG'],
+                ['mother03-63e2-4acc-9b94-26663b9bc267', 'cgg_UG'],
+            ]})
+
+        self.assertEqual(
+            result.get(), "Sent 1 location reminders, 1 failed")
+        sms_calls = [
+            call for call in responses.calls
+            if call.request.url.endswith('/outbound/')]
+        self.assertEqual(len(sms_calls), 1)
+        self.assertEqual(
+            json.loads(sms_calls[0].request.body)['to_addr'], '+4321')
 
 
 class TestUserCreation(AuthenticatedAPITestCase):
@@ -1565,6 +1741,7 @@ class TestMetrics(AuthenticatedAPITestCase):
         # Setup
         adapter = self._mount_session()
         # reconnect metric post_save hook
+        post_save.connect(update_registration_rollup, sender=Registration)
         post_save.connect(fire_created_metric, sender=Registration)
 
         # Execute
@@ -1591,6 +1768,7 @@ class TestMetrics(AuthenticatedAPITestCase):
         )
         # remove post_save hooks to prevent teardown errors
         post_save.disconnect(fire_created_metric, sender=Registration)
+        post_save.disconnect(update_registration_rollup, sender=Registration)
 
     def test_language_metric(self):
         """
@@ -1599,6 +1777,7 @@ class TestMetrics(AuthenticatedAPITestCase):
         with a value of 1, and one of type last with the current total.
         """
         adapter = self._mount_session()
+        post_save.connect(update_registration_rollup, sender=Registration)
         post_save.connect(fire_language_metric, sender=Registration)
 
         cache.clear()
@@ -1624,6 +1803,7 @@ class TestMetrics(AuthenticatedAPITestCase):
         )
 
         post_save.disconnect(fire_language_metric, sender=Registration)
+        post_save.disconnect(update_registration_rollup, sender=Registration)
 
     def test_source_metric(self):
         """
@@ -1632,6 +1812,7 @@ class TestMetrics(AuthenticatedAPITestCase):
         with a value of 1, and one of type last with the current total.
         """
         adapter = self._mount_session()
+        post_save.connect(update_registration_rollup, sender=Registration)
         post_save.connect(fire_source_metric, sender=Registration)
 
         cache.clear()
@@ -1657,6 +1838,117 @@ class TestMetrics(AuthenticatedAPITestCase):
         )
 
         post_save.disconnect(fire_source_metric, sender=Registration)
+        post_save.disconnect(update_registration_rollup, sender=Registration)
+
+    def test_scheduled_metrics(self):
+        """
+        The scheduled metrics task should fire all of the realtime total
+        metrics in a single request from the rollup, and update the cached
+        totals. The sum metrics are fired as registrations are created, so
+        they shouldn't be fired again.
+        """
+        adapter = self._mount_session()
+        cache.clear()
+        hour = timezone.now().replace(minute=0, second=0, microsecond=0)
+        for created_hour in (hour, hour - timedelta(hours=1),
+                             hour - timedelta(hours=2)):
+            RegistrationRollup.objects.create(
+                hour=created_hour, stage='prebirth', authority='hw_full',
+                language='eng_UG', validated=True, count=1)
+
+        result = tasks.scheduled_metrics.apply_async()
+
+        [request] = adapter.requests
+        metrics = json.loads(request.body)
+        self.assertEqual(
+            sorted(metrics.keys()),
+            sorted(m for m in utils.get_available_metrics()
+                   if m.endswith('.total.last')))
+        self.assertEqual(metrics['registrations.created.total.last'], 3.0)
+        self.assertEqual(
+            metrics['registrations.language.eng_UG.total.last'], 3.0)
+        self.assertEqual(
+            metrics['registrations.source.hw_full.total.last'], 3.0)
+        self.assertEqual(
+            metrics['registrations.source.patient.total.last'], 0.0)
+        self.assertEqual(cache.get('registrations.created.total.last'), 3)
+        self.assertEqual(
+            result.get(), "Fired %s scheduled metrics" % len(metrics))
+
+
+class TestRegistrationRollup(AuthenticatedAPITestCase):
+
+    def setUp(self):
+        super(TestRegistrationRollup, self).setUp()
+        post_save.connect(update_registration_rollup, sender=Registration)
+
+    def tearDown(self):
+        post_save.disconnect(update_registration_rollup, sender=Registration)
+        super(TestRegistrationRollup, self).tearDown()
+
+    def test_created(self):
+        """
+        Creating registrations should increment the count of the rollup row
+        for the hour, stage, authority, language and validation status.
+        """
+        registration = self.make_registration_adminuser()
+        self.make_registration_adminuser()
+        self.make_registration_normaluser()
+
+        rows = RegistrationRollup.objects.order_by('authority')
+        self.assertEqual([
+            (r.hour, r.stage, r.authority, r.language, r.validated, r.count)
+            for r in rows], [
+            (registration.created_at.replace(
+                minute=0, second=0, microsecond=0),
+             'prebirth', 'hw_full', 'eng_UG', False, 2),
+            (registration.created_at.replace(
+                minute=0, second=0, microsecond=0),
+             'prebirth', 'patient', '', False, 1),
+        ])
+
+    def test_validated(self):
+        """
+        When a registration gets validated, it should move to the validated
+        rollup row, and further saves shouldn't change the counts.
+        """
+        self.make_registration_adminuser()
+        registration = Registration.objects.get()
+        registration.validated = True
+        registration.save()
+        registration.save()
+
+        self.assertEqual(RegistrationRollup.objects.total(), 1)
+        self.assertEqual(
+            RegistrationRollup.objects.total(validated=False), 0)
+        self.assertEqual(
+            RegistrationRollup.objects.total(validated=True), 1)
+
+    def test_rebuild_command(self):
+        """
+        The rebuild command should replace the rollup rows with counts
+        calculated from the registrations.
+        """
+        self.make_registration_adminuser()
+        registration = self.make_registration_normaluser()
+        registration.created_at = registration.created_at - timedelta(
+            hours=2)
+        registration.validated = True
+        registration.save()
+        RegistrationRollup.objects.create(
+            hour=registration.created_at, stage='loss', authority='patient',
+            language='', count=5)
+
+        stdout = StringIO()
+        call_command('rebuild_registration_rollup', stdout=stdout)
+
+        self.assertEqual(stdout.getvalue().strip(), "Rebuilt 2 rollup rows")
+        self.assertEqual(RegistrationRollup.objects.total(), 2)
+        self.assertEqual(RegistrationRollup.objects.total(stage='loss'), 0)
+        [row] = RegistrationRollup.objects.filter(validated=True)
+        self.assertEqual(row.authority, 'patient')
+        self.assertEqual(row.hour, registration.created_at.replace(
+            minute=0, second=0, microsecond=0))
 
 
 class TestRepopulateMetricsTask(TestCase):
@@ -1697,6 +1989,56 @@ class TestRepopulateMetricsTask(TestCase):
         [parameters], _ = mock_pika.BlockingConnection.call_args
         self.assertEqual(parameters, mock_pika.URLParameters.return_value)
 
+    @patch('registrations.tasks.pika')
+    @patch('registrations.tasks.RepopulateMetrics.generate_and_send_histogram')
+    def test_run_repopulate_metrics_histogram(
+            self, mock_repopulate, mock_pika):
+        """
+        When using the histogram generator, the repopulate metrics task should
+        call generate_and_send_histogram once for each retention, with a
+        batch publisher on the amqp channel.
+        """
+        repopulate_metrics.delay(
+            'amqp://test', 'prefix', ['metric.foo', 'metric.bar'],
+            '30s:1m,1m:2m', histogram=True)
+        args = [args for args, _ in mock_repopulate.call_args_list]
+
+        connection = mock_pika.BlockingConnection.return_value
+        channel = connection.channel.return_value
+        [(p1, m1, short), (p2, m2, long)] = args
+        self.assertIs(p1, p2)
+        self.assertEqual(p1.amqp_channel, channel)
+        self.assertEqual(p1.prefix, 'prefix')
+        channel.confirm_delivery.assert_called_once_with()
+        self.assertEqual(m1, ['metric.foo', 'metric.bar'])
+        self.assertEqual(m2, ['metric.foo', 'metric.bar'])
+        self.assertEqual(
+            [e - s for s, e in short], [timedelta(seconds=30)] * 2)
+        self.assertEqual([e - s for s, e in long], [timedelta(seconds=60)])
+        self.assertEqual(long[-1][1], short[0][0])
+
+    @patch('registrations.tasks.HistogramMetricGenerator.generate_metrics')
+    def test_generate_and_send_histogram(self, mock_generate_metrics):
+        """
+        The generate_and_send_histogram function should publish each of the
+        values from the histogram generator, timestamped at the middle of
+        its bucket.
+        """
+        start = datetime.utcfromtimestamp(300.0)
+        end = datetime.utcfromtimestamp(500.0)
+        mock_generate_metrics.return_value = iter([
+            ('foo.sum', 3, start, end), ('foo.total.last', 7, start, end)])
+        publisher = Mock()
+        repopulate_metrics.generate_and_send_histogram(
+            publisher, ['foo.sum', 'foo.total.last'], [(start, end)])
+
+        mock_generate_metrics.assert_called_once_with(
+            ['foo.sum', 'foo.total.last'], [(start, end)])
+        self.assertEqual(publisher.publish.call_args_list, [
+            (('foo.sum', 3, datetime.utcfromtimestamp(400)), {}),
+            (('foo.total.last', 7, datetime.utcfromtimestamp(400)), {}),
+        ])
+
     @patch('registrations.tasks.MetricGenerator.generate_metric')
     @patch('registrations.tasks.send_metric')
     def test_generate_and_send(
@@ -1716,3 +2058,354 @@ class TestRepopulateMetricsTask(TestCase):
         mock_send_metric.assert_called_once_with(
             'amqp://foo', 'prefix', 'foo.bar', 17.2,
             datetime.utcfromtimestamp(400))
+
+
+class TestChunkedRepopulateMetrics(TestCase):
+    @patch('registrations.tasks.pika')
+    @patch('registrations.tasks.RepopulateMetrics.generate_and_send_histogram')
+    def test_start_metrics_repopulation(self, mock_generate, mock_pika):
+        """
+        The repopulation should be split up into chunks of the time range and
+        metrics, which should all be run and marked as completed.
+        """
+        repopulation = start_metrics_repopulation(
+            'amqp://test', 'prefix', ['metric.foo', 'metric.bar'],
+            '30s:2m,1m:3m', buckets_per_chunk=3, metrics_per_chunk=1)
+
+        chunks = repopulation.chunks.order_by('start', 'id')
+        # 4 buckets of 30s and 1 bucket of 1m, for 2 metrics
+        self.assertEqual(chunks.count(), 6)
+        self.assertFalse(chunks.filter(completed=False).exists())
+        self.assertEqual(
+            [len(c.get_buckets()) for c in chunks], [1, 1, 3, 3, 1, 1])
+        self.assertEqual(
+            [c.metric_names for c in chunks[:2]],
+            [['metric.foo'], ['metric.bar']])
+
+        connection = mock_pika.BlockingConnection.return_value
+        channel = connection.channel.return_value
+        self.assertEqual(mock_generate.call_count, 6)
+        for [publisher, _, _], _ in mock_generate.call_args_list:
+            self.assertEqual(publisher.amqp_channel, channel)
+            self.assertEqual(publisher.prefix, 'prefix')
+        self.assertEqual(connection.close.call_count, 6)
+
+        buckets = sorted(
+            b for args, _ in mock_generate.call_args_list
+            for b in args[2] if args[1] == ['metric.foo'])
+        self.assertEqual(
+            [e - s for s, e in buckets],
+            [timedelta(minutes=1)] + [timedelta(seconds=30)] * 4)
+
+    @patch('registrations.tasks.pika')
+    @patch('registrations.tasks.RepopulateMetrics.generate_and_send_histogram')
+    def test_resume_metrics_repopulation(self, mock_generate, mock_pika):
+        """
+        If a chunk fails, the completed chunks should stay completed, and
+        resuming the repopulation should only run the remaining chunks.
+        """
+        mock_generate.side_effect = [None, Exception('Broker down')]
+        with self.assertRaises(Exception):
+            start_metrics_repopulation(
+                'amqp://test', '', ['metric.foo'], '30s:2m',
+                buckets_per_chunk=1)
+
+        repopulation = MetricsRepopulation.objects.get()
+        self.assertEqual(
+            repopulation.chunks.filter(completed=True).count(), 1)
+
+        mock_generate.reset_mock()
+        mock_generate.side_effect = None
+        resume_metrics_repopulation(repopulation)
+
+        self.assertEqual(mock_generate.call_count, 3)
+        self.assertFalse(
+            repopulation.chunks.filter(completed=False).exists())
+
+    @patch('registrations.tasks.pika')
+    @patch('registrations.tasks.RepopulateMetrics.generate_and_send_histogram')
+    def test_admin_shows_progress(self, mock_generate, mock_pika):
+        """
+        The repopulate metrics admin page should show the chunk progress of
+        the repopulations, and allow incomplete ones to be resumed.
+        """
+        user = User.objects.create_superuser(
+            'admin', 'admin@example.org', 'password')
+        self.client.force_login(user)
+        mock_generate.side_effect = [None, Exception('Broker down')]
+        with self.assertRaises(Exception):
+            start_metrics_repopulation(
+                'amqp://test', '', ['metric.foo'], '30s:1m',
+                buckets_per_chunk=1)
+        repopulation = MetricsRepopulation.objects.get()
+
+        response = self.client.get(
+            '/admin/registrations/registration/'
+            'repopulate_registration_metrics/')
+        self.assertContains(response, '1 / 2')
+        self.assertContains(
+            response, 'repopulate_registration_metrics/%s/resume/' % (
+                repopulation.id,))
+
+        mock_generate.side_effect = None
+        response = self.client.post(
+            '/admin/registrations/registration/'
+            'repopulate_registration_metrics/%s/resume/' % repopulation.id)
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertFalse(
+            repopulation.chunks.filter(completed=False).exists())
+
+
+class TestExportMetricsCommand(AuthenticatedAPITestCase):
+    def setUp(self):
+        super(TestExportMetricsCommand, self).setUp()
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(TestExportMetricsCommand, self).tearDown()
+        shutil.rmtree(self.output_dir)
+
+    def test_export_metrics(self):
+        """
+        The export_metrics command should write the generated metrics for
+        every bucket of the retentions to files in the output directory.
+        """
+        self.make_registration_adminuser()
+        stdout = StringIO()
+        call_command(
+            'export_metrics', self.output_dir, '--retentions', '1m:5m',
+            '--metric', 'registrations.created.total.last',
+            '--prefix', 'test', stdout=stdout)
+
+        [filename] = os.listdir(self.output_dir)
+        with gzip.open(os.path.join(self.output_dir, filename), 'rb') as f:
+            lines = f.read().decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 5)
+        names, values, timestamps = zip(*(l.split(' ') for l in lines))
+        self.assertEqual(
+            set(names), set(['test.registrations.created.total.last']))
+        self.assertEqual(values[-1], '1.0')
+        self.assertEqual(sorted(timestamps), list(timestamps))
+        self.assertIn('Wrote 5 metrics to 1 files', stdout.getvalue())
+
+    def test_export_metrics_missing_directory(self):
+        """
+        If the output directory doesn't exist, an error should be raised.
+        """
+        with self.assertRaises(CommandError):
+            call_command(
+                'export_metrics', os.path.join(self.output_dir, 'missing'))
+
+
+class TestPrefetchPages(TestCase):
+
+    def make_get_page(self, pages, calls):
+        def get_page(url):
+            calls.append(url)
+            if isinstance(pages[url], Exception):
+                raise pages[url]
+            return pages[url]
+        return get_page
+
+    def test_pages(self):
+        """
+        Should return each of the pages in order, following the next urls.
+        """
+        calls = []
+        get_page = self.make_get_page({
+            None: {"next": "page2", "results": [1]},
+            "page2": {"next": "page3", "results": [2]},
+            "page3": {"next": None, "results": [3]},
+        }, calls)
+        self.assertEqual(
+            [page["results"] for page in utils.prefetch_pages(get_page)],
+            [[1], [2], [3]])
+        self.assertEqual(calls, [None, "page2", "page3"])
+
+    def test_start_url(self):
+        calls = []
+        get_page = self.make_get_page({
+            "page2": {"next": None, "results": [2]},
+        }, calls)
+        self.assertEqual(
+            [page["results"] for page in utils.prefetch_pages(
+                get_page, "page2")], [[2]])
+
+    def test_error(self):
+        """
+        Errors fetching a page should be raised once the pages before it have
+        been returned.
+        """
+        get_page = self.make_get_page({
+            None: {"next": "page2", "results": [1]},
+            "page2": ValueError("Bad page"),
+        }, [])
+        pages = utils.prefetch_pages(get_page)
+        self.assertEqual(next(pages)["results"], [1])
+        self.assertRaises(ValueError, next, pages)
+
+    def test_bounded(self):
+        """
+        At most buffer_size pages should be fetched ahead, and fetching
+        should stop once the iterator is closed.
+        """
+        calls = []
+        pages = dict(
+            (i or None, {"next": i + 1, "results": [i]}) for i in range(100))
+        pages = utils.prefetch_pages(
+            self.make_get_page(pages, calls), buffer_size=2)
+        next(pages)
+        time.sleep(0.2)
+        self.assertTrue(len(calls) <= 4)
+        pages.close()
+        time.sleep(0.3)
+        fetched = len(calls)
+        time.sleep(0.2)
+        self.assertEqual(len(calls), fetched)
+
+    @responses.activate
+    def test_get_vhts_for_parish(self):
+        """
+        Should return the VHTs from all of the pages of search results.
+        """
+        responses.add(
+            responses.GET,
+            'http://localhost:8001/api/v1/identities/search?'
+            'details__has_key=personnel_code&details_parish=Kawaaga',
+            json={
+                "next": "http://localhost:8001/api/v1/identities/search?"
+                        "cursor=2",
+                "results": [{"id": "vht1"}],
+            }, match_querystring=True)
+        responses.add(
+            responses.GET,
+            'http://localhost:8001/api/v1/identities/search?cursor=2',
+            json={"next": None, "results": [{"id": "vht2"}]},
+            match_querystring=True)
+
+        self.assertEqual(
+            [vht["id"] for vht in utils.get_vhts_for_parish("Kawaaga")],
+            ["vht1", "vht2"])
+
+
+class TestMotherShardRouter(AuthenticatedAPITestCase):
+
+    def test_disabled(self):
+        """
+        If there are no shard queues, tasks shouldn't be routed.
+        """
+        with self.settings(MOTHER_SHARD_QUEUES=0):
+            self.assertEqual(MotherShardRouter().route_for_task(
+                'task', kwargs={'mother_id': 'mother01'}), None)
+
+    def test_route(self):
+        """
+        Tasks with a mother id should be routed to the same shard queue for
+        the same mother, and tasks without a mother id shouldn't be routed.
+        """
+        router = MotherShardRouter()
+        with self.settings(MOTHER_SHARD_QUEUES=4):
+            route = router.route_for_task(
+                'task', kwargs={'mother_id': 'mother01'})
+            self.assertEqual(route, {'queue': 'mother_shard_%d' % (
+                zlib.crc32(b'mother01') % 4)})
+            self.assertEqual(route, router.route_for_task(
+                'other_task', kwargs={'mother_id': 'mother01'}))
+            self.assertEqual(
+                router.route_for_task('task', kwargs={'id': 'mother01'}),
+                None)
+            self.assertEqual(router.route_for_task('task'), None)
+
+            queues = set(
+                get_mother_shard_queue('mother%02d' % i) for i in range(100))
+            self.assertEqual(
+                queues, set('mother_shard_%d' % i for i in range(4)))
+
+    def test_validate_registration_routed(self):
+        """
+        The validation task should be queued with the mother id, so that it
+        is routed to the mother's shard queue.
+        """
+        user = User.objects.create(username='user1')
+        source = Source.objects.create(
+            name='TestSource', authority='hw_full', user=user)
+        post_save.connect(registration_post_save, sender=Registration)
+        try:
+            with patch.object(tasks.validate_registration,
+                              'apply_async') as apply_async:
+                registration = Registration.objects.create(
+                    mother_id='mother01', source=source, stage='prebirth')
+        finally:
+            post_save.disconnect(registration_post_save, sender=Registration)
+        apply_async.assert_called_once_with(kwargs={
+            'registration_id': str(registration.id),
+            'mother_id': 'mother01',
+        })
+
+
+class TestMotherProfile(AuthenticatedAPITestCase):
+
+    def make_registration(self, **data):
+        return Registration.objects.create(
+            stage='prebirth', mother_id='mother01', data=data,
+            source=self.make_source_adminuser())
+
+    def test_registration_updates_profile(self):
+        """
+        New registrations should become the mother's latest registration,
+        and the subscription state should be updated when the registration
+        is subscribed.
+        """
+        post_save.connect(update_mother_profile, sender=Registration)
+        try:
+            self.make_registration(language='eng_UG')
+            registration = self.make_registration(
+                language='cgg_UG', msg_receiver='mother_to_be')
+        finally:
+            post_save.disconnect(update_mother_profile, sender=Registration)
+
+        profile = MotherProfile.objects.get(mother_id='mother01')
+        self.assertEqual(profile.registration, registration)
+        self.assertEqual(profile.language, 'cgg_UG')
+        self.assertEqual(profile.msg_receiver, 'mother_to_be')
+        self.assertEqual(profile.authority, 'hw_full')
+        self.assertEqual(profile.subscribed, False)
+
+        MotherProfile.objects.registration_subscribed(registration)
+        profile.refresh_from_db()
+        self.assertEqual(profile.subscribed, True)
+        self.assertEqual(profile.subscription_stage, 'prebirth')
+
+        MotherProfile.objects.apply_change(
+            'mother01', 'change_language', {'new_language': 'xog_UG'})
+        MotherProfile.objects.apply_change('mother01', 'change_loss', {})
+        profile.refresh_from_db()
+        self.assertEqual(profile.language, 'xog_UG')
+        self.assertEqual(profile.subscription_stage, 'loss')
+
+    def test_get_for_mother(self):
+        """
+        If the mother doesn't have a profile yet, it should be created from
+        her latest registration.
+        """
+        self.make_registration(language='eng_UG')
+        registration = self.make_registration(language='cgg_UG')
+        registration.validated = True
+        registration.save()
+
+        profile = MotherProfile.objects.get_for_mother('mother01')
+
+        self.assertEqual(profile.registration, registration)
+        self.assertEqual(profile.language, 'cgg_UG')
+        self.assertEqual(profile.subscribed, True)
+        self.assertEqual(profile.subscription_stage, 'prebirth')
+        self.assertEqual(MotherProfile.objects.count(), 1)
+        with self.assertNumQueries(1):
+            MotherProfile.objects.get_for_mother('mother01')
+
+    def test_get_for_mother_no_registration(self):
+        """
+        If the mother has no registrations, an error should be raised.
+        """
+        with self.assertRaises(Registration.DoesNotExist):
+            MotherProfile.objects.get_for_mother('mother01')
@@ -12,8 +12,7 @@ from .serializers import (UserSerializer, GroupSerializer,
                           SourceSerializer, RegistrationSerializer,
                           HookSerializer, CreateUserSerializer)
 from familyconnect_registration.utils import get_available_metrics
-# Uncomment line below if scheduled metrics are added
-# from .tasks import scheduled_metrics
+from .tasks import scheduled_metrics
 
 
 class HookViewSet(viewsets.ModelViewSet):
@@ -112,7 +111,9 @@ class RegistrationFilter(filters.FilterSet):
         model = Registration
         ('stage', 'mother_id', 'validated', 'source', 'created_at')
         fields = ['stage', 'mother_id', 'validated', 'source',
-                  'created_before', 'created_after']
+                  'created_before', 'created_after', 'language',
+                  'receiver_id', 'hoh_id', 'msg_receiver', 'parish',
+                  'reg_type']
 
 
 class RegistrationGetViewSet(viewsets.ReadOnlyModelViewSet):
@@ -160,7 +161,6 @@ class MetricsView(APIView):
 
     def post(self, request, *args, **kwargs):
         status = 201
-        # Uncomment line below if scheduled metrics are added
-        # scheduled_metrics.apply_async()
+        scheduled_metrics.apply_async()
         resp = {"scheduled_metrics_initiated": True}
         return Response(resp, status=status)
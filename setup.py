@@ -29,6 +29,7 @@ setup(
         'seed-services-client==0.9.0',
         'future==0.15.2',
         'pika==0.10.0',
+        'numpy==1.12.1',
     ],
     classifiers=[
         'Development Status :: 4 - Beta',
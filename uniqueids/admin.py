@@ -1,6 +1,7 @@
 from django.contrib import admin
 
 # Register your models here.
-from .models import Record
+from .models import Record, UniqueIDBackfill
 
 admin.site.register(Record)
+admin.site.register(UniqueIDBackfill)
@@ -0,0 +1,56 @@
+import numpy as np
+
+
+# The largest ID length that fits into a 64 bit integer
+MAX_LENGTH = 18
+
+
+def check_digits(sources):
+    """
+    Returns an array of the Luhn check digits for an array of numbers, the
+    same as calculate_luhn does for a single number.
+    """
+    remaining = np.array(sources, dtype='int64')
+    total = np.zeros(remaining.shape, dtype='int64')
+    # The check digit is added on the right, so the last digit of the number
+    # is the first one to be doubled
+    double = True
+    while remaining.any():
+        digit = remaining % 10
+        if double:
+            digit *= 2
+            digit -= 9 * (digit > 9)
+        total += digit
+        remaining //= 10
+        double = not double
+    return (10 - total % 10) % 10
+
+
+def add_check_digits(sources):
+    """
+    Returns an array of the numbers with their Luhn check digits added.
+    """
+    sources = np.asarray(sources, dtype='int64')
+    return sources * 10 + check_digits(sources)
+
+
+def is_valid(ids):
+    """
+    Returns a boolean array of which of the IDs have a valid Luhn check digit.
+    """
+    ids = np.asarray(ids, dtype='int64')
+    return check_digits(ids // 10) == ids % 10
+
+
+def random_ids(length, count):
+    """
+    Returns an array of count random Luhn valid IDs with the given amount of
+    digits, which may contain duplicates.
+    """
+    length = int(length)
+    if not 2 <= length <= MAX_LENGTH:
+        raise ValueError("IDs must be between 2 and %s digits long" % (
+            MAX_LENGTH,))
+    sources = np.random.randint(
+        10**(length-2), 10**(length-1), size=count, dtype='int64')
+    return add_check_digits(sources)
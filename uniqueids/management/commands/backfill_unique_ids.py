@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from uniqueids.models import UniqueIDBackfill
+from uniqueids.tasks import backfill_unique_ids
+
+
+class Command(BaseCommand):
+    help = ("Gives unique IDs to the identities in the identity store that "
+            "don't have one yet. The backfill runs as a chain of tasks, and "
+            "can be resumed from where it stopped.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--write-to', default='health_id',
+            help='The identity details field to write the unique ID to')
+        parser.add_argument(
+            '--length', type=int, default=10,
+            help='The amount of digits in each unique ID')
+        parser.add_argument(
+            '--resume', type=int, default=None, metavar='BACKFILL_ID',
+            help='Resume an earlier backfill instead of starting a new one')
+        parser.add_argument(
+            '--pages', type=int, default=None,
+            help='The amount of pages of identities to process in each task')
+
+    def handle(self, *args, **options):
+        if options['resume'] is not None:
+            try:
+                backfill = UniqueIDBackfill.objects.get(id=options['resume'])
+            except UniqueIDBackfill.DoesNotExist:
+                raise CommandError(
+                    'Backfill %s does not exist' % options['resume'])
+            if backfill.completed:
+                raise CommandError(
+                    'Backfill %s is already completed' % backfill.id)
+        else:
+            backfill = UniqueIDBackfill.objects.create(
+                write_to=options['write_to'], length=options['length'])
+
+        backfill_unique_ids.apply_async(kwargs={
+            "backfill_id": backfill.id, "pages": options['pages']})
+        self.stdout.write(
+            "Started backfill %s, resume it with --resume %s if it stops" % (
+                backfill.id, backfill.id))
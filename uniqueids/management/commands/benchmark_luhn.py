@@ -0,0 +1,39 @@
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from uniqueids import luhn
+from uniqueids.models import calculate_luhn, luhn_checksum
+
+
+class Command(BaseCommand):
+    help = ("Compares the speed of the scalar and the batch Luhn functions, "
+            "for generating check digits and validating IDs.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--count', type=int, default=100000,
+            help='The amount of IDs to generate and validate')
+        parser.add_argument(
+            '--length', type=int, default=10,
+            help='The amount of digits in each ID')
+
+    def report(self, name, count, scalar, batch):
+        self.stdout.write(
+            "%s: scalar %.0f IDs/s, batch %.0f IDs/s, %.1fx faster" % (
+                name, count / scalar, count / batch, scalar / batch))
+
+    def handle(self, *args, **options):
+        ids = luhn.random_ids(options['length'], options['count'])
+        sources = (ids // 10).tolist()
+        id_list = ids.tolist()
+
+        scalar = timeit.timeit(
+            lambda: [calculate_luhn(s) for s in sources], number=1)
+        batch = timeit.timeit(lambda: luhn.check_digits(sources), number=1)
+        self.report("Generate", len(sources), scalar, batch)
+
+        scalar = timeit.timeit(
+            lambda: [luhn_checksum(i) == 0 for i in id_list], number=1)
+        batch = timeit.timeit(lambda: luhn.is_valid(id_list), number=1)
+        self.report("Validate", len(id_list), scalar, batch)
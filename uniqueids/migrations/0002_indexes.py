@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 07:56
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uniqueids', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='record',
+            name='identity',
+            field=models.UUIDField(db_index=True),
+        ),
+    ]
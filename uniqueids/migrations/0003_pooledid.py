@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 08:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uniqueids', '0002_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PooledID',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('length', models.IntegerField(db_index=True)),
+            ],
+        ),
+    ]
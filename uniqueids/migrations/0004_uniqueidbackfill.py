@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 08:04
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uniqueids', '0003_pooledid'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UniqueIDBackfill',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('write_to', models.CharField(max_length=36)),
+                ('length', models.IntegerField(default=10)),
+                ('next_url', models.TextField(blank=True, null=True)),
+                ('completed', models.BooleanField(default=False)),
+                ('identities_seen', models.IntegerField(default=0)),
+                ('records_created', models.IntegerField(default=0)),
+                ('identities_updated', models.IntegerField(default=0)),
+                ('identities_failed', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
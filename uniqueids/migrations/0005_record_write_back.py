@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 08:05
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uniqueids', '0004_uniqueidbackfill'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='record',
+            name='identity_details',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True),
+        ),
+        # Records that already exist have been written back by their tasks
+        migrations.AddField(
+            model_name='record',
+            name='written_back',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AlterField(
+            model_name='record',
+            name='written_back',
+            field=models.BooleanField(default=False),
+        ),
+        # The batched write back looks up the records that are pending
+        migrations.RunSQL(
+            "CREATE INDEX uniqueids_record_pending_write_back "
+            "ON uniqueids_record (created_at) WHERE NOT written_back",
+            "DROP INDEX uniqueids_record_pending_write_back"),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-19 08:27
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uniqueids', '0005_record_write_back'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='record',
+            name='write_back_claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
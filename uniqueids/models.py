@@ -1,23 +1,65 @@
 import random
+from datetime import timedelta
 
+import numpy as np
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.contrib.postgres.fields import JSONField
+from django.core.exceptions import ImproperlyConfigured
+from django.db import ProgrammingError, connection, models, transaction
 from django.db.models.signals import pre_save, post_save
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 
+from . import luhn
+from .permutation import FeistelPermutation
 from .tasks import add_unique_id_to_identity
 
 
+class RecordQuerySet(models.QuerySet):
+    def claim_write_back(self, count, exclude=()):
+        """
+        Claims up to count of the records that haven't been written back to
+        their identities yet, and returns them, oldest first. Records that
+        are claimed by other tasks or transactions, or whose IDs are in
+        exclude, are skipped. Claims expire after
+        UNIQUE_ID_WRITE_BACK_CLAIM_SECONDS, so that the records of a task
+        that died are written back again.
+        """
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        now = timezone.now()
+        expired = now - timedelta(
+            seconds=settings.UNIQUE_ID_WRITE_BACK_CLAIM_SECONDS)
+        return sorted(self.raw(
+            "UPDATE {table} SET write_back_claimed_at = %s WHERE id IN ("
+            "SELECT id FROM {table} WHERE NOT written_back "
+            "AND (write_back_claimed_at IS NULL "
+            "OR write_back_claimed_at < %s) "
+            "AND NOT id = ANY(%s::bigint[]) ORDER BY created_at "
+            "LIMIT %s FOR UPDATE SKIP LOCKED) "
+            "RETURNING *".format(table=table),
+            [now, expired, list(exclude), count]),
+            key=lambda record: record.created_at)
+
+
 @python_2_unicode_compatible
 class Record(models.Model):
     """ The historical record of identities requiring unique integer refs
         write_to is the field we should write back to on the identity details
+        identity_details is the identity's details when the record was
+        created, if they are known, so that the unique ID can be written
+        back without fetching the identity first
+        write_back_claimed_at is when a task claimed the record to write
+        its unique ID back, if it is being written back
     """
     id = models.BigIntegerField(primary_key=True)
-    identity = models.UUIDField()
+    identity = models.UUIDField(db_index=True)
     write_to = models.CharField(max_length=36, null=False, blank=False)
     length = models.IntegerField(default=10)
+    identity_details = JSONField(null=True, blank=True)
+    written_back = models.BooleanField(default=False)
+    write_back_claimed_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     created_by = models.ForeignKey(User, related_name='records_created',
@@ -26,28 +68,118 @@ class Record(models.Model):
                                    null=True)
     user = property(lambda self: self.created_by)
 
+    objects = RecordQuerySet.as_manager()
+
     def __str__(self):
         return "%s for %s" % (self.id, str(self.identity))
 
 
+class PooledIDQuerySet(models.QuerySet):
+    def claim(self, length):
+        """
+        Removes an unused ID of the given length from the pool and returns
+        it, or None if the pool has no IDs of that length.
+        """
+        ids = self.claim_many(length, 1)
+        return ids[0] if ids else None
+
+    def claim_many(self, length, count):
+        """
+        Removes up to count unused IDs of the given length from the pool and
+        returns them. IDs that are being claimed by other transactions are
+        skipped instead of waited for.
+        """
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM {table} WHERE id IN ("
+                "SELECT id FROM {table} WHERE length = %s "
+                "LIMIT %s FOR UPDATE SKIP LOCKED) "
+                "RETURNING id".format(table=table), [length, count])
+            return [row[0] for row in cursor.fetchall()]
+
+    def refill(self, length, amount):
+        """
+        Adds up to amount new random IDs of the given length to the pool, and
+        returns the amount that were added. Candidates that are already in
+        the pool or have already been used for a record are skipped.
+        """
+        candidates = np.unique(luhn.random_ids(length, amount)).tolist()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO {pool} (id, length) "
+                "SELECT candidate, %s FROM unnest(%s::bigint[]) AS candidate "
+                "WHERE NOT EXISTS ("
+                "SELECT 1 FROM {record} WHERE id = candidate) "
+                "ON CONFLICT DO NOTHING".format(
+                    pool=connection.ops.quote_name(self.model._meta.db_table),
+                    record=connection.ops.quote_name(Record._meta.db_table)),
+                [length, candidates])
+            return cursor.rowcount
+
+
+@python_2_unicode_compatible
+class PooledID(models.Model):
+    """ A pre-generated, Luhn valid, unused unique ID, which can be claimed
+        for a new record without searching for an ID that isn't taken.
+        The pool is topped up by the refill_unique_id_pool task.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    length = models.IntegerField(db_index=True)
+
+    objects = PooledIDQuerySet.as_manager()
+
+    def __str__(self):
+        return str(self.id)
+
+
+@python_2_unicode_compatible
+class UniqueIDBackfill(models.Model):
+    """ A run of the unique ID backfill, which gives unique IDs to the
+        identities in the identity store that don't have one yet. next_url
+        is the next page of identities to process, so that the run can be
+        resumed if it stops.
+    """
+    write_to = models.CharField(max_length=36, null=False, blank=False)
+    length = models.IntegerField(default=10)
+    next_url = models.TextField(null=True, blank=True)
+    completed = models.BooleanField(default=False)
+    identities_seen = models.IntegerField(default=0)
+    records_created = models.IntegerField(default=0)
+    identities_updated = models.IntegerField(default=0)
+    identities_failed = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "Backfill %s of %s" % (self.id, self.write_to)
+
+
 @receiver(pre_save, sender=Record)
 def record_pre_save(sender, instance, **kwargs):
-    """ Pre save hook to generate a unique ID
+    """ Pre save hook to generate a unique ID from the ID sequence if the
+        permutation generator is enabled, otherwise to claim one from the
+        pool, or generate one if the pool has none of the record's length
     """
+    if instance.id is None and settings.UNIQUE_ID_GENERATOR == 'permutation':
+        instance.id = generate_permuted_id(length=instance.length)
+    if instance.id is None:
+        instance.id = PooledID.objects.claim(int(instance.length))
     if instance.id is None:
         instance.id = generate_unique_id(length=instance.length)
 
 
 @receiver(post_save, sender=Record)
 def record_post_save(sender, instance, created, **kwargs):
-    """ Post save hook to patch the source identity
+    """ Post save hook to patch the source identity, unless the unique IDs
+        are written back in batches
     """
-    if created:
+    if created and not settings.UNIQUE_ID_WRITE_BACK_BATCH_SIZE:
         add_unique_id_to_identity.apply_async(
             kwargs={
                 "identity": str(instance.identity),
                 "unique_id": instance.id,
-                "write_to": instance.write_to
+                "write_to": instance.write_to,
             })
 
 
@@ -81,11 +213,52 @@ def generate_unique_id(length=10, attempts=0):
     checksum = calculate_luhn(source)
     unique_id = int(str(source) + str(checksum))
 
-    try:
-        Record.objects.get(id=unique_id)
-        if attempts < 10:
-            generate_unique_id(length=length, attempts=attempts+1)
-        else:
-            return "Aborting unique_id generation after 10 failed attempts"
-    except Record.DoesNotExist:
+    if not Record.objects.filter(id=unique_id).exists():
         return unique_id
+    if attempts < 10:
+        return generate_unique_id(length=length, attempts=attempts+1)
+    raise ValueError("Aborting unique_id generation after 10 failed attempts")
+
+
+def next_sequence_value(length):
+    """
+    Returns the next value of the ID sequence for the length, starting from
+    0, and creates the sequence if it doesn't exist yet.
+    """
+    name = connection.ops.quote_name('uniqueids_record_id_%d' % length)
+    with connection.cursor() as cursor:
+        try:
+            with transaction.atomic():
+                cursor.execute("SELECT nextval('%s')" % name)
+        except ProgrammingError:
+            cursor.execute(
+                "CREATE SEQUENCE IF NOT EXISTS %s MINVALUE 0 START 0" % name)
+            cursor.execute("SELECT nextval('%s')" % name)
+        return cursor.fetchone()[0]
+
+
+def generate_permuted_id(length=10):
+    """
+    Generates a unique ID by mapping the next value of the ID sequence for
+    the length through a keyed permutation of the (length-1) digit numbers,
+    and adding the Luhn check digit. The IDs look random, but are unique as
+    long as they are all generated this way with the same key. IDs that were
+    already issued another way are skipped.
+    """
+    if not settings.UNIQUE_ID_PERMUTATION_KEY:
+        raise ImproperlyConfigured(
+            "UNIQUE_ID_PERMUTATION_KEY must be set to use the permutation "
+            "unique ID generator")
+    length = int(length)
+    lower = 10**(length-2)
+    permutation = FeistelPermutation(
+        9 * lower, settings.UNIQUE_ID_PERMUTATION_KEY)
+    while True:
+        value = next_sequence_value(length)
+        if value >= permutation.size:
+            raise ValueError(
+                "All of the %s digit unique IDs have been generated" % length)
+        source = lower + permutation.permute(value)
+        unique_id = int(str(source) + str(calculate_luhn(source)))
+        if not Record.objects.filter(id=unique_id).exists():
+            return unique_id
@@ -0,0 +1,71 @@
+import hashlib
+import hmac
+
+
+class FeistelPermutation(object):
+    """
+    A keyed permutation of the numbers from 0 up to, but not including,
+    size. Numbers are split into a high and a low half of decimal digits,
+    and each round adds a keyed hash of one half to the other, alternating
+    between the halves. Results that fall outside of the range are permuted
+    again until they are inside it (cycle walking), so that any size can be
+    used.
+
+    The same key always gives the same permutation, so the key needs to be
+    kept for as long as numbers are being permuted.
+    """
+    def __init__(self, size, key, rounds=8):
+        self.size = size
+        self.key = key.encode('utf-8') if hasattr(key, 'encode') else key
+        self.rounds = rounds
+        digits = len(str(max(size - 1, 1)))
+        self.low = 10 ** (digits - digits // 2)
+        self.high = 10 ** (digits // 2)
+
+    def round_function(self, i, value):
+        digest = hmac.new(
+            self.key, ('%d:%d' % (i, value)).encode('ascii'),
+            hashlib.sha256).hexdigest()
+        return int(digest[:16], 16)
+
+    def encrypt(self, value):
+        left, right = divmod(value, self.low)
+        for i in range(self.rounds):
+            if i % 2 == 0:
+                left = (left + self.round_function(i, right)) % self.high
+            else:
+                right = (right + self.round_function(i, left)) % self.low
+        return left * self.low + right
+
+    def decrypt(self, value):
+        left, right = divmod(value, self.low)
+        for i in reversed(range(self.rounds)):
+            if i % 2 == 0:
+                left = (left - self.round_function(i, right)) % self.high
+            else:
+                right = (right - self.round_function(i, left)) % self.low
+        return left * self.low + right
+
+    def permute(self, value):
+        """
+        Returns the number that value is mapped to.
+        """
+        if not 0 <= value < self.size:
+            raise ValueError(
+                "%s is outside of the permutation range" % value)
+        value = self.encrypt(value)
+        while value >= self.size:
+            value = self.encrypt(value)
+        return value
+
+    def invert(self, value):
+        """
+        Returns the number that is mapped to value.
+        """
+        if not 0 <= value < self.size:
+            raise ValueError(
+                "%s is outside of the permutation range" % value)
+        value = self.decrypt(value)
+        while value >= self.size:
+            value = self.decrypt(value)
+        return value
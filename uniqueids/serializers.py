@@ -1,4 +1,5 @@
 from .models import Record
+from registrations.models import MotherProfile
 from rest_framework import serializers
 
 
@@ -9,3 +10,15 @@ class RecordSerializer(serializers.ModelSerializer):
         read_only_fields = ('id')
         fields = ('id', 'identity', 'write_to', 'length',
                   'created_at', 'created_by')
+
+
+class RegistrationSummarySerializer(serializers.ModelSerializer):
+    validated = serializers.BooleanField(source='registration.validated')
+    registered_at = serializers.DateTimeField(
+        source='registration.created_at')
+
+    class Meta:
+        model = MotherProfile
+        fields = ('registration', 'stage', 'authority', 'validated',
+                  'registered_at', 'msg_receiver', 'language', 'subscribed',
+                  'subscription_stage')
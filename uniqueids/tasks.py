@@ -1,5 +1,10 @@
+import datetime
+
 from celery.task import Task
 from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
 
 from familyconnect_registration import utils
 
@@ -7,25 +12,271 @@ from familyconnect_registration import utils
 logger = get_task_logger(__name__)
 
 
+def write_unique_id(identity, unique_id, write_to, details=None,
+                    session=None):
+    """
+    Writes the unique ID to the identity's details. If the details aren't
+    given, they are fetched from the identity store first. Returns False if
+    the identity doesn't exist.
+    """
+    if details is None:
+        full_identity = utils.get_identity(identity, session=session)
+        if "details" not in full_identity:
+            # a 404
+            return False
+        details = full_identity["details"]
+    details = dict(details)
+    # convert to string to enable Django filter lookups
+    details[write_to] = str(unique_id)
+    utils.patch_identity(identity, {"details": details}, session=session)
+    return True
+
+
+def get_write_back_details(record):
+    """
+    Returns the identity details from the record's webhook if they are recent
+    enough to be written back, otherwise None so that they are fetched again
+    and newer changes to the identity aren't overwritten.
+    """
+    max_age = datetime.timedelta(
+        seconds=settings.UNIQUE_ID_WRITE_BACK_DETAILS_SECONDS)
+    if record.created_at < timezone.now() - max_age:
+        return None
+    return record.identity_details
+
+
 class AddUniqueIDToIdentity(Task):
     def run(self, identity, unique_id, write_to, **kwargs):
         """
         identity:     the identity to receive the payload.
         unique_id:    the unique_id to add to the identity
         write_to:     the key to write the unique_id to
+
+        The identity's details are taken from the record if they are recent,
+        so that they don't need to be fetched.
         """
-        full_identity = utils.get_identity(identity)
-        if "details" in full_identity:
-            # not a 404
-            partial_identity = {
-                "details": full_identity["details"]
-            }
-            # convert to string to enable Django filter lookups
-            partial_identity["details"][write_to] = str(unique_id)
-            utils.patch_identity(identity, partial_identity)
-            return "Identity <%s> now has <%s> of <%s>" % (
-                identity, write_to, str(unique_id))
-        else:
+        from .models import Record
+        record = Record.objects.filter(id=unique_id).first()
+        details = get_write_back_details(record) if record else None
+        if not write_unique_id(identity, unique_id, write_to, details):
             return "Identity <%s> not found" % (identity,)
+        Record.objects.filter(id=unique_id).update(
+            written_back=True, identity_details=None)
+        return "Identity <%s> now has <%s> of <%s>" % (
+            identity, write_to, str(unique_id))
 
 add_unique_id_to_identity = AddUniqueIDToIdentity()
+
+
+class RefillUniqueIDPool(Task):
+    """ Tops up the pool of unused unique IDs for each of the configured
+    lengths, so that new records can claim an ID without generating one.
+    """
+    name = 'uniqueids.tasks.refill_unique_id_pool'
+
+    def run(self, lengths=None, size=None, **kwargs):
+        """
+        lengths:    the ID lengths to refill, defaults to
+                    UNIQUE_ID_POOL_LENGTHS
+        size:       the amount of unused IDs to keep in the pool for each
+                    length, defaults to UNIQUE_ID_POOL_SIZE
+        """
+        from .models import PooledID
+        if lengths is None:
+            lengths = settings.UNIQUE_ID_POOL_LENGTHS
+        if size is None:
+            size = settings.UNIQUE_ID_POOL_SIZE
+
+        added = 0
+        for length in lengths:
+            available = PooledID.objects.filter(length=length).count()
+            if available < size:
+                added += PooledID.objects.refill(length, size - available)
+        return "Added %s IDs to the unique ID pool" % added
+
+refill_unique_id_pool = RefillUniqueIDPool()
+
+
+class BackfillUniqueIDs(Task):
+    """ Gives unique IDs to the identities that don't have one yet, a page of
+    identities at a time. Each task processes a few pages, records where it
+    got to on the backfill, and then queues the next task.
+    """
+    name = 'uniqueids.tasks.backfill_unique_ids'
+
+    def allocate_ids(self, length, count):
+        """
+        Returns count unused unique IDs of the given length, taken from the
+        pool where possible.
+        """
+        from .models import PooledID, generate_unique_id
+        ids = PooledID.objects.claim_many(length, count)
+        if len(ids) < count:
+            PooledID.objects.refill(length, count - len(ids))
+            ids.extend(PooledID.objects.claim_many(length, count - len(ids)))
+        while len(ids) < count:
+            unique_id = generate_unique_id(length=length)
+            if unique_id not in ids:
+                ids.append(unique_id)
+        return ids
+
+    def write_unique_id(self, limiter, identity, write_to, unique_id):
+        limiter.wait()
+        return write_unique_id(
+            identity["id"], unique_id, write_to,
+            identity.get("details") or {})
+
+    def process_page(self, backfill, page, limiter):
+        """
+        Creates records for the identities on the page that don't have a
+        unique ID, and writes the IDs to the identities. Identities that
+        already have a record, from an earlier attempt at the page, are
+        given the ID of that record.
+        """
+        from .models import Record
+        identities = [
+            identity for identity in page.get("results", [])
+            if backfill.write_to not in (identity.get("details") or {})]
+        unique_ids = dict(
+            (str(identity), unique_id) for identity, unique_id in
+            Record.objects.filter(
+                identity__in=[identity["id"] for identity in identities],
+                write_to=backfill.write_to,
+            ).values_list("identity", "id"))
+
+        new = [identity["id"] for identity in identities
+               if identity["id"] not in unique_ids]
+        with transaction.atomic():
+            # Created in bulk, so the record post save hook doesn't queue a
+            # task per record
+            records = Record.objects.bulk_create(
+                Record(id=unique_id, identity=identity,
+                       write_to=backfill.write_to, length=backfill.length)
+                for identity, unique_id in zip(
+                    new, self.allocate_ids(backfill.length, len(new))))
+        unique_ids.update((str(r.identity), r.id) for r in records)
+
+        results = utils.run_concurrently(((
+            self.write_unique_id,
+            (limiter, identity, backfill.write_to, unique_ids[identity["id"]])
+        ) for identity in identities), raise_errors=False)
+        failed = [
+            (identity["id"], result)
+            for identity, result in zip(identities, results)
+            if isinstance(result, Exception)]
+        for identity, error in failed:
+            logger.warning(
+                "Failed to write unique ID to identity <%s>: %s" % (
+                    identity, error))
+        Record.objects.filter(
+            id__in=[unique_ids[identity["id"]] for identity, result in zip(
+                identities, results) if not isinstance(result, Exception)],
+        ).update(written_back=True)
+
+        backfill.identities_seen += len(page.get("results", []))
+        backfill.records_created += len(records)
+        backfill.identities_updated += len(identities) - len(failed)
+        backfill.identities_failed += len(failed)
+
+    def run(self, backfill_id, pages=None, **kwargs):
+        """
+        backfill_id:  the UniqueIDBackfill to continue
+        pages:        the amount of pages to process before queueing the
+                      next task, defaults to UNIQUE_ID_BACKFILL_PAGES
+        """
+        from .models import UniqueIDBackfill
+        backfill = UniqueIDBackfill.objects.get(id=backfill_id)
+        if backfill.completed:
+            return "Backfill <%s> is already completed" % (backfill.id,)
+        if pages is None:
+            pages = settings.UNIQUE_ID_BACKFILL_PAGES
+        limiter = utils.RateLimiter(settings.UNIQUE_ID_BACKFILL_RATE)
+
+        # The next pages are fetched while the current one is processed
+        identity_pages = utils.prefetch_pages(
+            utils.get_identities_page, backfill.next_url)
+        try:
+            for count, page in enumerate(identity_pages, 1):
+                self.process_page(backfill, page, limiter)
+                backfill.next_url = page.get("next")
+                backfill.completed = backfill.next_url is None
+                backfill.save()
+                if backfill.completed:
+                    return (
+                        "Backfill <%s> completed, created %s records and "
+                        "updated %s identities, %s failed" % (
+                            backfill.id, backfill.records_created,
+                            backfill.identities_updated,
+                            backfill.identities_failed))
+                if count >= pages:
+                    break
+        finally:
+            identity_pages.close()
+
+        self.apply_async(kwargs={"backfill_id": backfill.id, "pages": pages})
+        return "Backfill <%s> continues from <%s>" % (
+            backfill.id, backfill.next_url)
+
+backfill_unique_ids = BackfillUniqueIDs()
+
+
+class WriteBackUniqueIDs(Task):
+    """ Writes the unique IDs of the records that haven't been written back
+    yet to their identities, a batch of records at a time, reusing the
+    connections to the identity store.
+    """
+    name = 'uniqueids.tasks.write_back_unique_ids'
+
+    def write_back(self, record, session):
+        return write_unique_id(
+            str(record.identity), record.id, record.write_to,
+            get_write_back_details(record), session=session)
+
+    def run(self, batch_size=None, **kwargs):
+        """
+        batch_size:   the amount of records to write back concurrently,
+                      defaults to UNIQUE_ID_WRITE_BACK_BATCH_SIZE
+        """
+        from .models import Record
+        if batch_size is None:
+            batch_size = settings.UNIQUE_ID_WRITE_BACK_BATCH_SIZE
+        if not batch_size:
+            return "Batched unique ID write back is disabled"
+        session = utils.get_session()
+
+        written, not_found, failed = 0, 0, []
+        while True:
+            records = Record.objects.claim_write_back(
+                batch_size, exclude=failed)
+            if not records:
+                break
+            results = utils.run_concurrently((
+                (self.write_back, (record, session)) for record in records),
+                raise_errors=False)
+            done, retry = [], []
+            for record, result in zip(records, results):
+                if isinstance(result, Exception):
+                    logger.warning(
+                        "Failed to write unique ID <%s> to identity <%s>: "
+                        "%s" % (record.id, record.identity, result))
+                    retry.append(record.id)
+                    continue
+                if result:
+                    written += 1
+                else:
+                    not_found += 1
+                done.append(record.id)
+            Record.objects.filter(id__in=done).update(
+                written_back=True, write_back_claimed_at=None,
+                identity_details=None)
+            # The details will be out of date by the time the records are
+            # retried, so they are fetched again instead
+            Record.objects.filter(id__in=retry).update(
+                write_back_claimed_at=None, identity_details=None)
+            failed.extend(retry)
+
+        return (
+            "Wrote back %s unique IDs, %s identities not found, %s failed" % (
+                written, not_found, len(failed)))
+
+write_back_unique_ids = WriteBackUniqueIDs()
@@ -1,7 +1,17 @@
 import json
+from datetime import timedelta
 import responses
-
-from django.test import TestCase
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from django.utils.six import StringIO
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 
@@ -10,8 +20,16 @@ from rest_framework.test import APIClient
 from rest_framework.authtoken.models import Token
 from rest_hooks.models import model_saved
 
-from .models import Record, record_post_save
-from .tasks import add_unique_id_to_identity
+from . import luhn
+from familyconnect_registration.utils import RateLimiter
+from registrations.models import Registration, Source
+from .models import (
+    PooledID, Record, UniqueIDBackfill, calculate_luhn, generate_permuted_id,
+    generate_unique_id, luhn_checksum, record_post_save)
+from .permutation import FeistelPermutation
+from .tasks import (
+    add_unique_id_to_identity, backfill_unique_ids, refill_unique_id_pool,
+    write_back_unique_ids)
 
 
 class APITestCase(TestCase):
@@ -73,6 +91,13 @@ class AuthenticatedAPITestCase(APITestCase):
         self.adminclient.credentials(
             HTTP_AUTHORIZATION='Token ' + self.admintoken)
 
+    def mock_identity_patch(self, identity, status=200):
+        responses.add(
+            responses.PATCH,
+            'http://localhost:8001/api/v1/identities/%s/' % identity,
+            json={"id": identity}, status=status,
+            content_type='application/json')
+
     def tearDown(self):
         self._restore_post_save_hooks()
 
@@ -402,3 +427,583 @@ class TestRecordTasks(AuthenticatedAPITestCase):
         self.assertEqual(
             result.get(),
             "Identity <70097580-c9fe-4f92-a55e-8f5f54b19799> not found")
+
+
+class TestUniqueIDPool(AuthenticatedAPITestCase):
+
+    def test_refill(self):
+        """
+        Refilling should add Luhn valid IDs of the given length, skipping IDs
+        that are already used by a record.
+        """
+        Record.objects.create(
+            id=18, identity="9d02ae1a-16e4-4674-abdc-daf9cce9c52d",
+            write_to="health_id", length=2)
+
+        added = PooledID.objects.refill(2, 100)
+
+        ids = PooledID.objects.filter(length=2).values_list('id', flat=True)
+        self.assertEqual(added, len(ids))
+        self.assertTrue(0 < len(ids) <= 8)
+        self.assertNotIn(18, ids)
+        for unique_id in ids:
+            self.assertEqual(len(str(unique_id)), 2)
+            self.assertEqual(luhn_checksum(unique_id), 0)
+
+        # Only IDs that aren't in the pool yet should be added
+        self.assertEqual(PooledID.objects.refill(2, 100), 8 - len(ids))
+
+    def test_claim(self):
+        """
+        Claiming should remove an ID of the given length from the pool, and
+        return None once there are none left.
+        """
+        PooledID.objects.create(id=1234567897, length=10)
+        PooledID.objects.create(id=12344, length=5)
+
+        self.assertEqual(PooledID.objects.claim(10), 1234567897)
+        self.assertEqual(PooledID.objects.claim(10), None)
+        self.assertEqual(PooledID.objects.filter(length=5).count(), 1)
+
+    def test_record_claims_from_pool(self):
+        """
+        New records should use an ID from the pool, and generate an ID if
+        there are none in the pool of their length.
+        """
+        PooledID.objects.create(id=1234567897, length=10)
+        record = Record.objects.create(
+            identity="9d02ae1a-16e4-4674-abdc-daf9cce9c52d",
+            write_to="health_id")
+        self.assertEqual(record.id, 1234567897)
+        self.assertEqual(PooledID.objects.count(), 0)
+
+        record = Record.objects.create(
+            identity="c304f463-6db4-4f89-a095-46319da06ac9",
+            write_to="health_id")
+        self.assertEqual(len(str(record.id)), 10)
+
+    def test_refill_task(self):
+        """
+        The refill task should top up the pool of each length to the given
+        size.
+        """
+        PooledID.objects.create(id=1234567897, length=10)
+
+        result = refill_unique_id_pool.apply_async(
+            kwargs={"lengths": [10, 8], "size": 5})
+
+        self.assertEqual(
+            result.get(), "Added 9 IDs to the unique ID pool")
+        self.assertEqual(PooledID.objects.filter(length=10).count(), 5)
+        self.assertEqual(PooledID.objects.filter(length=8).count(), 5)
+
+    @patch('uniqueids.models.random_digits')
+    def test_generate_unique_id_retries(self, mock_random_digits):
+        """
+        If the generated ID is already taken, generating should retry, and
+        return the ID of the successful attempt.
+        """
+        mock_random_digits.side_effect = [123456789, 987654321]
+        Record.objects.create(
+            id=1234567897, identity="9d02ae1a-16e4-4674-abdc-daf9cce9c52d",
+            write_to="health_id")
+
+        self.assertEqual(
+            generate_unique_id(length=10),
+            9876543210 + calculate_luhn(987654321))
+
+
+@override_settings(UNIQUE_ID_PERMUTATION_KEY='key')
+class TestPermutedIDs(AuthenticatedAPITestCase):
+
+    def test_permutation(self):
+        """
+        The permutation should map each number in the range to a different
+        number in the range, and be reversible.
+        """
+        permutation = FeistelPermutation(900, 'key')
+        values = [permutation.permute(i) for i in range(900)]
+        self.assertEqual(sorted(values), list(range(900)))
+        self.assertNotEqual(values, list(range(900)))
+        self.assertEqual(
+            [permutation.invert(v) for v in values], list(range(900)))
+        self.assertNotEqual(
+            values, [FeistelPermutation(900, 'other').permute(i)
+                     for i in range(900)])
+        self.assertRaises(ValueError, permutation.permute, 900)
+
+    def test_generate_permuted_id(self):
+        """
+        Should generate every Luhn valid ID of the length once, and then
+        fail.
+        """
+        ids = [generate_permuted_id(length=2) for _ in range(9)]
+        self.assertEqual(
+            sorted(ids), [i for i in range(10, 100) if luhn_checksum(i) == 0])
+        self.assertRaises(ValueError, generate_permuted_id, length=2)
+
+    def test_generate_permuted_id_skips_existing(self):
+        """
+        IDs that were already issued by another generator should be
+        skipped.
+        """
+        Record.objects.create(
+            id=18, identity="9d02ae1a-16e4-4674-abdc-daf9cce9c52d",
+            write_to="health_id", length=2)
+        ids = [generate_permuted_id(length=2) for _ in range(8)]
+        self.assertEqual(
+            sorted(ids),
+            [i for i in range(10, 100) if luhn_checksum(i) == 0 and i != 18])
+        self.assertRaises(ValueError, generate_permuted_id, length=2)
+
+    @override_settings(UNIQUE_ID_PERMUTATION_KEY=None)
+    def test_generate_permuted_id_requires_key(self):
+        """
+        The permutation generator shouldn't be used without a key.
+        """
+        self.assertRaises(
+            ImproperlyConfigured, generate_permuted_id, length=10)
+
+    @override_settings(UNIQUE_ID_GENERATOR='permutation')
+    def test_record_uses_permuted_id(self):
+        """
+        When the permutation generator is enabled, records should get their
+        ID from it instead of from the pool.
+        """
+        PooledID.objects.create(id=1234567897, length=10)
+        record = Record.objects.create(
+            identity="9d02ae1a-16e4-4674-abdc-daf9cce9c52d",
+            write_to="health_id")
+        self.assertNotEqual(record.id, 1234567897)
+        self.assertEqual(len(str(record.id)), 10)
+        self.assertEqual(luhn_checksum(record.id), 0)
+        self.assertEqual(PooledID.objects.count(), 1)
+
+
+class TestBatchLuhn(TestCase):
+
+    def test_check_digits(self):
+        """
+        The batch check digits should match the scalar check digits.
+        """
+        sources = [0, 7, 12, 7992739871, 123456789, 999999999999999999 // 10]
+        self.assertEqual(
+            luhn.check_digits(sources).tolist(),
+            [calculate_luhn(s) for s in sources])
+        self.assertEqual(
+            luhn.add_check_digits([7992739871]).tolist(), [79927398713])
+
+    def test_is_valid(self):
+        """
+        Should validate the check digit of each ID.
+        """
+        self.assertEqual(
+            luhn.is_valid([79927398713, 79927398710, 1234567897]).tolist(),
+            [True, False, True])
+
+    def test_random_ids(self):
+        """
+        Should generate valid IDs of the given length.
+        """
+        ids = luhn.random_ids(10, 100)
+        self.assertEqual(len(ids), 100)
+        self.assertTrue(luhn.is_valid(ids).all())
+        self.assertTrue(
+            all(len(str(i)) == 10 for i in ids.tolist()))
+        self.assertRaises(ValueError, luhn.random_ids, 19, 1)
+
+    def test_benchmark_command(self):
+        """
+        The benchmark command should report the speed of the scalar and the
+        batch functions.
+        """
+        stdout = StringIO()
+        call_command('benchmark_luhn', '--count', '100', stdout=stdout)
+        lines = stdout.getvalue().strip().split('\n')
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('Generate: scalar '))
+        self.assertTrue(lines[1].startswith('Validate: scalar '))
+
+
+@override_settings(UNIQUE_ID_BACKFILL_RATE=0)
+class TestUniqueIDBackfill(AuthenticatedAPITestCase):
+    IDENTITY_1 = "9d02ae1a-16e4-4674-abdc-daf9cce9c52d"
+    IDENTITY_2 = "c304f463-6db4-4f89-a095-46319da06ac9"
+    IDENTITY_3 = "70097580-c9fe-4f92-a55e-8f5f54b19799"
+    IDENTITY_4 = "3f7c8851-5204-43f7-af7f-005059993333"
+
+    def mock_identity_pages(self):
+        url = 'http://localhost:8001/api/v1/identities/'
+        responses.add(
+            responses.GET, url, match_querystring=True,
+            json={
+                "next": url + "?cursor=2",
+                "results": [
+                    {"id": self.IDENTITY_1, "details": {"health_id": "1"}},
+                    {"id": self.IDENTITY_2, "details": {"role": "mother"}},
+                ],
+            }, status=200, content_type='application/json')
+        responses.add(
+            responses.GET, url + "?cursor=2", match_querystring=True,
+            json={
+                "next": None,
+                "results": [
+                    {"id": self.IDENTITY_3, "details": {}},
+                    {"id": self.IDENTITY_4, "details": {}},
+                ],
+            }, status=200, content_type='application/json')
+
+    def get_patched_ids(self):
+        return dict(
+            (call.request.url.split('/')[-2],
+             json.loads(call.request.body)["details"]["health_id"])
+            for call in responses.calls if call.request.method == 'PATCH')
+
+    @responses.activate
+    def test_backfill(self):
+        """
+        Should create records in bulk for the identities without a unique
+        ID, write the IDs to the identities, and continue to the next page
+        until there are no more.
+        """
+        self.mock_identity_pages()
+        self.mock_identity_patch(self.IDENTITY_2)
+        self.mock_identity_patch(self.IDENTITY_3)
+        self.mock_identity_patch(self.IDENTITY_4, status=500)
+        PooledID.objects.create(id=1234567897, length=10)
+        # From an earlier attempt at the page
+        Record.objects.create(
+            id=9876543217, identity=self.IDENTITY_3, write_to="health_id")
+        backfill = UniqueIDBackfill.objects.create(write_to="health_id")
+
+        result = backfill_unique_ids.apply_async(
+            kwargs={"backfill_id": backfill.id, "pages": 1})
+
+        self.assertEqual(
+            result.get(),
+            "Backfill <%s> continues from "
+            "<http://localhost:8001/api/v1/identities/?cursor=2>" % (
+                backfill.id,))
+        backfill.refresh_from_db()
+        self.assertTrue(backfill.completed)
+        self.assertEqual(backfill.next_url, None)
+        self.assertEqual(backfill.identities_seen, 4)
+        self.assertEqual(backfill.records_created, 2)
+        self.assertEqual(backfill.identities_updated, 2)
+        self.assertEqual(backfill.identities_failed, 1)
+
+        self.assertEqual(Record.objects.count(), 3)
+        record_2 = Record.objects.get(identity=self.IDENTITY_2)
+        record_4 = Record.objects.get(identity=self.IDENTITY_4)
+        self.assertEqual(record_2.id, 1234567897)
+        self.assertEqual(len(str(record_4.id)), 10)
+        self.assertTrue(record_2.written_back)
+        self.assertFalse(record_4.written_back)
+        self.assertEqual(self.get_patched_ids(), {
+            self.IDENTITY_2: "1234567897",
+            self.IDENTITY_3: "9876543217",
+            self.IDENTITY_4: str(record_4.id),
+        })
+
+    @responses.activate
+    def test_backfill_resume(self):
+        """
+        Resuming a backfill should continue from the last page that it got
+        to.
+        """
+        self.mock_identity_pages()
+        self.mock_identity_patch(self.IDENTITY_3)
+        self.mock_identity_patch(self.IDENTITY_4)
+        backfill = UniqueIDBackfill.objects.create(
+            write_to="health_id",
+            next_url="http://localhost:8001/api/v1/identities/?cursor=2")
+
+        stdout = StringIO()
+        call_command(
+            'backfill_unique_ids', '--resume', str(backfill.id),
+            stdout=stdout)
+
+        self.assertEqual(
+            stdout.getvalue().strip(),
+            "Started backfill %s, resume it with --resume %s if it stops" % (
+                backfill.id, backfill.id))
+        self.assertEqual(
+            set(self.get_patched_ids()),
+            set([self.IDENTITY_3, self.IDENTITY_4]))
+        backfill.refresh_from_db()
+        self.assertTrue(backfill.completed)
+        self.assertEqual(backfill.records_created, 2)
+
+        result = backfill_unique_ids.apply_async(
+            kwargs={"backfill_id": backfill.id})
+        self.assertEqual(
+            result.get(), "Backfill <%s> is already completed" % backfill.id)
+
+    def test_rate_limiter(self):
+        """
+        The rate limiter should space the calls out to the given rate.
+        """
+        with patch('familyconnect_registration.utils.time') as mock_time:
+            mock_time.time.return_value = 100
+            limiter = RateLimiter(4)
+            limiter.wait()
+            limiter.wait()
+            limiter.wait()
+        self.assertEqual(
+            [c[0][0] for c in mock_time.sleep.call_args_list], [0.25, 0.5])
+
+
+class TestUniqueIDWriteBack(AuthenticatedAPITestCase):
+    IDENTITY_1 = "9d02ae1a-16e4-4674-abdc-daf9cce9c52d"
+    IDENTITY_2 = "c304f463-6db4-4f89-a095-46319da06ac9"
+    IDENTITY_3 = "70097580-c9fe-4f92-a55e-8f5f54b19799"
+
+    def test_webhook_stores_details(self):
+        """
+        The record should keep the details from the webhook, so that they
+        don't need to be fetched to write the unique ID back.
+        """
+        response = self.normalclient.post(
+            '/api/v1/uniqueid/', json.dumps({"data": {
+                "id": self.IDENTITY_1, "details": {"role": "mother"}}}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        record = Record.objects.get()
+        self.assertEqual(record.identity_details, {"role": "mother"})
+        self.assertFalse(record.written_back)
+
+    @responses.activate
+    def test_write_back_with_details(self):
+        """
+        If the identity details are known, the unique ID should be written
+        back without fetching the identity, and the record marked as written
+        back.
+        """
+        self.mock_identity_patch(self.IDENTITY_1)
+        Record.objects.create(
+            id=1234567897, identity=self.IDENTITY_1, write_to="health_id",
+            identity_details={"role": "mother"})
+
+        result = add_unique_id_to_identity.apply_async(kwargs={
+            "identity": self.IDENTITY_1,
+            "unique_id": 1234567897,
+            "write_to": "health_id",
+        })
+
+        self.assertEqual(
+            result.get(),
+            "Identity <%s> now has <health_id> of <1234567897>" % (
+                self.IDENTITY_1,))
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(json.loads(responses.calls[0].request.body), {
+            "details": {"role": "mother", "health_id": "1234567897"}})
+        record = Record.objects.get()
+        self.assertTrue(record.written_back)
+        self.assertEqual(record.identity_details, None)
+
+    @responses.activate
+    def test_write_back_stale_details_per_record(self):
+        """
+        If the record's details are old when its task runs, they should be
+        fetched again, the same as for the batched write back.
+        """
+        self.mock_identity_patch(self.IDENTITY_1)
+        responses.add(
+            responses.GET,
+            'http://localhost:8001/api/v1/identities/%s/' % self.IDENTITY_1,
+            json={"id": self.IDENTITY_1, "details": {"role": "hoh"}},
+            status=200, content_type='application/json')
+        record = Record.objects.create(
+            identity=self.IDENTITY_1, write_to="health_id",
+            identity_details={"role": "mother"})
+        Record.objects.filter(id=record.id).update(
+            created_at=timezone.now() - timedelta(minutes=5))
+
+        add_unique_id_to_identity.apply_async(kwargs={
+            "identity": self.IDENTITY_1,
+            "unique_id": record.id,
+            "write_to": "health_id",
+        })
+
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(json.loads(responses.calls[-1].request.body), {
+            "details": {"role": "hoh", "health_id": str(record.id)}})
+
+    @responses.activate
+    @override_settings(UNIQUE_ID_WRITE_BACK_BATCH_SIZE=2)
+    def test_write_back_batched(self):
+        """
+        When the write back is batched, new records shouldn't queue a task,
+        and the write back task should write back all of the pending records,
+        leaving the ones that failed pending.
+        """
+        self.mock_identity_patch(self.IDENTITY_1)
+        self.mock_identity_patch(self.IDENTITY_2)
+        self.mock_identity_patch(self.IDENTITY_3, status=500)
+        responses.add(
+            responses.GET,
+            'http://localhost:8001/api/v1/identities/%s/' % self.IDENTITY_2,
+            json={"id": self.IDENTITY_2, "details": {"role": "hoh"}},
+            status=200, content_type='application/json')
+        post_save.connect(record_post_save, sender=Record)
+        try:
+            Record.objects.create(
+                identity=self.IDENTITY_1, write_to="health_id",
+                identity_details={"role": "mother"})
+            Record.objects.create(identity=self.IDENTITY_2, write_to="uid")
+            Record.objects.create(
+                identity=self.IDENTITY_3, write_to="health_id",
+                identity_details={})
+        finally:
+            post_save.disconnect(record_post_save, sender=Record)
+        self.assertEqual(len(responses.calls), 0)
+
+        result = write_back_unique_ids.apply_async()
+
+        self.assertEqual(
+            result.get(),
+            "Wrote back 2 unique IDs, 0 identities not found, 1 failed")
+        self.assertEqual(
+            sorted((c.request.method, c.request.url.split('/')[-2])
+                   for c in responses.calls), [
+                ('GET', self.IDENTITY_2),
+                ('PATCH', self.IDENTITY_3),
+                ('PATCH', self.IDENTITY_1),
+                ('PATCH', self.IDENTITY_2),
+            ])
+        failed = Record.objects.get(written_back=False)
+        self.assertEqual(str(failed.identity), self.IDENTITY_3)
+        self.assertIsNone(failed.write_back_claimed_at)
+        self.assertIsNone(failed.identity_details)
+
+    @responses.activate
+    @override_settings(UNIQUE_ID_WRITE_BACK_BATCH_SIZE=2)
+    def test_write_back_stale_details(self):
+        """
+        If the details from the webhook are old, they should be fetched
+        again, so that changes to the identity aren't overwritten.
+        """
+        self.mock_identity_patch(self.IDENTITY_1)
+        responses.add(
+            responses.GET,
+            'http://localhost:8001/api/v1/identities/%s/' % self.IDENTITY_1,
+            json={"id": self.IDENTITY_1, "details": {"role": "hoh"}},
+            status=200, content_type='application/json')
+        record = Record.objects.create(
+            identity=self.IDENTITY_1, write_to="health_id",
+            identity_details={"role": "mother"})
+        Record.objects.filter(id=record.id).update(
+            created_at=timezone.now() - timedelta(minutes=5))
+
+        result = write_back_unique_ids.apply_async()
+
+        self.assertEqual(
+            result.get(),
+            "Wrote back 1 unique IDs, 0 identities not found, 0 failed")
+        self.assertEqual(json.loads(responses.calls[-1].request.body), {
+            "details": {"role": "hoh", "health_id": str(record.id)}})
+
+    @override_settings(UNIQUE_ID_WRITE_BACK_CLAIM_SECONDS=600)
+    def test_claim_write_back(self):
+        """
+        Records that are claimed by another task shouldn't be claimed again
+        until the claim expires, and claiming shouldn't mark them as written
+        back.
+        """
+        records = [
+            Record.objects.create(
+                identity=self.IDENTITY_1, write_to="health_id")
+            for _ in range(3)]
+        Record.objects.filter(id=records[1].id).update(
+            write_back_claimed_at=timezone.now())
+        Record.objects.filter(id=records[2].id).update(
+            write_back_claimed_at=timezone.now() - timedelta(minutes=20))
+
+        claimed = Record.objects.claim_write_back(10)
+
+        self.assertEqual(
+            sorted(r.id for r in claimed),
+            sorted([records[0].id, records[2].id]))
+        self.assertEqual(Record.objects.filter(written_back=True).count(), 0)
+        self.assertEqual(Record.objects.claim_write_back(10), [])
+
+    def test_write_back_disabled(self):
+        result = write_back_unique_ids.apply_async()
+        self.assertEqual(
+            result.get(), "Batched unique ID write back is disabled")
+
+
+class TestRecordLookup(AuthenticatedAPITestCase):
+    IDENTITY = "9d02ae1a-16e4-4674-abdc-daf9cce9c52d"
+
+    def setUp(self):
+        super(TestRecordLookup, self).setUp()
+        cache.clear()
+
+    def make_registration(self, stage, validated):
+        source = Source.objects.create(
+            name="Clinic", authority="hw_full", user=self.adminuser)
+        # Created in bulk so that the registration isn't validated
+        [registration] = Registration.objects.bulk_create([Registration(
+            mother_id=self.IDENTITY, stage=stage, source=source,
+            validated=validated, language="eng_UG",
+            msg_receiver="mother_to_be")])
+        return registration
+
+    def test_lookup(self):
+        """
+        Should return the identity for the unique ID, and a summary of its
+        latest registration, which is cached.
+        """
+        Record.objects.create(
+            id=1234567897, identity=self.IDENTITY, write_to="health_id")
+        registration = self.make_registration("prebirth", True)
+
+        response = self.normalclient.get('/api/v1/uniqueid/1234567897/')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["id"], 1234567897)
+        self.assertEqual(response.data["identity"], self.IDENTITY)
+        self.assertEqual(response.data["write_to"], "health_id")
+        summary = response.data["registration"]
+        self.assertEqual(summary["registration"], registration.id)
+        self.assertEqual(summary["stage"], "prebirth")
+        self.assertEqual(summary["authority"], "hw_full")
+        self.assertEqual(summary["validated"], True)
+        self.assertEqual(summary["language"], "eng_UG")
+        self.assertEqual(summary["subscribed"], True)
+
+        Record.objects.all().delete()
+        response = self.normalclient.get('/api/v1/uniqueid/1234567897/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["identity"], self.IDENTITY)
+
+    def test_lookup_no_registration(self):
+        Record.objects.create(
+            id=1234567897, identity=self.IDENTITY, write_to="health_id")
+        response = self.normalclient.get('/api/v1/uniqueid/1234567897/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["registration"], None)
+
+    def test_lookup_not_found(self):
+        response = self.normalclient.get('/api/v1/uniqueid/1234567897/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @patch('uniqueids.views.Record.objects.get')
+    def test_lookup_invalid(self, mock_get):
+        """
+        IDs that fail the Luhn check, or that aren't made of ASCII digits,
+        shouldn't be looked up.
+        """
+        # %C2%B2 is a superscript two, which isdigit accepts
+        for unique_id in ('1234567890', '01234567897', 'abc', '%C2%B2'):
+            response = self.normalclient.get(
+                '/api/v1/uniqueid/%s/' % unique_id)
+            self.assertEqual(
+                response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(response.data, {"id": ['Invalid unique ID.']})
+        self.assertFalse(mock_get.called)
+
+    def test_lookup_unauthenticated(self):
+        response = APIClient().get('/api/v1/uniqueid/1234567897/')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
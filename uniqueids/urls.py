@@ -7,5 +7,7 @@ router = routers.DefaultRouter()
 # Wire up our API using automatic URL routing.
 # Additionally, we include login URLs for the browseable API.
 urlpatterns = [
+    url(r'^api/v1/uniqueid/(?P<unique_id>[^/]+)/$',
+        views.RecordLookup.as_view()),
     url(r'^api/v1/uniqueid/', views.RecordPost.as_view()),
 ]
@@ -1,7 +1,13 @@
+import re
+
+from django.conf import settings
+from django.core.cache import cache
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from .models import Record
+from registrations.models import MotherProfile, Registration
+from .models import Record, luhn_checksum
+from .serializers import RegistrationSummarySerializer
 
 
 class RecordPost(APIView):
@@ -15,7 +21,8 @@ class RecordPost(APIView):
         """
         if "id" in request.data["data"]:
             rec = {
-                "identity": request.data["data"]["id"]
+                "identity": request.data["data"]["id"],
+                "identity_details": request.data["data"].get("details")
             }
             if "details" in request.data["data"] and \
                     "uniqueid_field_name" in request.data["data"]["details"]:
@@ -37,3 +44,43 @@ class RecordPost(APIView):
             status = 400
             accepted = {"id": ['This field is required.']}
             return Response(accepted, status=status)
+
+
+class RecordLookup(APIView):
+
+    """ Looks up the identity that a unique ID, such as the health ID on a
+        mother's card, belongs to, along with a summary of the identity's
+        latest registration
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, unique_id, *args, **kwargs):
+        # Reject mistyped IDs without looking them up. isdigit would also
+        # accept non-ASCII digits, which int can't parse.
+        if (not re.match(r'^[0-9]+$', unique_id) or
+                unique_id != str(int(unique_id)) or
+                luhn_checksum(int(unique_id)) != 0):
+            return Response({"id": ['Invalid unique ID.']}, status=400)
+
+        cache_key = 'uniqueids.lookup.%s' % unique_id
+        data = cache.get(cache_key)
+        if data is None:
+            try:
+                record = Record.objects.get(id=unique_id)
+            except Record.DoesNotExist:
+                return Response({"detail": "Not found."}, status=404)
+            try:
+                registration = RegistrationSummarySerializer(
+                    MotherProfile.objects.get_for_mother(
+                        str(record.identity))).data
+            except Registration.DoesNotExist:
+                registration = None
+            data = {
+                "id": record.id,
+                "identity": str(record.identity),
+                "write_to": record.write_to,
+                "registration": registration,
+            }
+            cache.set(
+                cache_key, data, settings.UNIQUE_ID_LOOKUP_CACHE_SECONDS)
+        return Response(data)